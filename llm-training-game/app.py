@@ -1,15 +1,20 @@
 import streamlit as st
 import requests
-from bs4 import BeautifulSoup
-import random
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch.nn.functional as F
-import torch
-import tiktoken
+from tokenization import get_random_text_sample
+from prediction_cache import prefix_hash
+from concurrent.futures import Future
+import article_pool
+import metrics
+import model_backends
+import shared_cache
+import warmup
+import wiki_corpus
+import worker_pool
+import hashlib
+import itertools
 import os
-import openai
 import time
-import threading
+import uuid
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -20,182 +25,243 @@ st.set_page_config(
     layout="wide",
 )
 
-# Initialize Hyperbolic client
+# Models to show predictions from, e.g. MODEL_BACKENDS=gpt2,llama3,llama2 (see model_backends),
+# and how long to wait for each, e.g. MODEL_TIMEOUTS=gpt2=30,llama3=10
 @st.cache_resource
-def get_hyperbolic_client():
-    return openai.OpenAI(
-        api_key=os.getenv('HYPERBOLIC_API_KEY'),
-        base_url="https://api.hyperbolic.xyz/v1",
+def get_backends():
+    names = os.getenv('MODEL_BACKENDS', ','.join(model_backends.DEFAULT_BACKENDS))
+    return model_backends.make_backends(
+        [name.strip() for name in names.split(',') if name.strip()],
+        timeouts=model_backends.parse_timeouts(os.getenv('MODEL_TIMEOUTS', ''))
     )
 
-hyperbolic_client = get_hyperbolic_client()
+# Local models are loaded and run at a few prefix lengths (WARMUP_LENGTHS, e.g. 8,128,512)
+# before the game starts. If HEALTH_PORT is set, GET /health on that port reports whether
+# they are ready (see warmup), and GET /metrics has per-stage latencies for Prometheus.
+@st.cache_resource
+def get_warmup():
+    lengths = os.getenv('WARMUP_LENGTHS')
+    lengths = [int(length) for length in lengths.split(',')] if lengths else model_backends.WARMUP_LENGTHS
+    models = warmup.ModelWarmup(get_backends(), lengths)
+    if os.getenv('HEALTH_PORT'):
+        models.serve_health(int(os.getenv('HEALTH_PORT')))
+    return models
 
-# Cache GPT-2 model to avoid reloading
+# One cache for the whole server, so players on the same article share predictions
+# (size cap in MB from PREDICTION_CACHE_MB)
 @st.cache_resource
-def load_gpt2_model():
-    return AutoModelForCausalLM.from_pretrained('gpt2')
+def get_shared_cache():
+    return shared_cache.SharedPredictionCache(max_bytes=int(os.getenv('PREDICTION_CACHE_MB', '64')) * 1024 * 1024)
 
+# One pool of worker threads for the whole server, with separate caps on concurrent
+# local model calls (LOCAL_WORKERS) and remote API calls (REMOTE_WORKERS)
 @st.cache_resource
-def load_gpt2_tokenizer():
-    return AutoTokenizer.from_pretrained('gpt2')
+def get_worker_pool():
+    return worker_pool.PriorityWorkerPool({
+        'local': int(os.getenv('LOCAL_WORKERS', '1')),
+        'remote': int(os.getenv('REMOTE_WORKERS', '8')),
+    })
+
+# The step a player is looking at runs before any look-ahead step, and look-ahead
+# steps run nearest first
+VIEWING_PRIORITY = 0
+
+# Articles in the pool have their first ARTICLE_POOL_STEPS steps predicted, after everything
+# players are waiting on
+PREFETCH_PRIORITY = 100
+PREFETCH_STEPS = int(os.getenv('ARTICLE_POOL_STEPS', '3'))
+FIRST_PREFIX_SIZE = 10
 
 def get_random_wikipedia_article():
-    # URL for random Wikipedia article
-    url = "https://en.wikipedia.org/wiki/Special:Random"
+    with metrics.timer('wikipedia_fetch'):
+        response = requests.get(wiki_corpus.WIKIPEDIA_RANDOM_URL, timeout=30)
+        response.raise_for_status()
+    with metrics.timer('html_parse'):
+        return wiki_corpus.parse_article_html(response.text)
 
-    # Send request and get response
-    with st.spinner("Fetching random Wikipedia article..."):
-        response = requests.get(url)
+def submit_step(words, prefix_size, priority, tag=None):
+    """Queue each model's predictions for a step on the worker pool. Returns {model name: Future}."""
+    prefix = ''.join(words[:prefix_size])
+    # Cache keys hash the prefix, so long samples don't fill the cache with copies of their text
+    key = prefix_hash(prefix)
+    cache = get_shared_cache()
+    pool = get_worker_pool()
 
-    # Parse HTML content
-    soup = BeautifulSoup(response.text, 'html.parser')
+    futures = {}
+    # Each model is its own task, so local and remote models run at the same time
+    for backend in get_backends():
+        cached = cache.get((backend.name, key))
+        if cached is not None:
+            # Already there (e.g. from the whole-sample pass), so no need to queue behind other work
+            futures[backend.name] = Future()
+            futures[backend.name].set_result(cached)
+            continue
+        def compute(backend=backend):
+            return cache.get_or_compute((backend.name, key), lambda: backend.predict_topk([prefix], 5)[0])
+        futures[backend.name] = pool.submit('remote' if backend.remote else 'local', priority, compute, tag)
+    return futures
 
-    # Get article title
-    title = soup.find(id="firstHeading").text
+def submit_sample_lookahead(words, first_prefix_size, tag=None, priority=VIEWING_PRIORITY + 1):
+    """Queue every local model's predictions for every step of the sample, one pass over it per model.
 
-    # Get main content (excluding references, navigation, etc.)
-    content = soup.find(id="mw-content-text")
+    Each pass fills the shared cache, so the steps after it find their local predictions there.
+    """
+    cache = get_shared_cache()
+    text = ''.join(words)
+    ends = []
+    keys = []
+    # Hashing incrementally gives prefix_hash(''.join(words[:n])) without joining every prefix
+    prefix = hashlib.sha256()
+    for prefix_size, end in enumerate(itertools.accumulate(len(word) for word in words), start=1):
+        prefix.update(words[prefix_size - 1].encode('utf-8'))
+        if prefix_size >= first_prefix_size:
+            ends.append(end)
+            keys.append(prefix.hexdigest())
 
-    # Remove unwanted elements
-    for unwanted in content.find_all(['table', 'sup', 'div.thumb', 'span.mw-editsection']):
-        unwanted.decompose()
+    for backend in get_backends():
+        if backend.remote or not hasattr(backend, 'predict_text'):
+            continue
+        def compute(backend=backend):
+            # Only the steps not already predicted, e.g. while the article waited in the pool
+            missing = [i for i, key in enumerate(keys) if (backend.name, key) not in cache]
+            if missing:
+                predictions = backend.predict_text(text, [ends[i] for i in missing], 5)
+                cache.put_many(((backend.name, keys[i]), prediction) for i, prediction in zip(missing, predictions))
+        # By default ahead of the per-step look-ahead, which it makes unnecessary for this model
+        get_worker_pool().submit('local', priority, compute, tag)
 
-    # Extract text
-    text = content.get_text().strip()
+def step_results(words, prefix_size, futures, started=None, on_ready=None):
+    """Wait for a step's predictions and put them together.
 
+    Models that fail or run past their timeout get an error entry (see model_backends.collect_predictions).
+    """
     return {
-        'title': title,
-        'text': text
+        "prefix": ''.join(words[:prefix_size]),
+        "next_actual_token": words[prefix_size] if prefix_size < len(words) else "END",
+        "predictions": model_backends.collect_predictions(get_backends(), futures, started, on_ready)
     }
 
-def get_random_text_sample(text, minimum_sample_length=20):
-    # Tokenize text using tiktoken and convert back to strings
-    enc = tiktoken.get_encoding("gpt2")
-    tokens = enc.encode(text)
-    words = [enc.decode([token]) for token in tokens]
-    
-    if len(words) > minimum_sample_length:
-        max_start_index = len(words) - minimum_sample_length
-        start_index = random.randint(0, max_start_index)
-    else:
-        start_index = 0
-    
-    return words[start_index:]
-
-def step(words, prefix_size):
+def step(words, prefix_size, on_ready=None):
     """
     Generate next token predictions from different models based on a prefix of words.
     
     Args:
         words: List of tokens/words
         prefix_size: Number of tokens to use as prefix
+        on_ready: Called with (model name, predictions) as soon as each model is done
     
     Returns:
         Dictionary containing predictions from each model
     """
-    # Create the prompt from the prefix
-    prefix = ''.join(words[:prefix_size])
-    
-    results = {
-        "prefix": prefix,
-        "next_actual_token": words[prefix_size] if prefix_size < len(words) else "END",
-        "predictions": {}
+    started = time.monotonic()
+    with metrics.timer('app_step'):
+        futures = submit_step(words, prefix_size, VIEWING_PRIORITY, st.session_state.article_id)
+        return step_results(words, prefix_size, futures, started, on_ready)
+
+def has_errors(results):
+    return any("error" in pred for preds in results["predictions"].values() for pred in preds)
+
+def schedule_lookahead(num_steps=10):
+    """Queue the steps after the one being viewed that aren't cached or queued yet"""
+    for distance in range(num_steps):
+        prefix_size = st.session_state.prefix_size + distance
+        if prefix_size >= len(st.session_state.sample):
+            break
+        if prefix_size in st.session_state.cached_steps or prefix_size in st.session_state.pending_steps:
+            continue
+        st.session_state.pending_steps[prefix_size] = submit_step(
+            st.session_state.sample, prefix_size, VIEWING_PRIORITY + 1 + distance, st.session_state.article_id
+        )
+
+def collect_lookahead():
+    """Move finished look-ahead steps into cached_steps (only the script thread touches session state)"""
+    # A look-ahead step that never finishes is simply computed again (with timeouts) when it's viewed
+    for prefix_size, futures in list(st.session_state.pending_steps.items()):
+        if all(future.done() for future in futures.values()):
+            st.session_state.cached_steps[prefix_size] = step_results(st.session_state.sample, prefix_size, futures)
+            del st.session_state.pending_steps[prefix_size]
+
+def prepare_article(article):
+    """Sample an article and queue predictions for its first steps, so it's ready to play.
+
+    Runs on the article pool's threads, and only fills the shared cache.
+    """
+    prepared = {
+        'article': article,
+        'article_id': uuid.uuid4().hex,
+        'sample': get_random_text_sample(article['text'], minimum_sample_length=40),
     }
-    
-    # Get GPT-2 predictions
-    with st.spinner("Getting GPT-2 predictions..."):
-        gpt2_model = load_gpt2_model()
-        gpt2_tokenizer = load_gpt2_tokenizer()
-        inputs = gpt2_tokenizer(prefix, return_tensors='pt')
-        with torch.no_grad():
-            outputs = gpt2_model(**inputs)
-            logits = outputs.logits[0, -1, :]
-        probs = F.softmax(logits, dim=-1)
-        top_probs, top_indices = torch.topk(probs, 5)
-        
-        gpt2_predictions = []
-        for prob, idx in zip(top_probs, top_indices):
-            token = gpt2_tokenizer.decode(idx)
-            gpt2_predictions.append({"token": token, "probability": prob.item()})
-        
-        results["predictions"]["gpt2"] = gpt2_predictions
-    
-    # Get Llama-2 predictions
-    try:
-        raise Exception('not implemented')
-        # Llama-2 code would go here
-    except Exception as e:
-        results["predictions"]["llama2"] = [{"error": str(e)}]
-    
-    # Get Llama 3.1 predictions
-    try:
-        with st.spinner("Getting Llama 3.1 predictions..."):
-            chat_completion = hyperbolic_client.completions.create(
-                model="meta-llama/Meta-Llama-3.1-405B-FP8",
-                prompt=prefix,
-                temperature=0,
-                top_p=1,
-                max_tokens=1,
-                logprobs=5,
-            )
-            
-            logprobs = chat_completion.choices[0].logprobs.top_logprobs[0]
-            
-            # Sort by logprob values (highest first)
-            sorted_logprobs = sorted(logprobs.items(), key=lambda x: x[1], reverse=True)
-            
-            llama3_predictions = []
-            for token, logprob in sorted_logprobs:
-                if logprob > -9999:  # Skip the placeholder values
-                    prob = torch.exp(torch.tensor(logprob)).item()
-                    llama3_predictions.append({"token": token, "probability": prob})
-            
-            results["predictions"]["llama3"] = llama3_predictions
-    except Exception as e:
-        results["predictions"]["llama3"] = [{"error": str(e)}]
-    
-    return results
-
-def precompute_steps(words, start_prefix_size, num_steps=10):
-    """Precompute multiple steps and cache the results"""
-    results = {}
-    for i in range(num_steps):
-        current_prefix_size = start_prefix_size + i
-        if current_prefix_size < len(words):
-            results[current_prefix_size] = step(words, current_prefix_size)
-    return results
-
-def background_precompute(words, start_prefix_size, num_steps=10):
-    """Run precomputation in background and update session state when done"""
-    results = precompute_steps(words, start_prefix_size, num_steps)
-    # Update the session state with the precomputed results
-    st.session_state.cached_steps.update(results)
-    st.session_state.precomputing = False
+    submit_sample_lookahead(prepared['sample'], FIRST_PREFIX_SIZE, prepared['article_id'], PREFETCH_PRIORITY)
+    for prefix_size in range(FIRST_PREFIX_SIZE, min(FIRST_PREFIX_SIZE + PREFETCH_STEPS, len(prepared['sample']))):
+        submit_step(prepared['sample'], prefix_size, PREFETCH_PRIORITY, prepared['article_id'])
+    return prepared
 
-# Initialize session state
-if 'article' not in st.session_state:
-    st.session_state.article = get_random_wikipedia_article()
-    st.session_state.sample = get_random_text_sample(st.session_state.article['text'], minimum_sample_length=40)
-    st.session_state.prefix_size = 10
+# Articles fetched, sampled and partly predicted ahead of time (see article_pool), falling back
+# to the local corpus ARTICLE_CORPUS (which generate.py --corpus also fills) when the fetchers
+# are behind. ARTICLE_POOL_DEPTH articles are kept ready, refilling once fewer than
+# ARTICLE_POOL_LOW_WATERMARK are.
+@st.cache_resource
+def get_article_pool():
+    return article_pool.ArticlePool(
+        get_random_wikipedia_article,
+        prepare_article,
+        corpus=wiki_corpus.CorpusStore(os.getenv('ARTICLE_CORPUS', wiki_corpus.DEFAULT_CORPUS_PATH)),
+        depth=int(os.getenv('ARTICLE_POOL_DEPTH', '8')),
+        low_watermark=int(os.getenv('ARTICLE_POOL_LOW_WATERMARK', '3')),
+    )
+
+def start_article(prepared):
+    """Reset the session to play a prepared article, cancelling work queued for the old one"""
+    if 'article_id' in st.session_state:
+        get_worker_pool().cancel(st.session_state.article_id)
+    st.session_state.article = prepared['article']
+    st.session_state.article_id = prepared['article_id']
+    st.session_state.sample = prepared['sample']
+    st.session_state.prefix_size = FIRST_PREFIX_SIZE
+    # Whatever the pool queued for this article and hasn't started is queued again at the
+    # priority of a player waiting on it (look-ahead steps are queued on the next run)
+    get_worker_pool().cancel(prepared['article_id'])
+    submit_sample_lookahead(prepared['sample'], FIRST_PREFIX_SIZE, prepared['article_id'])
     st.session_state.show_predictions = False
     st.session_state.show_actual = False
     st.session_state.step_results = None
     st.session_state.cached_steps = {}
-    st.session_state.precomputing = False
+    st.session_state.pending_steps = {}
 
-# Start precomputation if needed
-if not st.session_state.precomputing and len(st.session_state.cached_steps) < 5:
-    st.session_state.precomputing = True
-    start_prefix = max(st.session_state.prefix_size, max(st.session_state.cached_steps.keys()) + 1) if st.session_state.cached_steps else st.session_state.prefix_size
-    threading.Thread(target=background_precompute, args=(st.session_state.sample, start_prefix, 10)).start()
+# Nothing runs a model until warmup is over, so no player waits on loading it
+if not get_warmup().ready:
+    st.markdown("### Warming up models...")
+    for name, status in get_warmup().status.items():
+        st.write(f"{name}: {status}")
+    time.sleep(1)
+    st.rerun()
+
+# Initialize session state
+if 'article' not in st.session_state:
+    with metrics.timer('new_article'):
+        start_article(get_article_pool().take())
+
+# Pick up finished look-ahead steps and keep the next ones queued
+collect_lookahead()
+schedule_lookahead(10)
 
 # Display cache status (for debugging, can be removed in production)
-cache_status = f"Cached steps: {len(st.session_state.cached_steps)} steps ahead"
+steps_ahead = sum(1 for prefix_size in st.session_state.cached_steps if prefix_size >= st.session_state.prefix_size)
+cache_status = f"Cached steps: {steps_ahead} steps ahead ({len(st.session_state.pending_steps)} queued)"
 st.sidebar.write(cache_status)
+st.sidebar.write(get_shared_cache().summary())
+st.sidebar.write(get_worker_pool().summary())
+st.sidebar.write(get_article_pool().summary())
+st.sidebar.write(get_warmup().summary())
+if metrics.enabled:
+    with st.sidebar.expander("Latency by stage"):
+        st.code(metrics.summary_table())
 if st.sidebar.button("Force Precompute"):
-    st.session_state.precomputing = True
-    start_prefix = st.session_state.prefix_size
-    threading.Thread(target=background_precompute, args=(st.session_state.sample, start_prefix, 10)).start()
+    # Recompute look-ahead steps that came back with errors
+    for prefix_size, results in list(st.session_state.cached_steps.items()):
+        if has_errors(results):
+            del st.session_state.cached_steps[prefix_size]
+    schedule_lookahead(10)
     st.rerun()
 
 # Display article title in sidebar
@@ -224,70 +290,61 @@ col1, col2, col3 = st.columns(3)
 with col1:
     if st.button("Show/Hide Predictions", type="primary"):
         st.session_state.show_predictions = not st.session_state.show_predictions
-        # Use cached results if available, otherwise compute
-        if st.session_state.prefix_size in st.session_state.cached_steps:
-            st.session_state.step_results = st.session_state.cached_steps[st.session_state.prefix_size]
-        else:
-            st.session_state.step_results = step(st.session_state.sample, st.session_state.prefix_size)
 
 with col2:
     if st.button("Reveal Next Token & Advance", type="secondary"):
-        # Use cached results if available, otherwise compute
-        if st.session_state.prefix_size in st.session_state.cached_steps:
-            st.session_state.step_results = st.session_state.cached_steps[st.session_state.prefix_size]
-        else:
-            st.session_state.step_results = step(st.session_state.sample, st.session_state.prefix_size)
         st.session_state.show_actual = True
 
 with col3:
     if st.button("New Article"):
-        st.session_state.article = get_random_wikipedia_article()
-        st.session_state.sample = get_random_text_sample(st.session_state.article['text'], minimum_sample_length=40)
-        st.session_state.prefix_size = 10
-        st.session_state.show_predictions = False
-        st.session_state.show_actual = False
-        st.session_state.step_results = None
-        st.session_state.cached_steps = {}
-        st.session_state.precomputing = False
+        with metrics.timer('new_article'):
+            start_article(get_article_pool().take())
         st.rerun()
 
-# Get predictions if needed
-if st.session_state.show_predictions and not st.session_state.step_results:
-    # Use cached results if available, otherwise compute
-    if st.session_state.prefix_size in st.session_state.cached_steps:
-        st.session_state.step_results = st.session_state.cached_steps[st.session_state.prefix_size]
-    else:
-        st.session_state.step_results = step(st.session_state.sample, st.session_state.prefix_size)
+# Use look-ahead results for this step if there are any (they may include a model that timed out here)
+cached_results = st.session_state.cached_steps.get(st.session_state.prefix_size)
+if cached_results and (not st.session_state.step_results or has_errors(st.session_state.step_results)):
+    st.session_state.step_results = cached_results
 
 # Show predictions if toggled
-if st.session_state.show_predictions and st.session_state.step_results:
+if st.session_state.show_predictions:
     st.markdown("### Model Predictions")
     
     # Create columns for each model
-    col1, col2 = st.columns(2)
-    
-    # GPT-2
-    with col1:
-        st.markdown("#### GPT-2")
-        for pred in st.session_state.step_results["predictions"]["gpt2"]:
-            st.markdown(f"**{pred['probability']:.3f}:** `{pred['token']}`")
-    
-    # Llama 3.1
-    with col2:
-        st.markdown("#### Llama 3.1")
-        if "llama3" in st.session_state.step_results["predictions"]:
-            for pred in st.session_state.step_results["predictions"]["llama3"]:
+    placeholders = {}
+    for column, backend in zip(st.columns(len(get_backends())), get_backends()):
+        with column:
+            st.markdown(f"#### {backend.label}")
+            placeholders[backend.name] = st.empty()
+
+    def show_model_predictions(name, predictions):
+        with placeholders[name].container():
+            for pred in predictions:
                 if "error" in pred:
                     st.error(f"Error: {pred['error']}")
                 else:
                     st.markdown(f"**{pred['probability']:.3f}:** `{pred['token']}`")
-        else:
-            st.write("Not available")
+
+    if st.session_state.step_results:
+        for name, placeholder in placeholders.items():
+            if name in st.session_state.step_results["predictions"]:
+                show_model_predictions(name, st.session_state.step_results["predictions"][name])
+            else:
+                placeholder.write("Not available")
+    else:
+        # Fill in each model's column as soon as it is done, so a slow model doesn't hold up the rest
+        for placeholder in placeholders.values():
+            placeholder.caption("Thinking...")
+        st.session_state.step_results = step(
+            st.session_state.sample, st.session_state.prefix_size, on_ready=show_model_predictions
+        )
 
 # Show actual next token if revealed
-if st.session_state.show_actual and st.session_state.step_results:
+if st.session_state.show_actual:
+    prefix_size = st.session_state.prefix_size
+    next_actual_token = st.session_state.sample[prefix_size] if prefix_size < len(st.session_state.sample) else "END"
     st.markdown("### Actual Next Token")
-    st.markdown(f"## `{st.session_state.step_results['next_actual_token']}`")
+    st.markdown(f"## `{next_actual_token}`")
     
     # Advance after showing
     if st.button("Continue to Next Token"):
@@ -300,12 +357,7 @@ if st.session_state.show_actual and st.session_state.step_results:
         else:
             st.session_state.step_results = None
             
-        # Trigger precomputation if cache is getting low
-        if not st.session_state.precomputing and len(st.session_state.cached_steps) < 5:
-            st.session_state.precomputing = True
-            start_prefix = max(st.session_state.prefix_size, max(st.session_state.cached_steps.keys()) + 1) if st.session_state.cached_steps else st.session_state.prefix_size
-            threading.Thread(target=background_precompute, args=(st.session_state.sample, start_prefix, 10)).start()
-            
+        # The rerun queues the look-ahead steps that are now in range
         st.rerun()
 
 # Add some styling
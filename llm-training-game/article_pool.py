@@ -0,0 +1,97 @@
+"""
+Pool of ready-to-play articles for the Streamlit app, refilled in the background.
+
+Fetching and parsing a random Wikipedia article takes a network round-trip, so instead
+of doing it when a player asks for a new article, fetcher threads keep a few articles
+ready. Each is passed through prepare() before it joins the pool (app.py samples it and
+queues its first predictions), and saved to the local corpus.
+
+Refilling starts when fewer than `low_watermark` articles are ready and stops once
+`depth` are. When the pool is empty, take() falls back to an article from the corpus,
+and only waits for the fetchers if the corpus is empty too.
+"""
+
+import collections
+import threading
+import time
+
+class ArticlePool:
+    def __init__(self, fetch, prepare, corpus=None, depth=8, low_watermark=3, num_fetchers=2):
+        """fetch() returns a new article, prepare(article) turns it into what take() hands out"""
+        self.fetch = fetch
+        self.prepare = prepare
+        self.corpus = corpus
+        self.depth = depth
+        self.low_watermark = low_watermark
+        self.lock = threading.Lock()
+        self.wanted = threading.Condition(self.lock)
+        self.arrived = threading.Condition(self.lock)
+        self.ready = collections.deque()
+        self.fetching = 0
+        self.refilling = True
+        self.taken = 0
+        self.from_corpus = 0
+        self.failures = 0
+        self.fetchers = [threading.Thread(target=self.fetch_loop, daemon=True) for _ in range(num_fetchers)]
+        for fetcher in self.fetchers:
+            fetcher.start()
+
+    def take(self, timeout=60):
+        """Return a prepared article, only waiting for the fetchers if the pool and corpus are both empty"""
+        with self.lock:
+            self.taken += 1
+            if not self.ready and self.corpus is not None and len(self.corpus):
+                article = self.corpus.random_article()
+                self.from_corpus += 1
+            else:
+                if not self.arrived.wait_for(lambda: self.ready, timeout):
+                    raise RuntimeError(f"No article fetched within {timeout}s")
+                article = None
+                prepared = self.ready.popleft()
+            self.update_refilling()
+        return prepared if article is None else self.prepare(article)
+
+    def update_refilling(self):
+        """Start refilling below the low watermark and stop at depth. Call with the lock held."""
+        if len(self.ready) + self.fetching < self.low_watermark:
+            self.refilling = True
+            self.wanted.notify_all()
+        elif len(self.ready) + self.fetching >= self.depth:
+            self.refilling = False
+
+    def fetch_loop(self):
+        failures = 0
+        while True:
+            with self.lock:
+                while not self.refilling or len(self.ready) + self.fetching >= self.depth:
+                    self.wanted.wait()
+                self.fetching += 1
+
+            try:
+                article = self.fetch()
+                prepared = self.prepare(article)
+            except Exception as e:
+                print(f"Error fetching article for the pool: {e}")
+                with self.lock:
+                    self.fetching -= 1
+                    self.failures += 1
+                failures += 1
+                time.sleep(min(30, 2 ** failures))
+                continue
+            failures = 0
+
+            with self.lock:
+                self.fetching -= 1
+                self.ready.append(prepared)
+                self.arrived.notify()
+                if self.corpus is not None:
+                    self.corpus.add(article)
+                self.update_refilling()
+
+    def summary(self):
+        with self.lock:
+            state = "refilling" if self.refilling else "idle"
+            return (
+                f"Article pool: {len(self.ready)}/{self.depth} ready ({state}), "
+                f"{self.from_corpus} of {self.taken} taken from the corpus, {self.failures} failed fetches"
+            )
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the data generation pipeline.
+
+    python bench.py tokenize     # tokenization.get_random_text_sample vs. the old per-token decode
+    python bench.py startup      # generate.py import time and first-prediction latency
+    python bench.py lookahead    # GPT-2 for every step of a sample in one pass vs. step by step
+    python bench.py metrics      # cost of a metrics.timer() block, enabled and disabled
+    python bench.py tui          # tui.py frame time over a scripted key sequence
+    python bench.py combine      # combine_json.py peak memory as the inputs grow
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tiktoken
+import tokenization
+
+def timed(fn, repeat):
+    """Best wall-clock time of `repeat` runs of fn(), and its last result"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def load_article_texts(path, article_kb):
+    """Build article-sized texts out of a prediction dataset's samples"""
+    samples = json.load(open(path))
+    texts = []
+    for sample in samples:
+        text = ''.join(sample['sample_words'])
+        # Repeat short samples up to roughly the size of a full Wikipedia article
+        texts.append((text + '\n') * max(1, article_kb * 1024 // (len(text) + 1)))
+    return texts
+
+def old_random_text_sample(text, minimum_sample_length=20):
+    """get_random_text_sample as it was before tokenization.py"""
+    enc = tiktoken.get_encoding("gpt2")
+    tokens = enc.encode(text)
+    words = [enc.decode([token]) for token in tokens]
+
+    if len(words) > minimum_sample_length:
+        max_start_index = len(words) - minimum_sample_length
+        start_index = random.randint(0, max_start_index)
+    else:
+        start_index = 0
+
+    return words[start_index:]
+
+def bench_tokenize(args):
+    texts = load_article_texts(args.dataset, args.article_kb)
+    print(f"{len(texts)} texts, {sum(map(len, texts)) / 1024:.0f} KB total")
+
+    def run(sample_fn):
+        random.seed(0)
+        return [sample_fn(text, minimum_sample_length=40) for text in texts]
+
+    old_time, old_result = timed(lambda: run(old_random_text_sample), args.repeat)
+    new_time, new_result = timed(lambda: run(tokenization.get_random_text_sample), args.repeat)
+    assert old_result == new_result, "tokenization.get_random_text_sample changed its output"
+
+    print(f"per-token decode:  {old_time * 1000:8.1f} ms")
+    print(f"tokenization.py:   {new_time * 1000:8.1f} ms")
+    print(f"speedup:           {old_time / new_time:8.1f}x")
+
+# Runs in a fresh interpreter, so nothing is already imported or loaded
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import generate
+imported = time.perf_counter()
+generate.get_gpt2_predictions("The quick brown fox jumps over the")
+first = time.perf_counter()
+generate.get_gpt2_predictions("The quick brown fox jumps over the lazy")
+second = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_prediction": first - imported, "warm_prediction": second - first}))
+"""
+
+def bench_startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    timings = {"import": [], "first_prediction": [], "warm_prediction": [], "no_model_run": []}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(args.repeat):
+            result = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT], cwd=here, capture_output=True, text=True, check=True
+            )
+            for name, seconds in json.loads(result.stdout.strip().splitlines()[-1]).items():
+                timings[name].append(seconds)
+
+            # A whole run that never needs a model, from process start to exit
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, 'generate.py', '--mode', 'literal', '--file', args.literal_file,
+                 '--no-model-completions', '--no-cache', '--output', os.path.join(tmp, 'out.json')],
+                cwd=here, capture_output=True, check=True
+            )
+            timings["no_model_run"].append(time.perf_counter() - start)
+
+    print(f"median of {args.repeat} runs:")
+    print(f"  import generate:               {statistics.median(timings['import']) * 1000:8.0f} ms")
+    print(f"  first GPT-2 prediction (cold): {statistics.median(timings['first_prediction']) * 1000:8.0f} ms")
+    print(f"  next GPT-2 prediction (warm):  {statistics.median(timings['warm_prediction']) * 1000:8.0f} ms")
+    print(f"  --no-model-completions run:    {statistics.median(timings['no_model_run']) * 1000:8.0f} ms")
+
+def bench_lookahead(args):
+    import itertools
+    import model_backends
+
+    texts = load_article_texts(args.dataset, args.article_kb)
+    random.seed(0)
+    words = tokenization.get_random_text_sample(random.choice(texts), minimum_sample_length=40)[:args.sample_tokens]
+    backend = model_backends.make_backends(['gpt2'])[0]
+    ends = list(itertools.accumulate(len(word) for word in words))[args.first_step - 1:]
+    print(f"sample of {len(words)} tokens, {len(ends)} steps")
+
+    # Loads the model outside the timings
+    backend.predict_topk([''.join(words[:args.first_step])])
+
+    whole_time, whole = timed(lambda: backend.predict_text(''.join(words), ends), args.repeat)
+    steps = ends[:args.steps]
+    step_time, by_step = timed(
+        lambda: [backend.predict_topk([''.join(words)[:end]])[0] for end in steps], args.repeat
+    )
+    same = sum([p['token'] for p in a] == [p['token'] for p in b] for a, b in zip(whole, by_step))
+    print(f"top-k tokens agree on {same} of {len(steps)} compared steps")
+
+    print(f"whole sample, one pass:       {whole_time * 1000:8.0f} ms for {len(ends)} steps "
+          f"({whole_time * 1000 / len(ends):.1f} ms/step)")
+    print(f"step by step:                 {step_time * 1000:8.0f} ms for {len(steps)} steps "
+          f"({step_time * 1000 / len(steps):.1f} ms/step)")
+
+def bench_metrics(args):
+    import metrics
+
+    def bare():
+        for _ in range(args.calls):
+            pass
+
+    def instrumented():
+        for _ in range(args.calls):
+            with metrics.timer('bench'):
+                pass
+
+    bare_time, _ = timed(bare, args.repeat)
+    metrics.enable()
+    enabled_time, _ = timed(instrumented, args.repeat)
+    metrics.disable()
+    disabled_time, _ = timed(instrumented, args.repeat)
+
+    print(f"{args.calls} timed blocks, per block:")
+    print(f"  metrics enabled:   {(enabled_time - bare_time) / args.calls * 1e9:8.0f} ns")
+    print(f"  metrics disabled:  {(disabled_time - bare_time) / args.calls * 1e9:8.0f} ns")
+
+def tui_key_script(dataset, num_keys):
+    """Keys that step through each sample and back, like holding the arrow keys, peeking at the predictions"""
+    keys = []
+    for sample in dataset:
+        steps = len(sample['steps'])
+        keys += ['right'] * (steps - 1) + ['p'] + ['left'] * (steps - 1) + ['r', 'p', 'down']
+    return (keys * (num_keys // len(keys) + 1))[:num_keys]
+
+def long_prefix_dataset(path, prefix_kb):
+    """A copy of a dataset with each step's prefix repeated to about prefix_kb, for slow renders"""
+    samples = json.load(open(path))
+    for sample in samples:
+        for step in sample['steps']:
+            step['prefix'] = (step['prefix'] + ' ') * max(1, prefix_kb * 1024 // (len(step['prefix']) + 1))
+    return samples
+
+def bench_tui(args):
+    import asyncio
+    from rich.panel import Panel
+    from rich.text import Text
+    from textual.reactive import reactive
+    import tui
+
+    class OldDisplayViewer(tui.PredictionViewer):
+        # Reactive, so every assignment also repainted the app
+        show_predictions = reactive(False)
+        show_actual = reactive(False)
+        current_sample_index = reactive(0)
+        current_step_index = reactive(0)
+
+        def update_display(self):
+            """update_display as it was before render caching"""
+            current_sample = self.data[self.current_sample_index]
+            current_step = current_sample["steps"][self.current_step_index]
+            self.query_one("#title").update(f"Article: {current_sample['article_title']}")
+            self.query_one("#sample_nav").update(f"Sample {self.current_sample_index + 1} of {len(self.data)}")
+            self.query_one("#step_nav").update(f"Step {self.current_step_index + 1} of {len(current_sample['steps'])}")
+            self.query_one("#prefix").update(Panel(current_step["prefix"], title="Current Prefix"))
+            self.query_one("#predictions").update(self.format_predictions(current_step["predictions"]))
+            actual_text = Text(f"{current_step['next_actual_token']}", style="bold green")
+            self.query_one("#actual").update(Panel(actual_text, title="Actual Next Token"))
+            self.query_one("#predictions").set_class(self.show_predictions, "visible")
+            self.query_one("#actual").set_class(self.show_actual, "visible")
+            self.query_one("#prev_sample").disabled = self.current_sample_index == 0
+            self.query_one("#next_sample").disabled = self.current_sample_index >= len(self.data) - 1
+            self.query_one("#prev_step").disabled = self.current_step_index == 0
+            self.query_one("#next_step").disabled = self.current_step_index >= len(current_sample["steps"]) - 1
+
+    async def replay(viewer_class, path, keys):
+        """CPU time from each key press until the frame after it has been drawn, and the total wall time.
+
+        CPU time leaves out the test pilot's idle waits, which are most of the wall time.
+        """
+        app = viewer_class(path)
+        frame_times = []
+        async with app.run_test(size=(args.width, args.height)) as pilot:
+            # The dataset is opened on a worker thread
+            await app.workers.wait_for_complete()
+            await pilot.pause()
+            start_wall = time.perf_counter()
+            for key in keys:
+                start = time.process_time()
+                await pilot.press(key)
+                await pilot.pause()
+                frame_times.append(time.process_time() - start)
+            wall = time.perf_counter() - start_wall
+        return frame_times, wall
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'dataset.json')
+        samples = long_prefix_dataset(args.dataset, args.prefix_kb)
+        json.dump(samples, open(path, 'w'))
+        keys = tui_key_script(samples, args.keys)
+        print(f"{len(keys)} keys over {len(samples)} samples, prefixes of about {args.prefix_kb} KB, "
+              f"{args.width}x{args.height} terminal")
+
+        print("CPU ms per frame:")
+        for name, viewer_class in [('before', OldDisplayViewer), ('cached', tui.PredictionViewer)]:
+            frame_times, wall = asyncio.run(replay(viewer_class, path, keys))
+            frame_times.sort()
+            print(f"  {name:<8} mean {statistics.mean(frame_times) * 1000:6.1f}, "
+                  f"p50 {statistics.median(frame_times) * 1000:6.1f}, "
+                  f"p95 {frame_times[int(0.95 * (len(frame_times) - 1))] * 1000:6.1f}, "
+                  f"max {frame_times[-1] * 1000:6.1f}  (wall {wall * 1000 / len(keys):.1f} ms per key)")
+
+def old_combine_json_files(input_files, output_file):
+    """combine_json.combine_json_files as it was before streaming: every input loaded at once"""
+    combined_data = []
+    for file_path in input_files:
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+            if isinstance(data, list):
+                combined_data.extend(data)
+    with open(output_file, 'w') as f:
+        json.dump(combined_data, f, indent=2)
+
+# Runs in a fresh interpreter, so its peak RSS is the merge's own
+COMBINE_SCRIPT = """
+import json, resource, sys, time
+import bench, combine_json
+which, output_file, input_files = sys.argv[1], sys.argv[2], sys.argv[3:]
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if which == 'before':
+    bench.old_combine_json_files(input_files, output_file)
+else:
+    combine_json.combine_json_files(input_files, output_file)
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "baseline_kb": baseline, "peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+def write_combine_inputs(path, count, file_mb, tmp):
+    """count JSON datasets of about file_mb each, made of the samples in path under distinct titles"""
+    samples = json.load(open(path))
+    sample_bytes = len(json.dumps(samples, indent=2)) / len(samples)
+    per_file = max(1, int(file_mb * 1024 * 1024 / sample_bytes))
+    paths = []
+    for n in range(count):
+        file_samples = []
+        for i in range(per_file):
+            sample = dict(samples[i % len(samples)])
+            sample['article_title'] = f"{sample['article_title']} ({n}-{i})"
+            file_samples.append(sample)
+        paths.append(os.path.join(tmp, f'input-{n}.json'))
+        with open(paths[-1], 'w') as f:
+            json.dump(file_samples, f, indent=2)
+    return paths
+
+def bench_combine(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_combine_inputs(args.dataset, max(args.files), args.file_mb, tmp)
+        print(f"inputs of {os.path.getsize(paths[0]) / 1024 / 1024:.1f} MB each; peak RSS above interpreter start:")
+        for count in args.files:
+            results = {}
+            for which in ['before', 'streaming']:
+                result = subprocess.run(
+                    [sys.executable, '-c', COMBINE_SCRIPT, which, os.path.join(tmp, 'combined.json'), *paths[:count]],
+                    cwd=here, capture_output=True, text=True, check=True
+                )
+                results[which] = json.loads(result.stdout.strip().splitlines()[-1])
+            line = ", ".join(
+                f"{which} {(r['peak_kb'] - r['baseline_kb']) / 1024:7.1f} MB in {r['seconds']:5.2f} s"
+                for which, r in results.items()
+            )
+            print(f"  {count:3d} files: {line}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the data generation pipeline')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    tokenize_parser = subparsers.add_parser('tokenize', help='Text sampling and token decoding')
+    tokenize_parser.add_argument('--dataset', type=str, default='wikipedia.json', help='Dataset to take texts from')
+    tokenize_parser.add_argument('--article_kb', type=int, default=20, help='Approximate size of each text')
+    tokenize_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs (best is reported)')
+    tokenize_parser.set_defaults(func=bench_tokenize)
+
+    startup_parser = subparsers.add_parser('startup', help='generate.py import time and first-prediction latency')
+    startup_parser.add_argument('--literal_file', type=str, default='math.txt',
+                                help='Literal problem file for the --no-model-completions run')
+    startup_parser.add_argument('--repeat', type=int, default=3, help='Number of runs (median is reported)')
+    startup_parser.set_defaults(func=bench_startup)
+
+    lookahead_parser = subparsers.add_parser('lookahead', help='Whole-sample GPT-2 look-ahead vs. step by step')
+    lookahead_parser.add_argument('--dataset', type=str, default='wikipedia.json', help='Dataset to take texts from')
+    lookahead_parser.add_argument('--article_kb', type=int, default=20, help='Approximate size of each text')
+    lookahead_parser.add_argument('--sample_tokens', type=int, default=2048, help='Longest sample to predict')
+    lookahead_parser.add_argument('--first_step', type=int, default=10, help='Prefix size of the first step, as in app.py')
+    lookahead_parser.add_argument('--steps', type=int, default=50, help='Number of steps to time one by one')
+    lookahead_parser.add_argument('--repeat', type=int, default=1, help='Number of timed runs (best is reported)')
+    lookahead_parser.set_defaults(func=bench_lookahead)
+
+    metrics_parser = subparsers.add_parser('metrics', help='Overhead of metrics.timer(), enabled and disabled')
+    metrics_parser.add_argument('--calls', type=int, default=100000, help='Number of timed blocks per run')
+    metrics_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs (best is reported)')
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    tui_parser = subparsers.add_parser('tui', help='tui.py frame time, with and without render caching')
+    tui_parser.add_argument('--dataset', type=str, default='wikipedia.json', help='Dataset to step through')
+    tui_parser.add_argument('--prefix_kb', type=int, default=4, help='Approximate size of each prefix')
+    tui_parser.add_argument('--keys', type=int, default=400, help='Number of key presses to replay')
+    tui_parser.add_argument('--width', type=int, default=120, help='Terminal width')
+    tui_parser.add_argument('--height', type=int, default=50, help='Terminal height')
+    tui_parser.set_defaults(func=bench_tui)
+
+    combine_parser = subparsers.add_parser('combine', help='combine_json.py peak memory, streaming vs. loading everything')
+    combine_parser.add_argument('--dataset', type=str, default='wikipedia.json', help='Dataset to make the inputs from')
+    combine_parser.add_argument('--file_mb', type=float, default=20, help='Approximate size of each input')
+    combine_parser.add_argument('--files', type=int, nargs='+', default=[2, 4, 8], help='Numbers of inputs to combine')
+    combine_parser.set_defaults(func=bench_combine)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
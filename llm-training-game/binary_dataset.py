@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Compact binary format for prediction datasets, with an index for random access.
+
+The JSON datasets repeat the whole text so far in every step's prefix, so they grow with
+the square of the sample length. In this format each sample stores its strings once and
+refers to them by number: a step's prefix is a range of sample_words, and predictions
+are columns of token numbers and float32 probabilities.
+
+    python binary_dataset.py to-binary wikipedia.json            # writes wikipedia.llmp
+    python binary_dataset.py to-json wikipedia.llmp -o copy.json
+
+Layout (little-endian):
+
+    header   b'LLMPRED\\0', version u32, sample count u32, index offset u64, unused u64
+    samples  one block per sample, decodable on its own
+    index    u64 offset of each block, plus the end of the last one
+
+A sample block is a string table (u32 count, u32 end offsets, UTF-8 bytes) followed by:
+
+    title                   string number
+    sample_words            u32 count, u32 string numbers
+    steps                   u32 count, then one column per field:
+      prefix start, end     i32 each: a range of sample_words, or start -1 and end the
+                            number of a string holding the prefix when it isn't one
+      next_actual_token     u32 string number
+      flags                 u8, bit 0 set if the step has a "predictions" object
+      extra                 i32 number of a JSON string of any other keys, or -1
+    models                  u32 count, u32 string numbers
+    prediction counts       i32 per step per model, -1 if that model isn't in the step
+    predictions             u32 total, u32 token string numbers, f32 probabilities;
+                            {"error": message} entries have a NaN probability and the
+                            message as their token
+    extra                   i32 number of a JSON string of other sample keys, or -1
+
+Probabilities are stored as float32, so converting back to JSON gives the nearest float32
+of each value; everything else round-trips exactly.
+"""
+
+import argparse
+import array
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import dataset_index
+
+MAGIC = b'LLMPRED\0'
+VERSION = 1
+SUFFIX = '.llmp'
+HEADER = struct.Struct('<8sIIQQ')
+
+STEP_KEYS = ('prefix', 'next_actual_token', 'predictions')
+SAMPLE_KEYS = ('article_title', 'sample_words', 'steps')
+
+def little_endian(values):
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+class StringTable:
+    def __init__(self):
+        self.numbers = {}
+        self.strings = []
+
+    def add(self, string):
+        number = self.numbers.get(string)
+        if number is None:
+            number = self.numbers[string] = len(self.strings)
+            self.strings.append(string)
+        return number
+
+    def encode(self):
+        blobs = [string.encode('utf-8') for string in self.strings]
+        ends = array.array('I')
+        end = 0
+        for blob in blobs:
+            end += len(blob)
+            ends.append(end)
+        return struct.pack('<I', len(blobs)) + little_endian(ends) + b''.join(blobs)
+
+def columnar_predictions(predictions):
+    """Whether every entry is {"token", "probability"} or {"error"}, so it fits the prediction columns"""
+    return isinstance(predictions, dict) and all(
+        isinstance(entries, list) and all(
+            isinstance(entry, dict) and (
+                (entry.keys() == {'token', 'probability'} and isinstance(entry['token'], str)
+                 and isinstance(entry['probability'], (int, float)) and not math.isnan(entry['probability']))
+                or (entry.keys() == {'error'} and isinstance(entry['error'], str))
+            ) for entry in entries
+        ) for entries in predictions.values()
+    )
+
+def prefix_range(prefix, text, boundaries):
+    """(start, end) word indices with ''.join(words[start:end]) == prefix, or None.
+
+    boundaries[i] is the character offset where word i starts in text.
+    """
+    position = text.find(prefix)
+    while position != -1:
+        start = bisect.bisect_left(boundaries, position)
+        if start < len(boundaries) and boundaries[start] == position:
+            end = bisect.bisect_left(boundaries, position + len(prefix))
+            if end < len(boundaries) and boundaries[end] == position + len(prefix):
+                return start, end
+        position = text.find(prefix, position + 1)
+    return None
+
+def encode_sample(sample):
+    strings = StringTable()
+    words = sample['sample_words']
+    steps = sample['steps']
+
+    boundaries = [0]
+    for word in words:
+        boundaries.append(boundaries[-1] + len(word))
+    text = ''.join(words)
+
+    models = []
+    for step in steps:
+        predictions = step.get('predictions')
+        if columnar_predictions(predictions):
+            models += [model for model in predictions if model not in models]
+
+    prefix_starts = array.array('i')
+    prefix_ends = array.array('i')
+    actual = array.array('I')
+    flags = array.array('B')
+    extras = array.array('i')
+    counts = array.array('i')
+    tokens = array.array('I')
+    probabilities = array.array('f')
+
+    for step in steps:
+        span = prefix_range(step['prefix'], text, boundaries)
+        if span is None:
+            prefix_starts.append(-1)
+            prefix_ends.append(strings.add(step['prefix']))
+        else:
+            prefix_starts.append(span[0])
+            prefix_ends.append(span[1])
+        actual.append(strings.add(step['next_actual_token']))
+
+        extra = {key: value for key, value in step.items() if key not in STEP_KEYS}
+        predictions = step.get('predictions')
+        if predictions is not None and not columnar_predictions(predictions):
+            extra['predictions'] = predictions
+            predictions = None
+        flags.append(predictions is not None)
+        extras.append(strings.add(json.dumps(extra)) if extra else -1)
+
+        for model in models:
+            entries = predictions.get(model) if predictions is not None else None
+            if entries is None:
+                counts.append(-1)
+                continue
+            counts.append(len(entries))
+            for entry in entries:
+                if 'error' in entry:
+                    tokens.append(strings.add(entry['error']))
+                    probabilities.append(math.nan)
+                else:
+                    tokens.append(strings.add(entry['token']))
+                    probabilities.append(entry['probability'])
+
+    title = strings.add(sample['article_title'])
+    word_numbers = array.array('I', (strings.add(word) for word in words))
+    model_numbers = array.array('I', (strings.add(model) for model in models))
+    extra = {key: value for key, value in sample.items() if key not in SAMPLE_KEYS}
+    sample_extra = strings.add(json.dumps(extra)) if extra else -1
+
+    return b''.join([
+        strings.encode(),
+        struct.pack('<II', title, len(word_numbers)), little_endian(word_numbers),
+        struct.pack('<I', len(steps)),
+        little_endian(prefix_starts), little_endian(prefix_ends), little_endian(actual),
+        flags.tobytes(), little_endian(extras),
+        struct.pack('<I', len(model_numbers)), little_endian(model_numbers),
+        little_endian(counts),
+        struct.pack('<I', len(tokens)), little_endian(tokens), little_endian(probabilities),
+        struct.pack('<i', sample_extra),
+    ])
+
+class BlockReader:
+    def __init__(self, block):
+        self.block = block
+        self.position = 0
+
+    def read(self, size):
+        data = self.block[self.position:self.position + size]
+        self.position += size
+        return data
+
+    def u32(self):
+        return struct.unpack('<I', self.read(4))[0]
+
+    def i32(self):
+        return struct.unpack('<i', self.read(4))[0]
+
+    def column(self, typecode, count):
+        values = array.array(typecode)
+        values.frombytes(self.read(values.itemsize * count))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def strings(self):
+        count = self.u32()
+        ends = self.column('I', count)
+        blob = bytes(self.read(ends[-1] if count else 0))
+        strings = []
+        start = 0
+        for end in ends:
+            strings.append(blob[start:end].decode('utf-8'))
+            start = end
+        return strings
+
+def decode_sample(block):
+    """The sample encoded in block, in the same shape as in the JSON datasets"""
+    reader = BlockReader(block)
+    strings = reader.strings()
+    title = strings[reader.u32()]
+    words = [strings[number] for number in reader.column('I', reader.u32())]
+    num_steps = reader.u32()
+    prefix_starts = reader.column('i', num_steps)
+    prefix_ends = reader.column('i', num_steps)
+    actual = reader.column('I', num_steps)
+    flags = reader.column('B', num_steps)
+    extras = reader.column('i', num_steps)
+    models = [strings[number] for number in reader.column('I', reader.u32())]
+    counts = reader.column('i', num_steps * len(models))
+    num_predictions = reader.u32()
+    tokens = reader.column('I', num_predictions)
+    probabilities = reader.column('f', num_predictions)
+    sample_extra = reader.i32()
+
+    text = ''.join(words)
+    boundaries = [0]
+    for word in words:
+        boundaries.append(boundaries[-1] + len(word))
+
+    steps = []
+    entry = 0
+    for i in range(num_steps):
+        if prefix_starts[i] == -1:
+            prefix = strings[prefix_ends[i]]
+        else:
+            prefix = text[boundaries[prefix_starts[i]]:boundaries[prefix_ends[i]]]
+        step = {'prefix': prefix, 'next_actual_token': strings[actual[i]]}
+
+        predictions = {}
+        for m, model in enumerate(models):
+            count = counts[i * len(models) + m]
+            if count == -1:
+                continue
+            entries = []
+            for token, probability in zip(tokens[entry:entry + count], probabilities[entry:entry + count]):
+                if math.isnan(probability):
+                    entries.append({'error': strings[token]})
+                else:
+                    entries.append({'token': strings[token], 'probability': probability})
+            predictions[model] = entries
+            entry += count
+        if flags[i] & 1:
+            step['predictions'] = predictions
+        if extras[i] != -1:
+            step.update(json.loads(strings[extras[i]]))
+        steps.append(step)
+
+    sample = {'article_title': title, 'sample_words': words, 'steps': steps}
+    if sample_extra != -1:
+        sample.update(json.loads(strings[sample_extra]))
+    return sample
+
+def write_binary(samples, output_path):
+    """Write an iterable of samples to output_path; returns the number written"""
+    offsets = array.array('Q')
+    with open(output_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+        for sample in samples:
+            offsets.append(f.tell())
+            f.write(encode_sample(sample))
+        offsets.append(f.tell())
+        f.write(little_endian(offsets))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(offsets) - 1, offsets[-1], 0))
+    return len(offsets) - 1
+
+class BinaryDataset:
+    """A binary dataset file, read a sample at a time: supports len(), indexing and iteration"""
+
+    def __init__(self, path, cache_size=32):
+        self.path = path
+        self.cache = dataset_index.SampleCache(cache_size)
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index_offset, _ = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary dataset")
+        if version != VERSION:
+            raise ValueError(f"{path} has format version {version}, expected {VERSION}")
+        self.offsets = BlockReader(self.map[index_offset:index_offset + 8 * (count + 1)]).column('Q', count + 1)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.cache.get(index, lambda index: decode_sample(self.map[self.offsets[index]:self.offsets[index + 1]]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def close(self):
+        self.map.close()
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def open_dataset(path, cache_size=32):
+    """A dataset as a sequence of samples read on demand: a BinaryDataset, or a JSONDataset"""
+    if is_binary(path):
+        return BinaryDataset(path, cache_size)
+    return dataset_index.JSONDataset(path, cache_size)
+
+def write_json(samples, output_path):
+    """Write samples as a JSON array, laid out like json.dump(samples, f, indent=2)"""
+    with open(output_path, 'w', encoding='utf-8') as out:
+        array = dataset_index.ArrayWriter(out)
+        for sample in samples:
+            array.write(sample)
+        array.finish()
+    return array.count
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert prediction datasets between JSON and the binary format')
+    parser.add_argument('direction', choices=['to-binary', 'to-json'])
+    parser.add_argument('input', type=str, help='Dataset to convert')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help=f'Output file (default: the input with a {SUFFIX} or .json extension)')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.input)[0] + (SUFFIX if args.direction == 'to-binary' else '.json')
+    if os.path.abspath(output) == os.path.abspath(args.input):
+        parser.error("the output would overwrite the input; pass -o")
+
+    samples = open_dataset(args.input)
+    count = write_binary(samples, output) if args.direction == 'to-binary' else write_json(samples, output)
+    print(f"Wrote {count} samples to {output}: {os.path.getsize(args.input):,} -> {os.path.getsize(output):,} bytes")
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,129 @@
 #!/usr/bin/env python
+"""
+Combine prediction datasets into one, streaming so memory use stays flat however big they are.
+
+    python combine_json.py combined.json wikipedia.json math-full.json
+    python combine_json.py combined.jsonl runs/*.json --shard_mb 100    # combined-00000.jsonl, ...
+
+Inputs can be JSON arrays, JSONL (one sample per line) or binary datasets (.llmp); the
+output is JSONL if its name ends in .jsonl and a JSON array otherwise. Each input is read
+a sample at a time and each sample written out as soon as it's read.
+
+Samples with the same article_title and sample_words as an earlier one are dropped
+(--no-dedup keeps them). Only a 16-byte hash of each sample seen is kept for this.
+"""
+
+import argparse
+import hashlib
 import json
-import sys
-
-def combine_json_files(input_files, output_file):
-    """Combine JSON array files into a single JSON array file."""
-    combined_data = []
-    
-    for file_path in input_files:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-            if isinstance(data, list):
-                combined_data.extend(data)
-            else:
-                print(f"Warning: {file_path} does not contain a JSON array")
-    
-    with open(output_file, 'w') as f:
-        json.dump(combined_data, f, indent=2)
-    
-    print(f"Combined {len(input_files)} files into {output_file}")
+import os
+import binary_dataset
+import dataset_index
+
+def read_samples(path):
+    """Yield the samples in a JSON array, JSONL or binary dataset file"""
+    if path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif binary_dataset.is_binary(path):
+        yield from binary_dataset.BinaryDataset(path, cache_size=0)
+    else:
+        for _, _, sample in dataset_index.iter_array(path):
+            yield sample
+
+def sample_hash(sample):
+    """Hash of what makes a sample a duplicate: its article title and text"""
+    key = json.dumps([sample.get('article_title'), sample.get('sample_words')], ensure_ascii=False)
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+class ShardedWriter:
+    """Writes samples to output_file, or to numbered shards of about shard_bytes each"""
+
+    def __init__(self, output_file, shard_bytes=None):
+        self.output_file = output_file
+        self.shard_bytes = shard_bytes
+        self.jsonl = output_file.endswith('.jsonl')
+        self.paths = []
+        self.file = None
+        self.array = None
+
+    def open_shard(self):
+        if self.shard_bytes is None:
+            path = self.output_file
+        else:
+            stem, extension = os.path.splitext(self.output_file)
+            path = f"{stem}-{len(self.paths):05d}{extension}"
+        self.paths.append(path)
+        self.file = open(path, 'w', encoding='utf-8')
+        self.array = None if self.jsonl else dataset_index.ArrayWriter(self.file)
+        self.size = 0 if self.jsonl else 1
+
+    def close_shard(self):
+        if self.array is not None:
+            self.array.finish()
+        self.file.close()
+        self.file = None
+
+    def write(self, sample):
+        if self.file is not None and self.shard_bytes is not None and self.size >= self.shard_bytes:
+            self.close_shard()
+        if self.file is None:
+            self.open_shard()
+
+        if self.jsonl:
+            text = json.dumps(sample) + '\n'
+            self.file.write(text)
+        else:
+            text = self.array.write(sample)
+        self.size += len(text.encode('utf-8'))
+
+    def close(self):
+        if self.file is None:
+            self.open_shard()  # No samples: still write an empty output
+        self.close_shard()
+
+def combine_json_files(input_files, output_file, dedup=True, shard_bytes=None):
+    """Combine dataset files into one (or into shards), dropping duplicate samples if dedup.
+
+    Returns (samples written, duplicates dropped, output paths).
+    """
+    seen = set()
+    written = duplicates = 0
+    writer = ShardedWriter(output_file, shard_bytes)
+    try:
+        for file_path in input_files:
+            try:
+                for sample in read_samples(file_path):
+                    if dedup:
+                        digest = sample_hash(sample)
+                        if digest in seen:
+                            duplicates += 1
+                            continue
+                        seen.add(digest)
+                    writer.write(sample)
+                    written += 1
+            except ValueError as e:
+                print(f"Warning: skipping the rest of {file_path}: {e}")
+    finally:
+        writer.close()
+
+    print(f"Combined {len(input_files)} files into {', '.join(writer.paths)}: "
+          f"{written} samples, {duplicates} duplicates dropped")
+    return written, duplicates, writer.paths
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python combine_json.py output_file.json input1.json input2.json [input3.json ...]")
-        sys.exit(1)
-    
-    output_file = sys.argv[1]
-    input_files = sys.argv[2:]
-    
-    combine_json_files(input_files, output_file)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Combine prediction datasets (JSON, JSONL or binary) into one')
+    parser.add_argument('output_file', type=str, help='Output file (.jsonl for JSONL, otherwise a JSON array)')
+    parser.add_argument('input_files', type=str, nargs='+', help='Datasets to combine')
+    parser.add_argument('--no-dedup', action='store_true', help='Keep samples with the same title and text as an earlier one')
+    parser.add_argument('--shard_mb', type=float, default=None,
+                        help='Split the output into numbered files of about this many MB')
+    args = parser.parse_args()
+
+    if os.path.abspath(args.output_file) in map(os.path.abspath, args.input_files):
+        parser.error("the output file is also an input")
+
+    shard_bytes = int(args.shard_mb * 1024 * 1024) if args.shard_mb else None
+    combine_json_files(args.input_files, args.output_file, dedup=not args.no_dedup, shard_bytes=shard_bytes)
@@ -0,0 +1,236 @@
+"""
+Sample-level offset index for JSON datasets, so a sample can be read without parsing the rest.
+
+    dataset = JSONDataset('wikipedia.json')
+    len(dataset), dataset[3]
+
+The first time a file is opened, one streaming pass of the JSON decoder over its top-level
+array records the byte range of every sample, and the ranges are saved beside the file as
+`<file>.idx`. Later opens map that file instead, which takes the same time however big the
+dataset is; the index is rebuilt if the dataset's size or modification time changes.
+
+Samples are parsed when they're asked for, and the most recently used ones are kept.
+iter_array and ArrayWriter read and write JSON arrays an element at a time.
+"""
+
+import array
+import codecs
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'LLMPIDX\0'
+INDEX_HEADER = struct.Struct('<8sQQQ')  # magic, dataset size, dataset mtime_ns, sample count
+CHUNK_SIZE = 1 << 20
+WHITESPACE = ' \t\r\n'
+
+def iter_array(path, chunk_size=CHUNK_SIZE):
+    """Yield (start byte, end byte, value) for each element of the JSON array in path.
+
+    Reads the file a chunk at a time, so memory use is bounded by the largest sample.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    with open(path, 'rb') as f:
+        text = ''
+        eof = False
+        text_bytes = 0      # byte offset of text[0] in the file
+        counted_chars = 0   # text[:counted_chars] is counted_bytes bytes long
+        counted_bytes = 0
+
+        def read_more(size=chunk_size):
+            nonlocal text, eof
+            chunk = f.read(size)
+            eof = not chunk
+            text += utf8.decode(chunk, final=eof)
+
+        def byte_offset(char_index):
+            nonlocal counted_chars, counted_bytes
+            counted_bytes += len(text[counted_chars:char_index].encode('utf-8'))
+            counted_chars = char_index
+            return text_bytes + counted_bytes
+
+        def next_char(position):
+            """Position of the next non-whitespace character, reading more of the file as needed"""
+            while True:
+                while position < len(text) and text[position] in WHITESPACE:
+                    position += 1
+                if position < len(text) or eof:
+                    return position
+                read_more()
+
+        position = next_char(0)
+        if text[position:position + 1] != '[':
+            raise ValueError(f"{path} is not a JSON array")
+        position = next_char(position + 1)
+        if text[position:position + 1] == ']':
+            return
+
+        while True:
+            # Decode one element; if it runs off the end of what's been read, read more and retry
+            # (at least doubling what's read, so a huge sample isn't decoded over and over)
+            while True:
+                try:
+                    value, end = decoder.raw_decode(text, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise ValueError(f"{path}: invalid JSON at byte {byte_offset(position)}")
+                    read_more(max(chunk_size, len(text) - position))
+                    continue
+                if end < len(text) or eof:
+                    break
+                read_more()  # A number at the very end of the text may continue in the next chunk
+            yield byte_offset(position), byte_offset(end), value
+
+            position = next_char(end)
+            if text[position:position + 1] == ']':
+                return
+            if text[position:position + 1] != ',':
+                raise ValueError(f"{path}: expected ',' or ']' at byte {byte_offset(position)}")
+            position = next_char(position + 1)
+
+            # Drop text that's been dealt with
+            if position > chunk_size:
+                byte_offset(position)
+                text = text[position:]
+                text_bytes += counted_bytes
+                counted_chars = counted_bytes = 0
+                position = 0
+
+def scan_offsets(path, chunk_size=CHUNK_SIZE):
+    """[start0, end0, start1, end1, ...] byte offsets of the elements of the JSON array in path"""
+    offsets = array.array('Q')
+    for start, end, _ in iter_array(path, chunk_size):
+        offsets.append(start)
+        offsets.append(end)
+    return offsets
+
+class ArrayWriter:
+    """Writes values to a text file one at a time as a JSON array, laid out like json.dump(values, f, indent=2)"""
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+        file.write('[')
+
+    def write(self, value):
+        """Write one element, returning the text written"""
+        text = (',\n' if self.count else '\n') + '\n'.join(
+            '  ' + line for line in json.dumps(value, indent=2).split('\n')
+        )
+        self.file.write(text)
+        self.count += 1
+        return text
+
+    def finish(self):
+        """Close the array (the file itself is left open)"""
+        self.file.write('\n]' if self.count else ']')
+
+def write_index(index_path, stat, offsets):
+    if sys.byteorder == 'big':
+        offsets = array.array('Q', offsets)
+        offsets.byteswap()
+    temporary_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(offsets) // 2))
+        f.write(offsets.tobytes())
+    os.replace(temporary_path, index_path)
+
+def read_index(index_path, stat):
+    """The offsets saved in index_path, or None if it's missing or for another version of the dataset"""
+    try:
+        with open(index_path, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                return None
+            magic, size, mtime_ns, count = INDEX_HEADER.unpack(header)
+            if (magic, size, mtime_ns) != (INDEX_MAGIC, stat.st_size, stat.st_mtime_ns):
+                return None
+            if os.fstat(f.fileno()).st_size != INDEX_HEADER.size + 16 * count:
+                return None
+            if count == 0:
+                return array.array('Q')
+            index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+
+    if sys.byteorder == 'big':
+        offsets = array.array('Q', index_map[INDEX_HEADER.size:])
+        offsets.byteswap()
+        return offsets
+    return memoryview(index_map)[INDEX_HEADER.size:].cast('Q')
+
+def load_offsets(path):
+    """The byte offsets of path's samples (as in scan_offsets), from its saved index if it's current"""
+    stat = os.stat(path)
+    index_path = path + INDEX_SUFFIX
+    offsets = read_index(index_path, stat)
+    if offsets is None:
+        offsets = scan_offsets(path)
+        try:
+            write_index(index_path, stat, offsets)
+        except OSError as e:
+            print(f"Couldn't save the index for {path}: {e}")
+    return offsets
+
+class SampleCache:
+    """The most recently used `size` samples of a dataset, by index"""
+
+    def __init__(self, size):
+        self.size = size
+        self.samples = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, index, load):
+        """Sample `index`, calling load(index) if it isn't cached"""
+        with self.lock:
+            if index in self.samples:
+                self.samples.move_to_end(index)
+                return self.samples[index]
+        sample = load(index)
+        with self.lock:
+            self.samples[index] = sample
+            if len(self.samples) > self.size:
+                self.samples.popitem(last=False)
+        return sample
+
+class JSONDataset:
+    """A JSON array of samples, read a sample at a time: supports len(), indexing and iteration"""
+
+    def __init__(self, path, cache_size=32):
+        self.path = path
+        self.offsets = load_offsets(path)
+        self.cache = SampleCache(cache_size)
+        self.lock = threading.Lock()
+        self.file = open(path, 'rb')
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def read_raw(self, index):
+        """The JSON text of sample `index`, as bytes"""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = self.offsets[2 * index], self.offsets[2 * index + 1]
+        with self.lock:
+            self.file.seek(start)
+            return self.file.read(end - start)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return self.cache.get(index, lambda index: json.loads(self.read_raw(index)))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def close(self):
+        self.file.close()
@@ -1,133 +1,142 @@
-import requests
-from bs4 import BeautifulSoup
-import random
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import ctransformers
-import torch.nn.functional as F
-import torch
-import tiktoken
+import tokenization
+from tokenization import get_random_text_sample
+import math
 import os
-import openai
-import json
 import time
+import concurrent.futures
 from tqdm import tqdm
 import argparse
 import sys
+import model_backends
+import prediction_cache as prediction_cache_module
+import jsonl_output
+import wiki_corpus
+import metrics
 
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
-
-# Initialize Hyperbolic client
-def get_hyperbolic_client():
-    return openai.OpenAI(
-        api_key=os.getenv('HYPERBOLIC_API_KEY'),
-        base_url="https://api.hyperbolic.xyz/v1",
-    )
-
-hyperbolic_client = get_hyperbolic_client()
-
-gpt2_model = AutoModelForCausalLM.from_pretrained('gpt2')
-gpt2_tokenizer = AutoTokenizer.from_pretrained('gpt2')
-
-# llama2_model = ctransformers.AutoModelForCausalLM.from_pretrained('TheBloke/Llama-2-70B-GGUF', model_file='llama-2-70b.Q5_K_M.gguf', model_type='llama')
-# llama2_tokenizer = ctransformers.AutoTokenizer.from_pretrained('TheBloke/Llama-2-70B-GGUF', model_file='llama-2-70b.Q5_K_M.gguf')
-
-def get_random_wikipedia_article():
-    """Fetch a random Wikipedia article"""
-    url = "https://en.wikipedia.org/wiki/Special:Random"
-
-    # Send request and get response
-    response = requests.get(url)
+# torch, transformers, openai and ctransformers take seconds to import, so model_backends
+# only imports them (and loads models) the first time a prediction actually needs them.
 
-    # Parse HTML content
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    # Get article title
-    title = soup.find(id="firstHeading").text
-
-    # Get main content (excluding references, navigation, etc.)
-    content = soup.find(id="mw-content-text")
-
-    # Remove unwanted elements
-    for unwanted in content.find_all(['table', 'sup', 'div.thumb', 'span.mw-editsection']):
-        unwanted.decompose()
-
-    # Extract text
-    text = content.get_text().strip()
-
-    return {
-        'title': title,
-        'text': text
-    }
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-def get_random_text_sample(text, minimum_sample_length=20):
-    """Extract a random sample from text using GPT-2 tokenization"""
-    enc = tiktoken.get_encoding("gpt2")
-    tokens = enc.encode(text)
-    words = [enc.decode([token]) for token in tokens]
-
-    if len(words) > minimum_sample_length:
-        max_start_index = len(words) - minimum_sample_length
-        start_index = random.randint(0, max_start_index)
-    else:
-        start_index = 0
-
-    return words[start_index:]
-
-def get_hf_predictions(prefix, top_k=5, name=None, model=None, tokenizer=None):
-    """Get top-k predictions from GPT-2"""
-    print(f"Getting {name} predictions for prefix: {prefix}")
-    inputs = tokenizer(prefix, return_tensors='pt')
-    with torch.no_grad():
-        outputs = model(**inputs)
-        logits = outputs.logits[0, -1, :]
-    probs = F.softmax(logits, dim=-1)
-    top_probs, top_indices = torch.topk(probs, top_k)
-
-    predictions = []
-    for prob, idx in zip(top_probs, top_indices):
-        token = tokenizer.decode(idx)
-        predictions.append({"token": token, "probability": prob.item()})
-
-    return predictions
+# Set up in main() unless --no-cache is given
+prediction_cache = None
+
+# The model backends predictions come from; set up in main() from --backends
+backends = None
+
+def get_backends():
+    global backends
+    if backends is None:
+        backends = model_backends.make_backends(model_backends.DEFAULT_BACKENDS)
+    return backends
+
+def cached_predictions(model_id, top_k, prefix_groups, compute):
+    """Get predictions for groups of prefixes, consulting the prediction cache if enabled.
+
+    compute gets the groups with cached prefixes removed and returns predictions in the same shape.
+    """
+    if prediction_cache is None:
+        return compute(prefix_groups)
+    return prediction_cache.lookup(model_id, top_k, prefix_groups, compute)
+
+def get_backend_predictions(backend, prefixes, top_k=5):
+    """Get top-k predictions from one backend for a list of prefixes"""
+    if not prefixes:
+        return []
+
+    def compute(prefix_groups):
+        return [backend.predict_topk(prefix_groups[0], top_k)]
+    return cached_predictions(backend.cache_id, top_k, [prefixes], compute)[0]
+
+def get_backend_chain_predictions(backend, prefixes, top_k=5):
+    """Get top-k predictions for prefixes that each extend the previous one, reusing the KV cache"""
+    def compute(prefix_groups):
+        print(f"Getting {backend.name} predictions for {len(prefix_groups[0])} growing prefixes of: {prefixes[0]}")
+        return [backend.predict_chain(prefix_groups[0], top_k)]
+    return cached_predictions(backend.cache_id, top_k, [prefixes], compute)[0]
+
+# Backends asked for by name that get_backends() doesn't include, built once each
+other_backends = {}
+
+def get_backend(name):
+    """The backend called name, from get_backends() if it's one of them"""
+    for backend in get_backends():
+        if backend.name == name:
+            return backend
+    if name not in other_backends:
+        other_backends[name] = model_backends.make_backends([name])[0]
+    return other_backends[name]
 
 def get_gpt2_predictions(prefix, top_k=5):
-    return get_hf_predictions(prefix, top_k, 'gpt2', gpt2_model, gpt2_tokenizer)
-
-# def get_llama2_predictions(prefix, top_k=5):
-#     return get_hf_predictions(prefix, top_k, 'llama2', llama2_model, llama2_tokenizer)
+    return get_backend_predictions(get_backend('gpt2'), [prefix], top_k)[0]
 
 def get_llama3_predictions(prefix, top_k=5):
-    """Get top-k predictions from Llama 3.1"""
-    print(f"Getting Llama 3.1 predictions for prefix: {prefix}")
-    try:
-        chat_completion = hyperbolic_client.completions.create(
-            model="meta-llama/Meta-Llama-3.1-405B-FP8",
-            prompt=prefix,
-            temperature=0,
-            top_p=1,
-            max_tokens=1,
-            logprobs=5,
+    return get_backend_predictions(get_backend('llama3'), [prefix], top_k)[0]
+
+def predict_backend_groups(backend, prefix_groups, incremental=False):
+    """Get one backend's predictions for groups of prefixes, in the same shape"""
+    if incremental and hasattr(backend, 'predict_chain'):
+        return [get_backend_chain_predictions(backend, group) if group else [] for group in prefix_groups]
+
+    predictions = iter(get_backend_predictions(backend, [prefix for group in prefix_groups for prefix in group]))
+    return [[next(predictions) for _ in group] for group in prefix_groups]
+
+# Runs the backends' model calls side by side; a call that times out keeps its thread
+# until it finishes, so this isn't shut down between chunks
+backend_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+def predict_steps(local_prefix_groups, remote_prefix_groups, model_completions=True, incremental=False):
+    """Get {backend name: predictions} for groups of steps, or None per step when model_completions is off.
+
+    Local backends see local_prefix_groups and remote ones remote_prefix_groups. The
+    backends run at the same time, each getting all the groups' prefixes in one
+    predict_topk call. incremental decodes each group with the KV cache instead (for
+    backends that can), for groups where each prefix extends the previous one by a
+    token or so.
+
+    A backend that fails, or takes longer than its timeout for each call it needs,
+    gets an error entry for every step instead, without holding up the others.
+    """
+    if not model_completions:
+        return [[None] * len(group) for group in local_prefix_groups]
+
+    num_prefixes = sum(len(group) for group in local_prefix_groups)
+    started = time.monotonic()
+    futures = {
+        backend.name: backend_executor.submit(
+            predict_backend_groups, backend, remote_prefix_groups if backend.remote else local_prefix_groups, incremental
         )
+        for backend in get_backends()
+    }
+    # Timeouts are per call, and a backend needs one call per max_batch prefixes
+    timeouts = {
+        backend.name: backend.timeout * max(1, math.ceil(num_prefixes / backend.max_batch))
+        for backend in get_backends()
+    }
+    by_backend = model_backends.collect_predictions(get_backends(), futures, started, timeouts=timeouts)
 
-        logprobs = chat_completion.choices[0].logprobs.top_logprobs[0]
+    for name, future in futures.items():
+        if not future.done() or future.exception() is not None:
+            error = by_backend[name]
+            print(f"{name} predictions failed: {error[0]['error']}")
+            by_backend[name] = [[error] * len(group) for group in local_prefix_groups]
 
-        # Sort by logprob values (highest first)
-        sorted_logprobs = sorted(logprobs.items(), key=lambda x: x[1], reverse=True)
+    return [
+        [{name: by_backend[name][g][s] for name in by_backend} for s in range(len(group))]
+        for g, group in enumerate(local_prefix_groups)
+    ]
 
-        predictions = []
-        for token, logprob in sorted_logprobs[:top_k]:
-            if logprob > -9999:  # Skip the placeholder values
-                prob = torch.exp(torch.tensor(logprob)).item()
-                predictions.append({"token": token, "probability": prob})
+def process_literal_file(file_path, single_token=False, model_completions=True, writer=None, chunk_size=8):
+    """Process a literal file where each line has format 'prefix|answer', streaming results to writer.
 
-        return predictions
-    except Exception as e:
-        return [{"error": str(e)}]
+    Without a writer, the samples are collected in memory and returned instead.
+    """
+    if writer is None:
+        writer = jsonl_output.MemoryWriter()
+        process_literal_file(file_path, single_token, model_completions, writer, chunk_size)
+        return writer.dataset()
 
-def process_literal_file(file_path, single_token=False, model_completions=True):
-    """Process a literal file where each line has format 'prefix|answer'"""
     print(f"Processing literal file: {file_path}")
-    samples = []
 
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -136,7 +145,7 @@ def process_literal_file(file_path, single_token=False, model_completions=True):
         # First, validate the entire file
         print("Validating file format and token counts...")
         valid_problems = []
-        enc = tiktoken.get_encoding("gpt2")
+        enc = tokenization.get_encoding("gpt2")
 
         for i, line in enumerate(lines):
             line = line.strip()
@@ -166,77 +175,68 @@ def process_literal_file(file_path, single_token=False, model_completions=True):
 
         print(f"Validation complete. Found {len(valid_problems)} valid problems.")
 
-        # Now generate predictions for each valid problem
-        for i, (prefix, answer) in enumerate(valid_problems):
-            print(f"Processing problem {i+1}/{len(valid_problems)}: {prefix}")
-
-            # Create a sample with steps
-            sample = {
-                "article_title": f"Problem {i+1}",
-                "sample_words": [prefix, answer],  # Just for reference
-                "steps": []
-            }
-
-            if single_token:
-                # Single token mode - just create one step with the entire answer
-                step = {
-                    "prefix": prefix  + " ",
-                    "next_actual_token": answer,
-                }
-
-                # Add model predictions if requested
-                if model_completions:
-                    step["predictions"] = {
-                        "gpt2": get_gpt2_predictions(prefix),
-                        "llama3": get_llama3_predictions(prefix + " ")
-                    }
-
-                sample["steps"].append(step)
-            else:
-                # Multi-token mode - tokenize the answer and create a step for each token
-                answer_tokens = enc.encode(answer)
-                current_prefix = prefix
-
-                for j, token_id in enumerate(answer_tokens):
-                    # Decode the current token
-                    token_text = enc.decode([token_id])
-
-                    print(f"  Step {j+1}/{len(answer_tokens)}: prefix='{current_prefix}', next_token='{token_text}'")
+        for chunk_start in range(0, len(valid_problems), chunk_size):
+            # Lay out this chunk's steps first, so each backend can score them all at once
+            chunk = []
+            for i in range(chunk_start, min(chunk_start + chunk_size, len(valid_problems))):
+                prefix, answer = valid_problems[i]
+                if i not in writer.samples:
+                    writer.write_sample(i, f"Problem {i+1}", [prefix, answer])  # Just for reference
+
+                # Each step is (prefix, next_actual_token, prefix local models see)
+                if single_token:
+                    # Single token mode - just create one step with the entire answer
+                    steps = [(prefix + " ", answer, prefix)]
+                else:
+                    # Multi-token mode - tokenize the answer and create a step for each token
+                    steps = []
+                    current_prefix = prefix
+                    for token_text in tokenization.decode_tokens(enc.encode(answer)):
+                        steps.append((current_prefix, token_text, current_prefix))
+
+                        # Update the prefix for the next token
+                        current_prefix += token_text
+
+                pending = [j for j in range(len(steps)) if (i, j) not in writer.done_steps]
+                chunk.append((i, steps, pending))
+
+            # In multi-token mode each answer token extends the previous step's prefix, so decode incrementally
+            predictions = predict_steps(
+                [[steps[j][2] for j in pending] for _, steps, pending in chunk],
+                [[steps[j][0] for j in pending] for _, steps, pending in chunk],
+                model_completions, not single_token
+            )
+
+            # Now attach the model predictions to each problem
+            for (i, steps, pending), problem_predictions in zip(chunk, predictions):
+                print(f"Processing problem {i+1}/{len(valid_problems)}: {valid_problems[i][0]}")
+
+                for j, step_predictions in zip(pending, problem_predictions):
+                    step_prefix, token_text, _ = steps[j]
+                    if not single_token:
+                        print(f"  Step {j+1}/{len(steps)}: prefix='{step_prefix}', next_token='{token_text}'")
 
-                    # Create a step for this token
                     step = {
-                        "prefix": current_prefix,
+                        "prefix": step_prefix,
                         "next_actual_token": token_text,
                     }
 
                     # Add model predictions if requested
                     if model_completions:
-                        step["predictions"] = {
-                            "gpt2": get_gpt2_predictions(current_prefix),
-                            "llama3": get_llama3_predictions(current_prefix)
-                        }
+                        step["predictions"] = step_predictions
 
-                    sample["steps"].append(step)
+                    writer.write_step(i, j, step)
 
-                    # Update the prefix for the next token
-                    current_prefix += token_text
-
-                    # Small delay to avoid rate limiting if getting predictions
-                    if model_completions:
-                        time.sleep(1)
-
-            samples.append(sample)
-
-            # Small delay to avoid rate limiting
-            time.sleep(1)
-
-        return samples
+            writer.checkpoint()
     except Exception as e:
         print(f"Error processing literal file: {e}")
         sys.exit(1)
 
-def generate_step_data(words, prefix_size, model_completions=True):
-    """Generate prediction data for a single step"""
+def generate_step_data(words, prefix_size, model_completions=True, predictions=None):
+    """Generate prediction data for a single step
+
+    predictions is the step's {backend name: predictions}, from predict_steps.
+    """
     prefix = ''.join(words[:prefix_size])
 
     result = {
@@ -246,11 +246,7 @@ def generate_step_data(words, prefix_size, model_completions=True):
 
     # Add model predictions if requested
     if model_completions:
-        result["predictions"] = {
-            "gpt2": get_gpt2_predictions(prefix),
-            "llama3": get_llama3_predictions(prefix),
-            # "llama2": get_llama2_predictions(prefix)
-        }
+        result["predictions"] = predictions
 
     return result
 
@@ -268,58 +264,93 @@ def get_text_from_file(file_path):
         print(f"Error reading file: {e}")
         sys.exit(1)
 
-def generate_sample_data(num_samples=10, steps_per_sample=10, min_sample_length=40, file_path=None, mode=None, single_token=False, model_completions=True):
-    """Generate data for multiple samples with multiple steps each"""
+def generate_sample_data(num_samples=10, steps_per_sample=10, min_sample_length=40, file_path=None, mode=None, single_token=False, model_completions=True, writer=None, chunk_size=8, num_fetchers=4, corpus=None, offline=False):
+    """Generate data for multiple samples with multiple steps each, streaming them to writer.
+
+    Samples are processed chunk_size at a time: enough to batch model work, without
+    holding the whole dataset in memory. Samples and steps the writer already has (from
+    a resumed run) are not generated again.
+
+    Wikipedia articles are fetched by num_fetchers background threads while the models
+    run, and saved to corpus if given. With offline, articles are drawn from corpus instead.
+
+    Without a writer, the samples are collected in memory and returned instead.
+    """
+    if writer is None:
+        writer = jsonl_output.MemoryWriter()
+        generate_sample_data(num_samples, steps_per_sample, min_sample_length, file_path, mode, single_token,
+                             model_completions, writer, chunk_size, num_fetchers, corpus, offline)
+        return writer.dataset()
 
     # Special handling for literal mode
     if mode == 'literal' and file_path:
-        return process_literal_file(file_path, single_token, model_completions)
-
-    all_samples = []
-
-    for i in tqdm(range(num_samples), desc="Generating samples"):
-        # Get text either from file or Wikipedia
-        if file_path:
-            # For file input, we only get the text once and create multiple samples from it
-            if i == 0:
-                article = get_text_from_file(file_path)
-                full_text = article['text']
-
-            # For each sample, get a different portion of the text
-            article_text = full_text
-            article = {'title': f"{os.path.basename(file_path)} (section {i+1})", 'text': article_text}
-        else:
-            # Get a random Wikipedia article
-            article = get_random_wikipedia_article()
-
-        # Get a random text sample
-        sample_words = get_random_text_sample(article['text'], minimum_sample_length=min_sample_length)
-
-        # Generate steps for this sample
-        steps = []
-        for step_idx in tqdm(range(steps_per_sample), desc=f"Sample {i+1} steps", leave=False):
-            prefix_size = 10 + step_idx  # Start with 10 tokens and advance
-
-            # Make sure we don't go beyond the sample length
-            if prefix_size >= len(sample_words):
-                break
-
-            step_data = generate_step_data(sample_words, prefix_size, model_completions)
-            steps.append(step_data)
-
-        # Add sample data
-        sample_data = {
-            "article_title": article['title'],
-            "sample_words": sample_words,
-            "steps": steps
-        }
-
-        all_samples.append(sample_data)
+        return process_literal_file(file_path, single_token, model_completions, writer, chunk_size)
+
+    full_text = None
+    pipeline = None
+    if not file_path and not offline:
+        # Start fetching every article we'll need in the background
+        pipeline = wiki_corpus.ArticlePipeline(
+            sum(1 for i in range(num_samples) if i not in writer.samples), num_fetchers=num_fetchers, corpus=corpus
+        )
+        articles = pipeline.articles()
 
-        # Small delay to avoid rate limiting
-        time.sleep(1)
+    progress = tqdm(total=num_samples, desc="Generating samples")
 
-    return all_samples
+    try:
+        for chunk_start in range(0, num_samples, chunk_size):
+            # Collect this chunk's samples first, so each backend can score all of them at once
+            chunk = []
+            for i in range(chunk_start, min(chunk_start + chunk_size, num_samples)):
+                if i in writer.samples:
+                    # Already sampled by the run we're resuming
+                    title, sample_words = writer.samples[i]
+                else:
+                    # Get text either from file or Wikipedia
+                    if file_path:
+                        # For file input, we only get the text once and create multiple samples from it
+                        if full_text is None:
+                            full_text = get_text_from_file(file_path)['text']
+
+                        # For each sample, get a different portion of the text
+                        article = {'title': f"{os.path.basename(file_path)} (section {i+1})", 'text': full_text}
+                    elif offline:
+                        # Get a random article from the local corpus
+                        article = corpus.random_article()
+                    else:
+                        # Get the next random Wikipedia article from the fetchers
+                        article = next(articles)
+
+                    # Get a random text sample
+                    title = article['title']
+                    sample_words = get_random_text_sample(article['text'], minimum_sample_length=min_sample_length)
+                    writer.write_sample(i, title, sample_words)
+
+                # Start with 10 tokens and advance, without going beyond the sample length
+                prefix_sizes = [10 + step_idx for step_idx in range(steps_per_sample) if 10 + step_idx < len(sample_words)]
+                pending = [(j, prefix_size) for j, prefix_size in enumerate(prefix_sizes) if (i, j) not in writer.done_steps]
+                chunk.append((i, sample_words, pending))
+
+            prefix_groups = [
+                [''.join(sample_words[:prefix_size]) for _, prefix_size in pending]
+                for _, sample_words, pending in chunk
+            ]
+            predictions = predict_steps(
+                prefix_groups, prefix_groups, model_completions
+            )
+
+            for (i, sample_words, pending), sample_predictions in zip(chunk, predictions):
+                # Generate steps for this sample
+                for (j, prefix_size), step_predictions in zip(pending, sample_predictions):
+                    step_data = generate_step_data(sample_words, prefix_size, model_completions, step_predictions)
+                    writer.write_step(i, j, step_data)
+                progress.update(1)
+
+            writer.checkpoint()
+    finally:
+        progress.close()
+        if pipeline is not None:
+            pipeline.close()
 
 def main():
     parser = argparse.ArgumentParser(description='Generate model prediction data from Wikipedia articles or a text file')
@@ -332,8 +363,42 @@ def main():
     parser.add_argument('--single_token', action='store_true', help='In literal mode, require answers to be a single token')
     parser.add_argument('--no-model-completions', dest='model_completions', action='store_false',
                         help='Skip generating model completions for steps')
-    parser.set_defaults(model_completions=True)
+    parser.add_argument('--backends', type=str, default=','.join(model_backends.DEFAULT_BACKENDS),
+                        help=f"Comma-separated models to get predictions from (available: {', '.join(model_backends.BACKENDS)})")
+    parser.add_argument('--timeouts', type=str, default='',
+                        help='Per-backend timeouts in seconds for each model call, e.g. gpt2=30,llama3=10')
+    parser.add_argument('--batch_size', type=int, default=16, help='Maximum number of sequences per GPT-2 batch')
+    parser.add_argument('--max_batch_tokens', type=int, default=4096,
+                        help='Maximum number of (padded) tokens per GPT-2 batch')
+    parser.add_argument('--llama_concurrency', type=int, default=8, help='Maximum number of Llama 3.1 requests in flight')
+    parser.add_argument('--llama_rate', type=float, default=4.0, help='Maximum number of Llama 3.1 requests started per second')
+    parser.add_argument('--gguf_model', type=str, default='TheBloke/Llama-2-70B-GGUF',
+                        help='llama2 backend: GGUF file, or directory or Hugging Face repo containing --gguf_file')
+    parser.add_argument('--gguf_file', type=str, default='llama-2-70b.Q5_K_M.gguf',
+                        help='llama2 backend: model file within --gguf_model')
+    parser.add_argument('--gguf_threads', type=int, default=None,
+                        help='llama2 backend: CPU threads per forward pass (default: one per CPU)')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=prediction_cache_module.DEFAULT_CACHE_DIR,
+                        help='Directory for the on-disk prediction cache')
+    parser.add_argument('--cache-max-mb', dest='cache_max_mb', type=int, default=1024,
+                        help='Size cap for the prediction cache; least recently used entries are evicted past it')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Don't read or write the prediction cache")
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run, skipping samples and steps already in its records file')
+    parser.add_argument('--chunk_size', type=int, default=8,
+                        help='Number of samples to generate (and checkpoint to disk) at a time')
+    parser.add_argument('--fetchers', type=int, default=4, help='Number of concurrent Wikipedia fetchers')
+    parser.add_argument('--corpus', type=str, default=wiki_corpus.DEFAULT_CORPUS_PATH,
+                        help='SQLite file that fetched Wikipedia articles are saved to')
+    parser.add_argument('--offline', action='store_true',
+                        help='In wiki mode, sample articles from --corpus instead of fetching them')
+    parser.add_argument('--no-metrics', dest='metrics', action='store_false',
+                        help="Don't time the stages of the run or print the summary table at the end")
+    parser.set_defaults(model_completions=True, use_cache=True, metrics=metrics.enabled)
     args = parser.parse_args()
+    if not args.metrics:
+        metrics.disable()
 
     # Validate arguments
     if args.mode == 'literal' and not args.file:
@@ -355,23 +420,76 @@ def main():
     else:  # literal mode
         source_text = f"problems from {args.file}"
 
+    global backends, prediction_cache
+    try:
+        backends = model_backends.make_backends(
+            [name.strip() for name in args.backends.split(',') if name.strip()],
+            timeouts=model_backends.parse_timeouts(args.timeouts),
+            batch_size=args.batch_size,
+            max_batch_tokens=args.max_batch_tokens,
+            llama_concurrency=args.llama_concurrency,
+            llama_rate=args.llama_rate,
+            gguf_model=args.gguf_model,
+            gguf_file=args.gguf_file,
+            gguf_threads=args.gguf_threads,
+        )
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if args.model_completions:
+        print("Predicting with: " + ", ".join(backend.describe() for backend in backends))
+
+    if args.use_cache:
+        prediction_cache = prediction_cache_module.PredictionCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    # Results stream to a records file as they finish, and become the JSON output at the end
+    records_path = os.path.splitext(args.output)[0] + '.records.jsonl'
+    writer = jsonl_output.RecordWriter(records_path, resume=args.resume)
+
+    corpus = wiki_corpus.CorpusStore(args.corpus) if args.mode == 'wiki' else None
+    if args.offline:
+        source_text = f"Wikipedia articles in {args.corpus}"
+
     print(f"Generating data from {source_text}...")
-    data = generate_sample_data(
-        args.num_samples,
-        args.steps_per_sample,
-        file_path=file_path,
-        mode=args.mode,
-        single_token=args.single_token,
-        model_completions=args.model_completions
-    )
+    try:
+        generate_sample_data(
+            args.num_samples,
+            args.steps_per_sample,
+            file_path=file_path,
+            mode=args.mode,
+            single_token=args.single_token,
+            model_completions=args.model_completions,
+            writer=writer,
+            chunk_size=args.chunk_size,
+            num_fetchers=args.fetchers,
+            corpus=corpus,
+            offline=args.offline
+        )
+    except (wiki_corpus.ArticleFetchError, ValueError) as e:
+        # No articles to be had (network down, or an empty corpus with --offline)
+        writer.close()
+        print(f"Error: {e}")
+        print(f"Samples finished so far are kept in {records_path}; rerun with --resume to continue")
+        sys.exit(1)
+    writer.close()
+    if corpus is not None:
+        print(f"Local corpus {args.corpus} has {len(corpus)} articles")
+        corpus.close()
 
     # Save to JSON file
-    with open(args.output, 'w') as f:
-        json.dump(data, f, indent=2)
+    num_samples, num_steps = jsonl_output.records_to_json(records_path, args.output)
+
+    print(f"Data saved to {args.output} (records kept in {records_path} for --resume)")
+    print(f"Total samples: {num_samples}")
+    print(f"Total steps: {num_steps}")
+
+    if prediction_cache is not None:
+        print(prediction_cache.summary())
+        prediction_cache.close()
 
-    print(f"Data saved to {args.output}")
-    print(f"Total samples: {len(data)}")
-    print(f"Total steps: {sum(len(sample['steps']) for sample in data)}")
+    if metrics.enabled:
+        print("Time by stage:")
+        print(metrics.summary_table())
 
 if __name__ == "__main__":
     main()
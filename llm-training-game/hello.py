@@ -1,10 +1,9 @@
 import requests
 from bs4 import BeautifulSoup
-import random
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import torch.nn.functional as F
 import torch
-import tiktoken
+from tokenization import get_random_text_sample
 import os
 import openai
 import sys
@@ -49,20 +48,6 @@ def get_random_wikipedia_article():
         'text': text
     }
 
-def get_random_text_sample(text, minimum_sample_length=20):
-    # Tokenize text using tiktoken and convert back to strings
-    enc = tiktoken.get_encoding("gpt2")
-    tokens = enc.encode(text)
-    words = [enc.decode([token]) for token in tokens]
-    
-    if len(words) > minimum_sample_length:
-        max_start_index = len(words) - minimum_sample_length
-        start_index = random.randint(0, max_start_index)
-    else:
-        start_index = 0
-    
-    return words[start_index:]
-
 def step(words, prefix_size):
     """
     Generate next token predictions from different models based on a prefix of words.
@@ -0,0 +1,282 @@
+"""
+Batched next-token prediction for Hugging Face causal language models (GPT-2).
+
+Work is described as a list of requests. Each request is a sequence of token ids plus
+the positions in it whose next-token predictions we want, so one forward pass can
+answer every step of a sample at once (a causal model's output at position i only
+depends on tokens 0..i). Texts longer than the model's context window are split into
+overlapping windows.
+
+Requests are sorted by length and packed into right-padded batches, capped both by
+number of sequences and by padded tokens per batch. Sorting first keeps padding waste
+low, and right padding means real tokens see exactly the same context as they would
+unbatched.
+"""
+
+import bisect
+import time
+import torch
+import torch.nn.functional as F
+import metrics
+
+# Most positions to run through the output projection at once
+OUTPUT_CHUNK = 256
+
+def logits_to_predictions(logits, top_k, tokenizer):
+    """Turn a [positions, vocab] tensor of next-token logits into top-k prediction lists"""
+    probs = F.softmax(logits, dim=-1)
+    top_probs, top_indices = torch.topk(probs, top_k, dim=-1)
+
+    all_predictions = []
+    for row_probs, row_indices in zip(top_probs, top_indices):
+        predictions = []
+        for prob, idx in zip(row_probs, row_indices):
+            token = tokenizer.decode(idx)
+            predictions.append({"token": token, "probability": prob.item()})
+        all_predictions.append(predictions)
+
+    return all_predictions
+
+def plan_requests(prefix_groups, tokenizer, max_length):
+    """Tokenize groups of prefixes into as few requests as possible.
+
+    Each group is a list of prefixes of the same text (e.g. every step of one sample).
+    Prefixes whose tokenization is a prefix of the group's longest one share its
+    request; any other prefix gets a request of its own, so results always match
+    running that prefix by itself.
+
+    Returns (requests, slots): requests is a list of (input_ids, positions), and
+    slots[g][i] is the (request index, position index) holding prefix i of group g.
+    """
+    requests = []
+    slots = []
+
+    for prefixes in prefix_groups:
+        group_slots = []
+        if prefixes:
+            full_ids = tokenizer(max(prefixes, key=len))['input_ids'][:max_length]
+            all_ids = [tokenizer(prefix)['input_ids'] for prefix in prefixes]
+            shared = [ids and ids == full_ids[:len(ids)] for ids in all_ids]
+
+            if any(shared):
+                shared_request = len(requests)
+                requests.append((full_ids, []))
+
+            for ids, is_shared in zip(all_ids, shared):
+                if is_shared:
+                    positions = requests[shared_request][1]
+                    group_slots.append((shared_request, len(positions)))
+                    positions.append(len(ids) - 1)
+                else:
+                    # Too long for the model: keep the most recent context
+                    ids = ids[-max_length:]
+                    group_slots.append((len(requests), 0))
+                    requests.append((ids, [len(ids) - 1]))
+        slots.append(group_slots)
+
+    return requests, slots
+
+def window_start(position, max_length, stride):
+    """Start of the window that predicts after `position` in a text longer than the model allows.
+
+    Windows are max_length tokens long and start every `stride` tokens. Each position
+    is predicted by the first window that contains it, so past the first window every
+    prediction sees at least max_length - stride tokens of context.
+    """
+    if position < max_length:
+        return 0
+    return -(-(position - max_length + 1) // stride) * stride
+
+def plan_text_requests(text, ends, tokenizer, max_length, stride=None):
+    """Plan requests for every prefix text[:end] of one text, tokenizing the text only once.
+
+    The text is tokenized with character offsets, and each end that falls on a token
+    boundary is mapped to that token's position. That is only what tokenizing the
+    prefix by itself would give if the text before it tokenizes the same way, which
+    holds for tokenizers that split text into pieces (words, punctuation, runs of
+    spaces) before merging within them, as GPT-2's does. So only the last piece (and
+    any whitespace before it) is re-tokenized to check each prefix.
+
+    Texts longer than max_length tokens are covered by overlapping windows (see
+    window_start). Returns (requests, slots, unplanned): slots[i] is the (request index,
+    position index) for ends[i], or None for the indices in unplanned, whose prefixes
+    have to be run on their own (e.g. with plan_requests).
+    """
+    stride = stride or max_length // 2
+    pre_tokenizer = getattr(getattr(tokenizer, 'backend_tokenizer', None), 'pre_tokenizer', None)
+    if pre_tokenizer is None:
+        return [], [None] * len(ends), list(range(len(ends)))
+
+    encoding = tokenizer(text, return_offsets_mapping=True)
+    ids = encoding['input_ids']
+    token_starts = {}
+    token_ends = {}
+    for i, (start, end) in enumerate(encoding['offset_mapping']):
+        token_starts.setdefault(start, i)
+        # Tokens that split one character all end with it, and the last one completes it
+        token_ends[end] = i
+    pieces = [offsets for _, offsets in pre_tokenizer.pre_tokenize_str(text)]
+    piece_starts = [start for start, _ in pieces]
+
+    requests = []
+    windows = {}  # window start -> request index
+    slots = []
+    unplanned = []
+    for i, end in enumerate(ends):
+        position = token_ends.get(end)
+        if end > 0 and position is not None:
+            # Whitespace splits differently at the end of the text, so start checking before any
+            piece = bisect.bisect_right(piece_starts, end - 1) - 1
+            while piece > 0 and text[piece_starts[piece] - 1].isspace():
+                piece -= 1
+            first = token_starts.get(piece_starts[piece])
+            piece_ids = tokenizer(text[piece_starts[piece]:end], add_special_tokens=False)['input_ids']
+            if first is None or piece_ids != ids[first:position + 1]:
+                position = None
+        if not end or position is None:
+            slots.append(None)
+            unplanned.append(i)
+            continue
+
+        start = window_start(position, max_length, stride)
+        if start not in windows:
+            windows[start] = len(requests)
+            requests.append((ids[start:start + max_length], []))
+        request = windows[start]
+        slots.append((request, len(requests[request][1])))
+        requests[request][1].append(position - start)
+
+    return requests, slots, unplanned
+
+def make_batches(requests, batch_size, max_batch_tokens):
+    """Group request indices into batches of similar length"""
+    order = sorted(range(len(requests)), key=lambda i: len(requests[i][0]))
+
+    batches = []
+    batch = []
+    for i in order:
+        # Sorted ascending, so the newest request sets the padded length
+        padded_tokens = (len(batch) + 1) * len(requests[i][0])
+        if batch and (len(batch) >= batch_size or padded_tokens > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def run_requests(requests, top_k=5, name=None, model=None, tokenizer=None, batch_size=16, max_batch_tokens=4096):
+    """Run requests through the model in padded batches.
+
+    Returns, for each request, a list of top-k predictions for each of its positions.
+    """
+    results = [None] * len(requests)
+    if not requests:
+        return results
+
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    if pad_token_id is None:
+        pad_token_id = 0
+
+    # Only the requested positions need the (vocab-sized) output projection
+    base_model = model.base_model
+    lm_head = model.get_output_embeddings()
+
+    batches = make_batches(requests, batch_size, max_batch_tokens)
+    real_tokens = 0
+    padded_tokens = 0
+    start_time = time.perf_counter()
+
+    for batch in batches:
+        max_len = max(len(requests[i][0]) for i in batch)
+        input_ids = torch.full((len(batch), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+        rows = []
+        cols = []
+        for row, i in enumerate(batch):
+            ids, positions = requests[i]
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+            rows.extend([row] * len(positions))
+            cols.extend(positions)
+            real_tokens += len(ids)
+        padded_tokens += len(batch) * max_len
+
+        batch_predictions = []
+        with torch.no_grad(), metrics.timer(f"{name or 'hf'}_forward"):
+            hidden = base_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            # A few hundred positions at a time, so a whole text's logits are never all in memory
+            for chunk in range(0, len(rows), OUTPUT_CHUNK):
+                logits = lm_head(hidden[rows[chunk:chunk + OUTPUT_CHUNK], cols[chunk:chunk + OUTPUT_CHUNK]])
+                batch_predictions.extend(logits_to_predictions(logits, top_k, tokenizer))
+        predictions = iter(batch_predictions)
+
+        for i in batch:
+            results[i] = [next(predictions) for _ in requests[i][1]]
+
+    elapsed = time.perf_counter() - start_time
+    waste = 1 - real_tokens / padded_tokens if padded_tokens else 0
+    print(
+        f"{name}: {len(requests)} sequences, {real_tokens} tokens in {len(batches)} batches "
+        f"({elapsed:.2f}s, {real_tokens / elapsed if elapsed > 0 else 0:.0f} tokens/sec, {waste:.0%} padding)"
+    )
+
+    return results
+
+def predict_prefix_groups(prefix_groups, top_k=5, name=None, model=None, tokenizer=None, batch_size=16, max_batch_tokens=4096):
+    """Get top-k predictions for every prefix in every group, batched across groups.
+
+    Returns a list parallel to prefix_groups, each a list of prediction lists.
+    """
+    requests, slots = plan_requests(prefix_groups, tokenizer, model.config.n_positions)
+    results = run_requests(requests, top_k, name, model, tokenizer, batch_size, max_batch_tokens)
+    return [[results[request][position] for request, position in group_slots] for group_slots in slots]
+
+def predict_text(text, ends, top_k=5, name=None, model=None, tokenizer=None, batch_size=16, max_batch_tokens=4096):
+    """Get top-k predictions for text[:end] for every end in ends, from one pass over the text.
+
+    Prefixes that can't be read off the whole text's tokenization (see plan_text_requests)
+    are run the usual way.
+    """
+    requests, slots, unplanned = plan_text_requests(text, ends, tokenizer, model.config.n_positions)
+    results = run_requests(requests, top_k, name, model, tokenizer, batch_size, max_batch_tokens)
+    predictions = [results[slot[0]][slot[1]] if slot else None for slot in slots]
+
+    if unplanned:
+        print(f"{name}: {len(unplanned)} of {len(ends)} prefixes don't line up with the text's tokens")
+        [unplanned_predictions] = predict_prefix_groups(
+            [[text[:ends[i]] for i in unplanned]], top_k, name, model, tokenizer, batch_size, max_batch_tokens
+        )
+        for i, prediction in zip(unplanned, unplanned_predictions):
+            predictions[i] = prediction
+    return predictions
+
+def predict_incremental(prefixes, top_k=5, name=None, model=None, tokenizer=None):
+    """Get top-k predictions for a chain of prefixes, each extending the one before.
+
+    Keeps the model's key/value cache between prefixes and only feeds the tokens that
+    were appended, so a chain costs one pass over its longest prefix instead of one
+    pass per prefix. If appending text changes how the earlier part tokenizes, the
+    cache is dropped and that prefix is encoded from scratch.
+    """
+    predictions = []
+    cached_ids = []
+    past_key_values = None
+
+    for prefix in prefixes:
+        ids = tokenizer(prefix)['input_ids']
+        if past_key_values is not None and len(ids) > len(cached_ids) and ids[:len(cached_ids)] == cached_ids:
+            new_ids = ids[len(cached_ids):]
+        else:
+            new_ids = ids
+            past_key_values = None
+
+        with torch.no_grad(), metrics.timer(f"{name or 'hf'}_forward"):
+            outputs = model(input_ids=torch.tensor([new_ids]), past_key_values=past_key_values, use_cache=True)
+        past_key_values = outputs.past_key_values
+        cached_ids = ids
+
+        predictions.append(logits_to_predictions(outputs.logits[0, -1:, :], top_k, tokenizer)[0])
+
+    return predictions
@@ -0,0 +1,155 @@
+"""
+Streaming, resumable output for generate.py.
+
+While a run is in progress, results are appended to a JSONL records file instead of
+being held in memory. Two kinds of record are written:
+
+    {"type": "sample", "index": 3, "article_title": ..., "sample_words": [...]}
+    {"type": "step", "sample": 3, "step": 0, "data": {"prefix": ..., ...}}
+
+A sample record is written as soon as its text is chosen, and a step record as soon
+as its predictions are done, so a resumed run reuses the same text and only fills in
+the missing steps. The file is fsynced at checkpoints; a partial line left by a crash
+is dropped when the file is reopened.
+
+At the end, records_to_json converts the records into the JSON array format that
+ui.js and tui.py read.
+"""
+
+import json
+import os
+import dataset_index
+import metrics
+
+class RecordWriter:
+    def __init__(self, path, resume=False, checkpoint_every=100):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.samples = {}
+        self.done_steps = set()
+        self.unsynced = 0
+
+        if resume and os.path.exists(path):
+            self.load()
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def load(self):
+        """Read existing records, truncating any partial line at the end of the file"""
+        good_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good_bytes += len(line)
+
+                if record["type"] == "sample":
+                    self.samples[record["index"]] = (record["article_title"], record["sample_words"])
+                elif record["type"] == "step":
+                    self.done_steps.add((record["sample"], record["step"]))
+
+        if good_bytes < os.path.getsize(self.path):
+            print(f"Dropping a partially written record at the end of {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_bytes)
+
+        print(f"Resuming from {self.path}: {len(self.samples)} samples, {len(self.done_steps)} steps already done")
+
+    def write(self, record):
+        with metrics.timer('json_serialize'):
+            self.file.write(json.dumps(record) + '\n')
+        self.unsynced += 1
+        if self.unsynced >= self.checkpoint_every:
+            self.checkpoint()
+
+    def write_sample(self, index, article_title, sample_words):
+        self.samples[index] = (article_title, sample_words)
+        self.write({"type": "sample", "index": index, "article_title": article_title, "sample_words": sample_words})
+
+    def write_step(self, sample_index, step_index, step_data):
+        self.done_steps.add((sample_index, step_index))
+        self.write({"type": "step", "sample": sample_index, "step": step_index, "data": step_data})
+
+    def checkpoint(self):
+        """Make everything written so far durable"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        self.checkpoint()
+        self.file.close()
+
+class MemoryWriter:
+    """The RecordWriter interface, keeping everything in memory, for callers that want the data back"""
+
+    def __init__(self):
+        self.samples = {}
+        self.steps = {}
+        self.done_steps = set()
+
+    def write_sample(self, index, article_title, sample_words):
+        self.samples[index] = (article_title, sample_words)
+
+    def write_step(self, sample_index, step_index, step_data):
+        self.done_steps.add((sample_index, step_index))
+        self.steps[sample_index, step_index] = step_data
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+    def dataset(self):
+        """The samples written, in the JSON array format records_to_json writes"""
+        return [
+            {
+                "article_title": article_title,
+                "sample_words": sample_words,
+                "steps": [self.steps[key] for key in sorted(key for key in self.steps if key[0] == index)],
+            }
+            for index, (article_title, sample_words) in sorted(self.samples.items())
+        ]
+
+def records_to_json(records_path, output_path):
+    """Convert a records file into a JSON array of samples, ordered by sample and step.
+
+    Only byte offsets are kept in memory; each sample is read back from the records file
+    when it is written out. Returns (number of samples, number of steps).
+    """
+    sample_offsets = {}
+    step_offsets = {}
+    with open(records_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            record = json.loads(line)
+            if record["type"] == "sample":
+                sample_offsets[record["index"]] = offset
+            elif record["type"] == "step":
+                step_offsets.setdefault(record["sample"], {})[record["step"]] = offset
+            offset += len(line)
+
+    def read_at(f, offset):
+        f.seek(offset)
+        return json.loads(f.readline())
+
+    num_steps = 0
+    with open(records_path, 'rb') as records, open(output_path, 'w') as out:
+        array = dataset_index.ArrayWriter(out)
+        for index in sorted(sample_offsets):
+            header = read_at(records, sample_offsets[index])
+            steps = step_offsets.get(index, {})
+            sample = {
+                "article_title": header["article_title"],
+                "sample_words": header["sample_words"],
+                "steps": [read_at(records, steps[step])["data"] for step in sorted(steps)],
+            }
+            num_steps += len(sample["steps"])
+            array.write(sample)
+        array.finish()
+
+    return len(sample_offsets), num_steps
@@ -0,0 +1,170 @@
+"""
+Concurrent Llama 3.1 logprob requests against Hyperbolic's OpenAI-compatible API.
+
+Requests run on the async OpenAI client, on an event loop thread of their own, with a
+semaphore bounding how many are in flight and a token bucket bounding how many start
+per second. Rate limit (429), server (5xx) and connection errors are retried with
+exponential backoff, honouring Retry-After when the server sends one.
+
+Set HYPERBOLIC_BASE_URL to point everything at another OpenAI-compatible server,
+e.g. a local stub.
+
+openai is imported on first use, since importing it takes most of a second.
+"""
+
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+import metrics
+
+LLAMA3_MODEL = "meta-llama/Meta-Llama-3.1-405B-FP8"
+HYPERBOLIC_BASE_URL = os.getenv('HYPERBOLIC_BASE_URL', "https://api.hyperbolic.xyz/v1")
+
+# Backoff jitter has its own generator so retries don't shift which text samples get drawn
+jitter = random.Random()
+
+def logprobs_to_predictions(logprobs, top_k=5):
+    """Turn a {token: logprob} dict from the completions API into a top-k prediction list"""
+    # Sort by logprob values (highest first)
+    sorted_logprobs = sorted(logprobs.items(), key=lambda x: x[1], reverse=True)
+
+    predictions = []
+    for token, logprob in sorted_logprobs[:top_k]:
+        if logprob > -9999:  # Skip the placeholder values
+            predictions.append({"token": token, "probability": math.exp(logprob)})
+
+    return predictions
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second on average, with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def is_retryable(error):
+    import openai
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, openai.APIConnectionError)
+
+def retry_delay(error, attempt, base_delay):
+    """Seconds to wait before retry number `attempt` (0-based)"""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            return float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    # Full jitter keeps a burst of 429s from retrying in lockstep
+    return base_delay * 2 ** attempt * jitter.uniform(0.5, 1.0)
+
+class LlamaClient:
+    """Fetch Llama 3.1 top-k predictions for many prefixes concurrently.
+
+    One client is meant to be kept and shared: every request, from any thread, runs on
+    the client's own event loop thread, so they all share one HTTP client, one limit on
+    requests in flight and one token bucket.
+    """
+
+    def __init__(self, concurrency=8, rate=4.0, max_retries=5, base_delay=1.0):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.retries = 0
+        self.lock = threading.Lock()
+        self.loop = None
+
+    def start(self):
+        """Start the event loop thread and create the client, semaphore and bucket on it, once"""
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                asyncio.run_coroutine_threadsafe(self.setup(), loop).result()
+                self.loop = loop
+        return self.loop
+
+    async def setup(self):
+        import openai
+
+        # Retries are ours, so the client shouldn't add its own on top
+        self.client = openai.AsyncOpenAI(
+            api_key=os.getenv('HYPERBOLIC_API_KEY'),
+            base_url=HYPERBOLIC_BASE_URL,
+            max_retries=0,
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.bucket = TokenBucket(self.rate)
+
+    async def predict(self, prefix, top_k):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    # Taking the token only once there's a free slot, so requests that queued
+                    # for one can't all start together with tokens taken while they waited
+                    await self.bucket.acquire()
+                    with metrics.timer('llama_round_trip'):
+                        completion = await self.client.completions.create(
+                            model=LLAMA3_MODEL,
+                            prompt=prefix,
+                            temperature=0,
+                            top_p=1,
+                            max_tokens=1,
+                            logprobs=5,
+                        )
+                return logprobs_to_predictions(completion.choices[0].logprobs.top_logprobs[0], top_k)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    metrics.count('llama_errors')
+                    return [{"error": str(e)}]
+                self.retries += 1
+                metrics.count('llama_retries')
+                await asyncio.sleep(retry_delay(e, attempt, self.base_delay))
+
+    async def predict_all(self, prefixes, top_k=5):
+        return await asyncio.gather(*(self.predict(prefix, top_k) for prefix in prefixes))
+
+    def predict_many(self, prefixes, top_k=5):
+        """Get top-k predictions for every prefix, in order. Failed requests give [{"error": ...}]."""
+        if not prefixes:
+            return []
+
+        print(f"Getting Llama 3.1 predictions for {len(prefixes)} prefixes "
+              f"(concurrency {self.concurrency}, {self.rate:g} requests/sec)")
+        loop = self.start()
+        retries_before = self.retries
+        start_time = time.perf_counter()
+        predictions = asyncio.run_coroutine_threadsafe(self.predict_all(prefixes, top_k), loop).result()
+        elapsed = time.perf_counter() - start_time
+
+        errors = sum(1 for p in predictions if p and "error" in p[0])
+        print(f"Llama 3.1: {len(prefixes)} requests in {elapsed:.2f}s "
+              f"({self.retries - retries_before} retries, {errors} errors)")
+        return predictions
+
+    def close(self):
+        """Close the HTTP client and stop the event loop thread"""
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self.client.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
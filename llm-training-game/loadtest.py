@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Load test for serve.py: concurrent clients fetching the viewer's files for a while.
+
+    python loadtest.py                          # starts serve.py on a spare port and tests it
+    python loadtest.py --url http://localhost:8000 --clients 32 --duration 20
+
+Each client keeps one connection open (reconnecting if the server closes it) and
+requests the files in turn, like a browser loading the page. Reports requests/sec,
+bytes transferred and latency percentiles per run. --revalidate sends the ETag from
+each client's previous response, to measure 304s the way a returning visitor gets them.
+"""
+
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+DEFAULT_PATHS = ['/', '/ui.js', '/wikipedia.json', '/intro1.json', '/intro2.json', '/math-full.json',
+                 '/specification-gaming.json']
+
+def spare_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(port, extra_args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(
+        [sys.executable, 'serve.py', '--port', str(port), '--no-browser', '--quiet'] + extra_args,
+        cwd=here, stdout=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("serve.py didn't start")
+
+def client_loop(host, port, paths, headers, revalidate, stop, results):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    etags = {}
+    latencies = []
+    statuses = {}
+    received = 0
+    i = 0
+    while not stop.is_set():
+        path = paths[i % len(paths)]
+        i += 1
+        request_headers = dict(headers)
+        if revalidate and path in etags:
+            request_headers['If-None-Match'] = etags[path]
+
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path, headers=request_headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            statuses['error'] = statuses.get('error', 0) + 1
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        received += len(body)
+        if response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+        if response.will_close:
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+
+    connection.close()
+    results.append((latencies, statuses, received))
+
+def run(url, paths, clients, duration, headers, revalidate):
+    parsed = urllib.parse.urlparse(url)
+    stop = threading.Event()
+    results = []
+    threads = [
+        threading.Thread(target=client_loop, args=(parsed.hostname, parsed.port or 80, paths, headers, revalidate, stop, results))
+        for _ in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for client_latencies, _, _ in results for latency in client_latencies)
+    statuses = {}
+    for _, client_statuses, _ in results:
+        for status, n in client_statuses.items():
+            statuses[status] = statuses.get(status, 0) + n
+    received = sum(client_received for _, _, client_received in results)
+    return latencies, statuses, received, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure serve.py requests/sec with concurrent clients')
+    parser.add_argument('--url', type=str, default=None, help='Server to test (default: start serve.py on a spare port)')
+    parser.add_argument('--server_args', type=str, default='', help='Extra arguments for the serve.py started here, e.g. "--dev"')
+    parser.add_argument('--paths', type=str, default=','.join(DEFAULT_PATHS), help='Comma-separated paths to request')
+    parser.add_argument('--clients', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run for')
+    parser.add_argument('--encoding', type=str, default='gzip, deflate, br', help='Accept-Encoding to send ("" for none)')
+    parser.add_argument('--revalidate', action='store_true', help='Send If-None-Match with the last ETag seen for each path')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        port = spare_port()
+        server = start_server(port, args.server_args.split())
+        url = f"http://127.0.0.1:{port}"
+
+    headers = {'Accept-Encoding': args.encoding} if args.encoding else {}
+    paths = [path.strip() for path in args.paths.split(',') if path.strip()]
+    try:
+        print(f"{args.clients} clients for {args.duration:g}s against {url} ({len(paths)} paths)")
+        latencies, statuses, received, elapsed = run(url, paths, args.clients, args.duration, headers, args.revalidate)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if not latencies:
+        print(f"No successful requests ({statuses})")
+        sys.exit(1)
+    print(f"requests:    {len(latencies)} ({len(latencies) / elapsed:.0f}/sec)")
+    print(f"received:    {received / 1024 / 1024:.1f} MB ({received / 1024 / 1024 / elapsed:.1f} MB/sec)")
+    print(f"statuses:    {', '.join(f'{status}: {n}' for status, n in sorted(statuses.items(), key=str))}")
+    print(f"latency ms:  p50 {statistics.median(latencies) * 1000:.1f}, "
+          f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f}, "
+          f"p99 {latencies[int(0.99 * (len(latencies) - 1))] * 1000:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Lightweight timers and counters for the prediction path.
+
+    with metrics.timer('gpt2_forward'):
+        ...
+    metrics.count('llama_retries')
+
+Each stage keeps its count, total time and its most recent SAMPLES_PER_STAGE timings,
+which p50/p95/p99 are computed from. summary_table() formats them for the end of a
+generate.py run, and prometheus_text() in Prometheus' text format for app.py.
+
+Metrics are on unless METRICS=0 is set in the environment (or disable() is called).
+When they are off, timer() hands back one shared do-nothing context manager and
+count() and observe() return straight away, so instrumented code costs next to nothing.
+"""
+
+import collections
+import os
+import threading
+import time
+
+SAMPLES_PER_STAGE = 10000
+QUANTILES = (0.5, 0.95, 0.99)
+
+enabled = os.getenv('METRICS', '1') != '0'
+lock = threading.Lock()
+timings = {}   # stage -> deque of recent durations in seconds
+totals = {}    # stage -> [count, total seconds]
+counters = {}  # name -> count
+
+class Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.stage, time.perf_counter() - self.start)
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def timer(stage):
+    """Context manager recording how long its block takes under `stage`"""
+    return Timer(stage) if enabled else NULL_TIMER
+
+def observe(stage, seconds):
+    """Record a duration measured elsewhere (e.g. in a worker process)"""
+    if not enabled:
+        return
+    with lock:
+        if stage not in timings:
+            timings[stage] = collections.deque(maxlen=SAMPLES_PER_STAGE)
+            totals[stage] = [0, 0.0]
+        timings[stage].append(seconds)
+        totals[stage][0] += 1
+        totals[stage][1] += seconds
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+def reset():
+    with lock:
+        timings.clear()
+        totals.clear()
+        counters.clear()
+
+def quantile(sorted_values, q):
+    """Nearest-rank quantile of a sorted, non-empty list"""
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def snapshot():
+    """{stage: {"count", "total", "p50", "p95", "p99"}} plus {counter: count}, in seconds"""
+    with lock:
+        stages = {stage: (sorted(values), list(totals[stage])) for stage, values in timings.items()}
+        counts = dict(counters)
+
+    summary = {}
+    for stage, (values, (stage_count, total)) in sorted(stages.items()):
+        summary[stage] = {"count": stage_count, "total": total}
+        for q in QUANTILES:
+            summary[stage][f"p{round(q * 100)}"] = quantile(values, q)
+    return summary, counts
+
+def summary_table():
+    summary, counts = snapshot()
+    if not summary and not counts:
+        return "No metrics recorded"
+
+    lines = [f"{'stage':<24} {'count':>8} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+    for stage, stats in summary.items():
+        lines.append(
+            f"{stage:<24} {stats['count']:>8} {stats['total']:>9.2f} "
+            f"{stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}"
+        )
+    for name, value in sorted(counts.items()):
+        lines.append(f"{name:<24} {value:>8}")
+    return '\n'.join(lines)
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format"""
+    summary, counts = snapshot()
+    lines = [
+        "# HELP prediction_stage_seconds Time spent in each stage of the prediction path",
+        "# TYPE prediction_stage_seconds summary",
+    ]
+    for stage, stats in summary.items():
+        for q in QUANTILES:
+            lines.append(f'prediction_stage_seconds{{stage="{stage}",quantile="{q}"}} {stats[f"p{round(q * 100)}"]}')
+        lines.append(f'prediction_stage_seconds_sum{{stage="{stage}"}} {stats["total"]}')
+        lines.append(f'prediction_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    lines += [
+        "# HELP prediction_events_total Events counted on the prediction path",
+        "# TYPE prediction_events_total counter",
+    ]
+    for name, value in sorted(counts.items()):
+        lines.append(f'prediction_events_total{{event="{name}"}} {value}')
+    return '\n'.join(lines) + '\n'
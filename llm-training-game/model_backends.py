@@ -0,0 +1,331 @@
+"""
+Registry of model backends that next-token predictions can come from.
+
+Every backend has the same batched interface, predict_topk(prefixes, k), which returns
+one top-k prediction list per prefix, plus a description of what calling it costs:
+
+    max_batch       how many prefixes it handles per call (1 means no batching)
+    cost_per_call   rough seconds per call, for planning and ordering work
+    timeout         seconds to wait for one call's predictions before giving up on it
+
+Backends registered here:
+
+    gpt2     GPT-2 through Hugging Face transformers, in padded batches (see hf_batch)
+    llama3   Llama 3.1 405B through Hyperbolic's OpenAI-compatible API (see llama_remote)
+    llama2   Llama 2 as a quantized GGUF file through ctransformers, on CPU only,
+             memory-mapped and multithreaded; works offline given a local model file
+
+Models, clients and heavy imports are all loaded on first use.
+"""
+
+import concurrent.futures
+import functools
+import heapq
+import math
+import os
+import threading
+import time
+import llama_remote
+import metrics
+
+BACKENDS = {}
+DEFAULT_BACKENDS = ['gpt2', 'llama3']
+
+# Prefix lengths (in tokens, roughly) that warmup() runs a local model at
+WARMUP_LENGTHS = (8, 128, 512)
+
+def register_backend(name):
+    """Decorator adding a backend factory to the registry under `name`"""
+    def register(factory):
+        BACKENDS[name] = factory
+        return factory
+    return register
+
+def make_backends(names, timeouts=None, **options):
+    """Build the named backends, passing each factory the options it knows about.
+
+    timeouts maps backend name -> seconds, overriding the backends' default timeouts.
+    """
+    unknown = [name for name in names if name not in BACKENDS]
+    if unknown:
+        raise ValueError(f"Unknown backend(s): {', '.join(unknown)} (available: {', '.join(BACKENDS)})")
+
+    backends = [BACKENDS[name](**options) for name in names]
+    for backend in backends:
+        if timeouts and backend.name in timeouts:
+            backend.timeout = timeouts[backend.name]
+    return backends
+
+def parse_timeouts(text):
+    """Parse "gpt2=30,llama3=10" into {"gpt2": 30.0, "llama3": 10.0}"""
+    timeouts = {}
+    for item in text.split(','):
+        if item.strip():
+            name, _, seconds = item.partition('=')
+            timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+def collect_predictions(backends, futures, started=None, on_ready=None, timeouts=None):
+    """Wait for {backend name: Future of predictions}, giving each backend until its timeout
+    (or the seconds given for it in timeouts).
+
+    Returns {backend name: predictions} in backend order. A backend that raised or ran
+    out of time gets an [{"error": ...}] entry instead, without holding up the others.
+    on_ready(name, predictions) is called for each backend as soon as it is done.
+    started is when the work was submitted (time.monotonic()); defaults to now.
+    """
+    started = time.monotonic() if started is None else started
+    timeouts = timeouts or {}
+    deadlines = {
+        backend.name: started + timeouts.get(backend.name, backend.timeout)
+        for backend in backends if backend.name in futures
+    }
+    pending = dict(futures)
+    results = {}
+
+    while pending:
+        wait = max(0, min(deadlines[name] for name in pending) - time.monotonic())
+        concurrent.futures.wait(pending.values(), timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        now = time.monotonic()
+        for name, future in list(pending.items()):
+            if future.done():
+                try:
+                    predictions = future.result()
+                except Exception as e:
+                    predictions = [{"error": str(e) or type(e).__name__}]
+            elif now >= deadlines[name]:
+                predictions = [{"error": f"Timed out after {deadlines[name] - started:g}s"}]
+            else:
+                continue
+            del pending[name]
+            results[name] = predictions
+            if on_ready is not None:
+                on_ready(name, predictions)
+
+    return {name: results[name] for name in futures}
+
+@functools.lru_cache(maxsize=None)
+def load_hf_model(model_name):
+    from transformers import AutoModelForCausalLM
+    return AutoModelForCausalLM.from_pretrained(model_name)
+
+@functools.lru_cache(maxsize=None)
+def load_hf_tokenizer(model_name):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_name)
+
+@functools.lru_cache(maxsize=None)
+def load_gguf_model(model_path, model_file, model_type, threads, context_length):
+    import ctransformers
+    return ctransformers.AutoModelForCausalLM.from_pretrained(
+        model_path,
+        model_file=model_file,
+        model_type=model_type,
+        threads=threads,
+        context_length=context_length,
+        gpu_layers=0,
+        mmap=True,
+    )
+
+# One ctransformers model can only evaluate one sequence at a time, and load_gguf_model
+# hands every backend built with the same arguments the same model, so they share a lock
+gguf_locks = {}
+gguf_locks_lock = threading.Lock()
+
+def gguf_model_lock(*model_key):
+    """The lock for the model load_gguf_model(*model_key) returns"""
+    with gguf_locks_lock:
+        return gguf_locks.setdefault(model_key, threading.Lock())
+
+def group_by_text(prefixes):
+    """Split prefix indices into groups where each prefix starts the group's longest one.
+
+    Prefixes of the same text can then be scored in a single forward pass.
+    """
+    groups = []
+    for i in sorted(range(len(prefixes)), key=lambda i: len(prefixes[i]), reverse=True):
+        for longest, members in groups:
+            if longest.startswith(prefixes[i]):
+                members.append(i)
+                break
+        else:
+            groups.append((prefixes[i], [i]))
+    return [members for _, members in groups]
+
+class Backend:
+    name = None           # key in step_data["predictions"]
+    label = None          # name to show people
+    cache_id = None       # model id in the prediction cache
+    remote = False        # whether it runs on someone else's server
+    max_batch = 1
+    cost_per_call = 1.0
+    timeout = 60.0
+
+    def predict_topk(self, prefixes, k=5):
+        raise NotImplementedError
+
+    def load(self):
+        """Load the model, if there is one to load"""
+
+    def warmup(self, lengths=WARMUP_LENGTHS):
+        """Load the model and run it once at each prefix length, so the first real call is fast.
+
+        Returns the seconds spent loading and warming up, and the latency of a prediction
+        afterwards. Remote backends have nothing to warm up and return {}.
+        """
+        if self.remote:
+            return {}
+        start = time.perf_counter()
+        self.load()
+        loaded = time.perf_counter()
+        for length in lengths:
+            self.predict_topk([" the" * length], 1)
+        warmed = time.perf_counter()
+        self.predict_topk(["The quick brown fox jumps over the"], 5)
+        return {
+            "load_seconds": loaded - start,
+            "warmup_seconds": warmed - loaded,
+            "first_token_seconds": time.perf_counter() - warmed,
+        }
+
+    def describe(self):
+        where = "remote" if self.remote else "local"
+        return f"{self.name} ({self.label}, {where}, up to {self.max_batch} per call, ~{self.cost_per_call:g}s/call)"
+
+class HFBackend(Backend):
+    """A Hugging Face causal LM, batched across prefixes"""
+
+    cost_per_call = 0.1
+
+    def __init__(self, name, label, model_name, batch_size=16, max_batch_tokens=4096):
+        self.name = name
+        self.label = label
+        self.cache_id = name
+        self.model_name = model_name
+        self.max_batch = batch_size
+        self.max_batch_tokens = max_batch_tokens
+
+    @property
+    def model(self):
+        return load_hf_model(self.model_name)
+
+    @property
+    def tokenizer(self):
+        return load_hf_tokenizer(self.model_name)
+
+    def load(self):
+        self.model
+        self.tokenizer
+
+    def predict_topk(self, prefixes, k=5):
+        import hf_batch
+        print(f"Getting {self.name} predictions for {len(prefixes)} prefixes in batches")
+        groups = group_by_text(prefixes)
+        group_predictions = hf_batch.predict_prefix_groups(
+            [[prefixes[i] for i in group] for group in groups],
+            k, self.name, self.model, self.tokenizer, self.max_batch, self.max_batch_tokens
+        )
+        predictions = [None] * len(prefixes)
+        for group, group_prediction in zip(groups, group_predictions):
+            for i, prediction in zip(group, group_prediction):
+                predictions[i] = prediction
+        return predictions
+
+    def predict_text(self, text, ends, k=5):
+        """Predictions for text[:end] for every end in ends, from one pass over the text"""
+        import hf_batch
+        print(f"Getting {self.name} predictions for {len(ends)} prefixes of one text")
+        return hf_batch.predict_text(
+            text, ends, k, self.name, self.model, self.tokenizer, self.max_batch, self.max_batch_tokens
+        )
+
+    def predict_chain(self, prefixes, k=5):
+        """Like predict_topk, for prefixes that each extend the previous one (reuses the KV cache)"""
+        import hf_batch
+        return hf_batch.predict_incremental(prefixes, k, self.name, self.model, self.tokenizer)
+
+class RemoteBackend(Backend):
+    """A model behind an OpenAI-compatible completions API, queried concurrently"""
+
+    remote = True
+    cost_per_call = 1.5
+    timeout = 20.0
+
+    def __init__(self, name, label, model, concurrency=8, rate=4.0):
+        self.name = name
+        self.label = label
+        self.cache_id = model
+        self.max_batch = concurrency
+        self.rate = rate
+        # Shared by every call, from any thread, so the concurrency and rate limits are too
+        self.client = llama_remote.LlamaClient(concurrency=concurrency, rate=rate)
+
+    def predict_topk(self, prefixes, k=5):
+        return self.client.predict_many(prefixes, k)
+
+class GGUFBackend(Backend):
+    """A quantized GGUF model run on CPU with ctransformers.
+
+    The model file is memory-mapped, so it is paged in on demand and shared between
+    processes, and each forward pass runs on `threads` CPU threads. Prefixes are
+    visited in sorted order so that ones sharing text reuse the tokens already
+    evaluated, and only the new tail of each is fed through the model.
+    """
+
+    cost_per_call = 5.0
+    timeout = 120.0
+
+    def __init__(self, name, label, model_path, model_file=None, model_type='llama', threads=None, context_length=4096):
+        self.name = name
+        self.label = label
+        self.cache_id = os.path.join(model_path, model_file) if model_file and not os.path.isfile(model_path) else model_path
+        self.model_path = model_path
+        self.model_file = model_file
+        self.model_type = model_type
+        self.threads = threads or os.cpu_count()
+        self.context_length = context_length
+        self.lock = gguf_model_lock(model_path, model_file, model_type, self.threads, context_length)
+
+    @property
+    def model(self):
+        return load_gguf_model(self.model_path, self.model_file, self.model_type, self.threads, self.context_length)
+
+    def load(self):
+        self.model
+
+    def predict_topk(self, prefixes, k=5):
+        llm = self.model
+        print(f"Getting {self.name} predictions for {len(prefixes)} prefixes on {self.threads} CPU threads")
+        results = {}
+        with self.lock:
+            for prefix in sorted(set(prefixes)):
+                tokens = llm.tokenize(prefix)[-llm.context_length:]
+                with metrics.timer(f"{self.name}_forward"):
+                    llm.eval(llm.prepare_inputs_for_generation(tokens))
+                results[prefix] = self.logits_to_predictions(llm, k)
+        return [results[prefix] for prefix in prefixes]
+
+    @staticmethod
+    def logits_to_predictions(llm, k):
+        logits = list(llm.logits)
+        top = heapq.nlargest(k, range(len(logits)), key=logits.__getitem__)
+        # Softmax over the whole vocabulary, computed stably
+        largest = logits[top[0]]
+        log_total = largest + math.log(sum(math.exp(logit - largest) for logit in logits))
+        return [
+            {"token": llm.detokenize([token]), "probability": math.exp(logits[token] - log_total)}
+            for token in top
+        ]
+
+@register_backend('gpt2')
+def gpt2_backend(batch_size=16, max_batch_tokens=4096, **options):
+    return HFBackend('gpt2', 'GPT-2', 'gpt2', batch_size, max_batch_tokens)
+
+@register_backend('llama3')
+def llama3_backend(llama_concurrency=8, llama_rate=4.0, **options):
+    return RemoteBackend('llama3', 'Llama 3.1', llama_remote.LLAMA3_MODEL, llama_concurrency, llama_rate)
+
+@register_backend('llama2')
+def llama2_backend(gguf_model='TheBloke/Llama-2-70B-GGUF', gguf_file='llama-2-70b.Q5_K_M.gguf', gguf_threads=None, **options):
+    return GGUFBackend('llama2', 'Llama 2 (GGUF)', gguf_model, gguf_file, 'llama', gguf_threads)
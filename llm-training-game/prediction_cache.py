@@ -0,0 +1,140 @@
+"""
+Persistent on-disk cache of model predictions, so re-running generate.py on the same
+text doesn't pay again for the same GPT-2 forward passes and Llama 3.1 API calls.
+
+Entries live in a SQLite file keyed by (model id, SHA-256 of the prefix, top_k). The
+file is capped at a total payload size; when it grows past the cap the least recently
+used entries are evicted.
+
+One PredictionCache can be used from several threads; compute callbacks run outside
+its lock, so different models can be computing at the same time.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIR = '.prediction_cache'
+
+def prefix_hash(prefix):
+    return hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+
+class PredictionCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=1024 * 1024 * 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'predictions.sqlite3')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS predictions (
+                model TEXT NOT NULL,
+                prefix_hash TEXT NOT NULL,
+                top_k INTEGER NOT NULL,
+                predictions TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, prefix_hash, top_k)
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.db.commit()
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+
+    def get_many(self, model, top_k, prefixes):
+        """Return {prefix: predictions} for the prefixes that are cached"""
+        found = {}
+        now = time.time()
+        with self.lock:
+            for prefix in set(prefixes):
+                key = (model, prefix_hash(prefix), top_k)
+                row = self.db.execute(
+                    'SELECT predictions FROM predictions WHERE model = ? AND prefix_hash = ? AND top_k = ?', key
+                ).fetchone()
+                if row is None:
+                    continue
+                found[prefix] = json.loads(row[0])
+                self.db.execute(
+                    'UPDATE predictions SET last_used = ? WHERE model = ? AND prefix_hash = ? AND top_k = ?', (now,) + key
+                )
+            self.db.commit()
+
+            self.hits += sum(1 for prefix in prefixes if prefix in found)
+            self.misses += sum(1 for prefix in prefixes if prefix not in found)
+        return found
+
+    def put_many(self, model, top_k, items):
+        """Store (prefix, predictions) pairs. Error results are not cached, so they get retried."""
+        now = time.time()
+        with self.lock:
+            for prefix, predictions in items:
+                if any("error" in prediction for prediction in predictions):
+                    continue
+                key = (model, prefix_hash(prefix), top_k)
+                value = json.dumps(predictions)
+                old = self.db.execute(
+                    'SELECT size FROM predictions WHERE model = ? AND prefix_hash = ? AND top_k = ?', key
+                ).fetchone()
+                if old is not None:
+                    self.total_bytes -= old[0]
+                self.db.execute(
+                    'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)', key + (value, len(value), now)
+                )
+                self.total_bytes += len(value)
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """Drop least recently used entries until the cache is under its size cap. Call with the lock held."""
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        to_free = self.total_bytes - self.max_bytes
+        victims = []
+        for key_and_size in self.db.execute(
+            'SELECT model, prefix_hash, top_k, size FROM predictions ORDER BY last_used'
+        ):
+            victims.append(key_and_size[:3])
+            to_free -= key_and_size[3]
+            self.total_bytes -= key_and_size[3]
+            if to_free <= 0:
+                break
+
+        self.db.executemany('DELETE FROM predictions WHERE model = ? AND prefix_hash = ? AND top_k = ?', victims)
+        self.evictions += len(victims)
+
+    def lookup(self, model, top_k, prefix_groups, compute):
+        """Get predictions for groups of prefixes, only computing the ones not cached.
+
+        compute is called with the same groups filtered down to the missing prefixes,
+        and must return predictions in the same shape.
+        """
+        found = self.get_many(model, top_k, [prefix for group in prefix_groups for prefix in group])
+        missing_groups = [[prefix for prefix in group if prefix not in found] for group in prefix_groups]
+
+        if any(missing_groups):
+            computed = compute(missing_groups)
+            new_items = [item for group, predictions in zip(missing_groups, computed) for item in zip(group, predictions)]
+            self.put_many(model, top_k, new_items)
+            found.update(new_items)
+
+        return [[found[prefix] for prefix in group] for group in prefix_groups]
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (
+            f"Prediction cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate), "
+            f"{self.evictions} evictions, {self.total_bytes / 1024 / 1024:.1f} MB in {self.path}"
+        )
+
+    def close(self):
+        self.db.close()
@@ -1,31 +1,407 @@
 #!/usr/bin/env python3
 """
 Simple HTTP server for the LLM Prediction Viewer application.
-Run this script to start a local server on port 8000.
+Run this script to start a local server on port 8000 (see --help for options).
+
+Each request is handled on its own thread. Files are served from memory, along with
+gzip (and brotli, when the brotli package is installed) versions compressed once when
+first needed and again whenever the file changes, picked according to Accept-Encoding.
+Every version has a strong ETag, so a browser that already has it gets a 304 Not
+Modified, and Range requests are supported for partial downloads.
+
+Datasets (.json), HTML pages and scripts are revalidated on every load (Cache-Control:
+no-cache, which with ETags costs a 304 when nothing changed), since index.html loads
+ui.js by a fixed name; other static assets may be cached for --max_age seconds. With
+--dev, everything is sent with no-store instead, so edits always show up on reload.
 """
 
+import argparse
+import functools
+import gzip
+import hashlib
 import http.server
-import socketserver
-import webbrowser
+import json
 import os
-import sys
+import threading
+import urllib.parse
+import webbrowser
+import binary_dataset
+import dataset_index
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 PORT = 8000
+# Files worth compressing, and ones the browser should check for changes on every load
+COMPRESSIBLE = {'.json', '.js', '.html', '.css', '.txt', '.svg'}
+REVALIDATE = {'.json', '.html', '.js'}
+MIN_COMPRESS_BYTES = 256
+# Bigger files are left to SimpleHTTPRequestHandler, which streams them from disk
+MAX_CACHED_BYTES = 64 * 1024 * 1024
+
+class CachedFile:
+    """A file's contents, its compressed versions and their ETags"""
+
+    def __init__(self, path, stat):
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.last_modified = stat.st_mtime
+        with open(path, 'rb') as f:
+            body = f.read()
+
+        self.bodies = {'identity': body}
+        if os.path.splitext(path)[1] in COMPRESSIBLE and len(body) >= MIN_COMPRESS_BYTES:
+            self.bodies['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(body, quality=11)
+            # Not worth it if compressing didn't save anything
+            self.bodies = {
+                encoding: data for encoding, data in self.bodies.items()
+                if encoding == 'identity' or len(data) < len(body)
+            }
+
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etags = {
+            encoding: f'"{digest}"' if encoding == 'identity' else f'"{digest}-{encoding}"'
+            for encoding in self.bodies
+        }
+
+class FileCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def get(self, path):
+        """The CachedFile for path, rebuilt if the file changed; None for anything that isn't a small enough regular file"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path) or stat.st_size > MAX_CACHED_BYTES:
+            return None
+
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is None or (cached.mtime_ns, cached.size) != (stat.st_mtime_ns, stat.st_size):
+                cached = self.files[path] = CachedFile(path, stat)
+            return cached
+
+    def preload(self, directory):
+        """Read and compress the compressible files directly in directory, so the first requests don't have to"""
+        for name in sorted(os.listdir(directory)):
+            if os.path.splitext(name)[1] in COMPRESSIBLE:
+                self.get(os.path.join(directory, name))
+        return len(self.files)
+
+class DatasetIndex:
+    """Byte offsets of each sample in a JSON dataset (see dataset_index.py), for reading samples with a seek"""
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.dataset = dataset_index.JSONDataset(path, cache_size=0)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def read_sample(self, index):
+        """The raw JSON of sample `index`, read straight from the file"""
+        return self.dataset.read_raw(index)
+
+class BinaryDatasetIndex:
+    """The same interface as DatasetIndex for a binary dataset (see binary_dataset.py), which has its own index"""
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.dataset = binary_dataset.BinaryDataset(path)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def read_sample(self, index):
+        return json.dumps(self.dataset[index]).encode('utf-8')
+
+class DatasetIndexCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+    def get(self, path):
+        """The index for a .json or binary dataset file, rebuilt if it changed; None if it isn't a readable dataset"""
+        if path.endswith('.json'):
+            index_class = DatasetIndex
+        elif path.endswith(binary_dataset.SUFFIX):
+            index_class = BinaryDatasetIndex
+        else:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            index = self.indexes.get(path)
+            if index is None or (index.mtime_ns, index.size) != (stat.st_mtime_ns, stat.st_size):
+                try:
+                    index = index_class(path, stat)
+                except (OSError, ValueError) as e:
+                    print(f"Not indexing {path}: {e}")
+                    index = None
+                self.indexes[path] = index
+            return index
+
+    def find(self, json_path):
+        """The index for a .json dataset, or for its binary version if only that exists"""
+        if not os.path.exists(json_path):
+            return self.get(json_path.removesuffix('.json') + binary_dataset.SUFFIX)
+        return self.get(json_path)
+
+def choose_encoding(accept_encoding, available):
+    """Pick the best of the available encodings the client accepts (brotli, then gzip, then none)"""
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+
+    for encoding in ('br', 'gzip'):
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
+def etag_matches(header, etag):
+    """Whether an If-None-Match header matches etag (using weak comparison, as RFC 9110 says to)"""
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+def parse_range(header, size):
+    """Parse a single-range "bytes=..." header into (start, end) inclusive.
+
+    Returns None to ignore the header (malformed, or several ranges, which we answer with
+    the whole file) and 'unsatisfiable' for a range that starts past the end.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        elif last:
+            # The last N bytes
+            start = max(0, size - int(last))
+            end = size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if start >= size:
+        return 'unsatisfiable'
+    if start > end:
+        return None
+    return start, min(end, size - 1)
 
 class MyHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep-alive, so clients can reuse a connection for several files; headers and body
+    # are written separately, so without TCP_NODELAY each response waits on a delayed ACK
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, cache=None, datasets=None, dev=False, max_age=3600, quiet=False, **kwargs):
+        self.cache = cache
+        self.datasets = datasets
+        self.dev = dev
+        self.max_age = max_age
+        self.quiet = quiet
+        super().__init__(*args, **kwargs)
+
+    def cache_control(self, path):
+        if self.dev:
+            return 'no-store, no-cache, must-revalidate'
+        if os.path.splitext(path)[1] in REVALIDATE:
+            return 'no-cache'
+        return f'public, max-age={self.max_age}'
+
     def end_headers(self):
-        self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+        # Responses that don't come from the file cache (directory listings, errors, big files)
+        if not getattr(self, 'cache_control_sent', False):
+            self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate' if self.dev else 'no-cache')
+        self.cache_control_sent = False
         super().end_headers()
 
+    def do_GET(self):
+        self.send_cached(head=False)
+
+    def do_HEAD(self):
+        self.send_cached(head=True)
+
+    def send_cached(self, head):
+        if self.path.startswith('/api/') and self.datasets is not None:
+            return self.send_api(head)
+
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split('?')[0].endswith('/'):
+            path = os.path.join(path, 'index.html')
+        cached = self.cache.get(path) if self.cache is not None else None
+        if cached is None:
+            return super().do_HEAD() if head else super().do_GET()
+
+        encoding = choose_encoding(self.headers.get('Accept-Encoding', ''), cached.bodies)
+        body = cached.bodies[encoding]
+        etag = cached.etags[encoding]
+
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_file_headers(path, cached, encoding, etag)
+            self.end_headers()
+            return
+
+        start, end = 0, len(body) - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        # If-Range: only send part of the file if the client's copy is still current
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            byte_range = parse_range(range_header, len(body))
+            if byte_range == 'unsatisfiable':
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+
+        self.send_response(status)
+        self.send_file_headers(path, cached, encoding, etag)
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body[start:end + 1])
+
+    def send_file_headers(self, path, cached, encoding, etag):
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(cached.last_modified))
+        self.send_header('Accept-Ranges', 'bytes')
+        if len(cached.bodies) > 1:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Cache-Control', self.cache_control(path))
+        self.cache_control_sent = True
+
+    def send_api(self, head):
+        """The dataset API:
+
+            GET /api/datasets                           [{"path", "samples", "bytes"}] for each dataset
+            GET /api/datasets/<file>/samples/<index>    one sample of a dataset
+
+        Binary datasets are listed and served under their .json names when there's no
+        JSON file of that name, so the viewer can load either.
+        """
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts == ['api', 'datasets']:
+            directory = self.translate_path('/')
+            datasets = []
+            names = {
+                name.removesuffix(binary_dataset.SUFFIX) + '.json' if name.endswith(binary_dataset.SUFFIX) else name
+                for name in os.listdir(directory)
+            }
+            for name in sorted(names):
+                index = self.datasets.find(os.path.join(directory, name))
+                if index is not None:
+                    datasets.append({"path": name, "samples": len(index), "bytes": index.size})
+            return self.send_json(json.dumps(datasets).encode('utf-8'), None, head)
+
+        if len(parts) == 5 and parts[:2] == ['api', 'datasets'] and parts[3] == 'samples' and parts[4].isdigit():
+            name = urllib.parse.unquote(parts[2])
+            index = self.datasets.find(self.translate_path('/' + name)) if '/' not in name else None
+            sample = int(parts[4])
+            if index is not None and sample < len(index):
+                etag = f'"{index.mtime_ns:x}-{index.size:x}-{sample}"'
+                return self.send_json(index.read_sample(sample), etag, head)
+
+        self.send_error(404)
+
+    def send_json(self, body, etag, head):
+        """Send an API response, gzipped if the client takes it, or a 304 if it has this version"""
+        encoding = 'identity'
+        if len(body) >= MIN_COMPRESS_BYTES:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding', ''), {'identity', 'gzip'})
+        if etag is not None and encoding != 'identity':
+            etag = etag[:-1] + f'-{encoding}"'
+
+        if etag is not None and etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        if encoding == 'gzip':
+            body = gzip.compress(body, compresslevel=6, mtime=0)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
 def main():
+    parser = argparse.ArgumentParser(description='Serve the LLM Prediction Viewer')
+    parser.add_argument('--port', type=int, default=PORT, help='Port to listen on')
+    parser.add_argument('--dev', action='store_true',
+                        help='Development mode: tell browsers not to cache anything, so edits show up on reload')
+    parser.add_argument('--max_age', type=int, default=7 * 24 * 3600,
+                        help='Seconds browsers may cache static assets other than datasets, HTML and scripts')
+    parser.add_argument('--no-browser', dest='browser', action='store_false', help="Don't open a browser")
+    parser.add_argument('--quiet', action='store_true', help="Don't log every request")
+    args = parser.parse_args()
+
+    cache = FileCache()
+    cached = cache.preload(os.getcwd())
+    encodings = 'gzip and brotli' if brotli is not None else 'gzip (pip install brotli for brotli too)'
+    print(f"Cached {cached} files with {encodings} versions")
+
     # Start the server
-    handler = MyHandler
-    with socketserver.TCPServer(("", PORT), handler) as httpd:
-        print(f"Server started at http://localhost:{PORT}")
+    handler = functools.partial(
+        MyHandler, cache=cache, datasets=DatasetIndexCache(), dev=args.dev, max_age=args.max_age, quiet=args.quiet
+    )
+    with http.server.ThreadingHTTPServer(("", args.port), handler) as httpd:
+        print(f"Server started at http://localhost:{args.port}" + (" (development mode)" if args.dev else ""))
         print("Press Ctrl+C to stop the server.")
 
         # Open the browser
-        webbrowser.open(f"http://localhost:{PORT}")
+        if args.browser:
+            webbrowser.open(f"http://localhost:{args.port}")
 
         # Keep the server running
         try:
@@ -0,0 +1,107 @@
+"""
+In-memory prediction cache shared by every session of the Streamlit app.
+
+Players looking at the same article and prefix get the same predictions, so the
+first one to ask pays for the GPT-2 forward pass and the Llama API call and everyone
+else reuses the result. Entries are evicted least recently used first once their
+(approximate) total size passes a cap.
+
+Lookups are single-flight: if a prefix is already being computed, later callers wait
+for that computation instead of starting their own.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class SharedPredictionCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (predictions, size)
+        self.in_flight = {}  # key -> Future of the computation every caller waits on
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, compute):
+        """Return the predictions cached under key, calling compute() at most once to get them.
+
+        Error results are handed to everyone waiting but not kept, so they get retried.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+            future = self.in_flight.get(key)
+            computing = future is None
+            if computing:
+                future = self.in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.joined += 1
+
+        if not computing:
+            return future.result()
+
+        try:
+            predictions = compute()
+        except BaseException as e:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.in_flight[key]
+            if not any("error" in prediction for prediction in predictions):
+                self.store(key, predictions)
+        future.set_result(predictions)
+        return predictions
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        """Return the predictions cached under key, or None (only hits are counted)"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put_many(self, items):
+        """Cache (key, predictions) pairs computed ahead of time, skipping error results"""
+        with self.lock:
+            for key, predictions in items:
+                if not any("error" in prediction for prediction in predictions):
+                    self.store(key, predictions)
+
+    def store(self, key, predictions):
+        """Add an entry and evict least recently used ones past the size cap. Call with the lock held."""
+        size = len(json.dumps(key)) + len(json.dumps(predictions))
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (predictions, size)
+        self.total_bytes += size
+
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.evictions += 1
+
+    def summary(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.joined
+            hit_rate = (self.hits + self.joined) / lookups if lookups else 0
+            return (
+                f"Shared cache: {len(self.entries)} entries, {self.total_bytes / 1024 / 1024:.1f} MB, "
+                f"{hit_rate:.0%} hit rate ({self.joined} joined in-flight), {self.evictions} evictions"
+            )
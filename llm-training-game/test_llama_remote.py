@@ -0,0 +1,170 @@
+"""
+Tests for llama_remote.py against a local stand-in for the OpenAI-compatible completions API.
+
+    python -m unittest test_llama_remote
+"""
+
+import http.server
+import json
+import os
+import threading
+import time
+import unittest
+import llama_remote
+
+def completion(prompt):
+    """A completions response with two top logprobs for the next token"""
+    return {
+        "id": "cmpl-test", "object": "text_completion", "created": 0, "model": llama_remote.LLAMA3_MODEL,
+        "choices": [{
+            "index": 0, "text": " a", "finish_reason": "length",
+            "logprobs": {"tokens": [" a"], "token_logprobs": [-0.5], "text_offset": [len(prompt)],
+                         "top_logprobs": [{" a": -0.5, " b": -1.5}]},
+        }],
+    }
+
+class StubAPI(http.server.ThreadingHTTPServer):
+    """Answers POST /v1/completions according to the prompt:
+
+        "rate limited"  429 with Retry-After on the first request, then a completion
+        "flaky"         503 on the first request, then a completion
+        "broken"        500 every time
+        anything else   a completion, after `delay` seconds
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = {}         # prompt -> times requested
+        self.request_times = {}    # prompt -> [time.monotonic() of each request]
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = 0
+        self.retry_after = 0.3
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = body['prompt']
+        with server.lock:
+            server.requests[prompt] = server.requests.get(prompt, 0) + 1
+            server.request_times.setdefault(prompt, []).append(time.monotonic())
+            attempt = server.requests[prompt]
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if prompt == 'rate limited' and attempt == 1:
+                self.send_json(429, {"error": {"message": "slow down"}}, {'Retry-After': str(server.retry_after)})
+            elif prompt == 'flaky' and attempt == 1:
+                self.send_json(503, {"error": {"message": "try again"}})
+            elif prompt == 'broken':
+                self.send_json(500, {"error": {"message": "always failing"}})
+            else:
+                time.sleep(server.delay)
+                self.send_json(200, completion(prompt))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def send_json(self, status, payload, headers={}):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class LlamaClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubAPI()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = llama_remote.HYPERBOLIC_BASE_URL
+        llama_remote.HYPERBOLIC_BASE_URL = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        self.api_key = os.environ.get('HYPERBOLIC_API_KEY')
+        os.environ['HYPERBOLIC_API_KEY'] = 'test'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        llama_remote.HYPERBOLIC_BASE_URL = self.base_url
+        if self.api_key is None:
+            del os.environ['HYPERBOLIC_API_KEY']
+        else:
+            os.environ['HYPERBOLIC_API_KEY'] = self.api_key
+
+    def client(self, **kwargs):
+        kwargs.setdefault('rate', 1000)
+        kwargs.setdefault('base_delay', 0.01)
+        client = llama_remote.LlamaClient(**kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_predictions(self):
+        predictions = self.client().predict_many(['The quick brown fox'])
+        self.assertEqual([[entry['token'] for entry in p] for p in predictions], [[' a', ' b']])
+        self.assertAlmostEqual(predictions[0][0]['probability'], 0.60653, places=4)
+
+    def test_rate_limit_honours_retry_after(self):
+        client = self.client()
+        predictions = client.predict_many(['rate limited'])
+        self.assertNotIn('error', predictions[0][0])
+        self.assertEqual(self.server.requests['rate limited'], 2)
+        self.assertEqual(client.retries, 1)
+        first, second = self.server.request_times['rate limited']
+        self.assertGreaterEqual(second - first, self.server.retry_after)
+
+    def test_server_error_is_retried(self):
+        client = self.client()
+        predictions = client.predict_many(['flaky', 'steady'])
+        self.assertTrue(all('error' not in p[0] for p in predictions))
+        self.assertEqual(self.server.requests['flaky'], 2)
+        self.assertEqual(self.server.requests['steady'], 1)
+        self.assertEqual(client.retries, 1)
+
+    def test_error_entry_after_max_retries(self):
+        client = self.client(max_retries=2)
+        predictions = client.predict_many(['steady', 'broken'])
+        self.assertNotIn('error', predictions[0][0])
+        self.assertEqual(len(predictions[1]), 1)
+        self.assertIn('error', predictions[1][0])
+        self.assertEqual(self.server.requests['broken'], 3)
+
+    def test_concurrency_cap(self):
+        self.server.delay = 0.1
+        predictions = self.client(concurrency=3).predict_many([f"prefix {i}" for i in range(12)])
+        self.assertEqual(len(predictions), 12)
+        self.assertTrue(all('error' not in p[0] for p in predictions))
+        self.assertEqual(self.server.max_in_flight, 3)
+
+    def test_limits_are_shared_between_calls(self):
+        # Calls one after another draw on one token bucket, so only the first gets a burst
+        client = self.client(rate=10)
+        start = time.monotonic()
+        for call in range(3):
+            client.predict_many([f"call {call} prefix {i}" for i in range(10)])
+        self.assertGreaterEqual(time.monotonic() - start, 1.8)
+
+    def test_concurrency_cap_across_threads(self):
+        self.server.delay = 0.1
+        client = self.client(concurrency=2)
+        threads = [
+            threading.Thread(target=client.predict_many, args=([f"thread {t} prefix {i}" for i in range(3)],))
+            for t in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(self.server.requests.values()), 12)
+        self.assertEqual(self.server.max_in_flight, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+Tests for wiki_corpus.py against a local stand-in for Wikipedia's Special:Random.
+
+    python -m unittest test_wiki_corpus
+"""
+
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+import wiki_corpus
+
+ARTICLE_HTML = """<html><body>
+<h1 id="firstHeading">Article {number}</h1>
+<div id="mw-content-text">
+<p>Article {number} is about the number {number}.<sup>[1]</sup></p>
+<table><tr><td>infobox</td></tr></table>
+</div>
+</body></html>"""
+
+class StubWikipedia(http.server.ThreadingHTTPServer):
+    """Serves a new canned article for every GET, failing the requests numbered in fail / broken:
+
+        fail    500, so the fetch fails
+        broken  a page without the article markup, so parsing fails
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fail=(), broken=()):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.articles = 0
+        self.fail = set(fail)
+        self.broken = set(broken)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/wiki/Special:Random"
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            request = server.requests
+            if request not in server.fail and request not in server.broken:
+                server.articles += 1
+            number = server.articles
+
+        if request in server.fail:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        html = '<html><body>Not an article</body></html>' if request in server.broken \
+            else ARTICLE_HTML.format(number=number)
+        body = html.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ArticlePipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.corpus = wiki_corpus.CorpusStore(os.path.join(self.tmp.name, 'corpus.sqlite3'))
+
+    def tearDown(self):
+        self.corpus.close()
+        self.tmp.cleanup()
+
+    def serve(self, **kwargs):
+        server = StubWikipedia(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def fetch(self, server, limit, num_fetchers=2, **kwargs):
+        pipeline = wiki_corpus.ArticlePipeline(limit, num_fetchers=num_fetchers, num_parsers=2,
+                                               corpus=self.corpus, url=server.url, **kwargs)
+        try:
+            return list(pipeline.articles())
+        finally:
+            pipeline.close()
+
+    def stored_titles(self):
+        return sorted(title for title, in self.corpus.db.execute('SELECT title FROM articles'))
+
+    def test_delivers_parsed_articles(self):
+        server = self.serve()
+        articles = self.fetch(server, 5)
+        titles = sorted(article['title'] for article in articles)
+        self.assertEqual(titles, [f"Article {n}" for n in range(1, 6)])
+        for article in articles:
+            number = article['title'].split()[-1]
+            # Footnote markers and tables are left out of the text
+            self.assertEqual(article['text'], f"Article {number} is about the number {number}.")
+        self.assertEqual(server.requests, 5)
+
+    def test_articles_are_saved_to_the_corpus(self):
+        server = self.serve()
+        articles = self.fetch(server, 3)
+        self.assertEqual(len(self.corpus), 3)
+        self.assertEqual(self.stored_titles(), sorted(article['title'] for article in articles))
+        self.assertIn(self.corpus.random_article(), articles)
+
+    def test_failed_fetch_is_replaced(self):
+        server = self.serve(fail={2})
+        articles = self.fetch(server, 3, num_fetchers=1)
+        self.assertEqual(len(articles), 3)
+        self.assertEqual(server.requests, 4)
+        self.assertEqual(self.stored_titles(), ["Article 1", "Article 2", "Article 3"])
+
+    def test_failed_parse_is_replaced(self):
+        server = self.serve(broken={1})
+        articles = self.fetch(server, 2, num_fetchers=1)
+        self.assertEqual(sorted(article['title'] for article in articles), ["Article 1", "Article 2"])
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(len(self.corpus), 2)
+
+    def test_gives_up_when_every_fetch_fails(self):
+        server = self.serve(fail=range(1, 100))
+        with self.assertRaises(wiki_corpus.ArticleFetchError):
+            self.fetch(server, 3, num_fetchers=1, max_failures=2)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(len(self.corpus), 0)
+
+    def test_gives_up_when_every_parse_fails(self):
+        server = self.serve(broken=range(1, 100))
+        with self.assertRaises(wiki_corpus.ArticleFetchError):
+            self.fetch(server, 3, num_fetchers=1, max_failures=3)
+        self.assertEqual(len(self.corpus), 0)
+
+    def test_failures_only_count_in_a_row(self):
+        # Two failures either side of an article don't add up to max_failures
+        server = self.serve(fail={2}, broken={4})
+        articles = self.fetch(server, 3, num_fetchers=1, max_failures=2)
+        self.assertEqual(len(articles), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""
+Shared tiktoken helpers for generate.py, app.py and hello.py.
+
+Encoders are built once per process, and token ids are turned into per-token strings
+in bulk with decode_tokens_bytes instead of one enc.decode([token]) call per token.
+"""
+
+import functools
+import random
+import tiktoken
+import metrics
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(name="gpt2"):
+    return tiktoken.get_encoding(name)
+
+def decode_tokens(tokens, name="gpt2"):
+    """Decode each token id to its own string; same result as [enc.decode([t]) for t in tokens]"""
+    with metrics.timer('tiktoken_decode'):
+        return [token_bytes.decode('utf-8', errors='replace') for token_bytes in get_encoding(name).decode_tokens_bytes(tokens)]
+
+def get_random_text_sample(text, minimum_sample_length=20):
+    """Extract a random sample from text using GPT-2 tokenization"""
+    with metrics.timer('tiktoken_encode'):
+        tokens = get_encoding("gpt2").encode(text)
+
+    if len(tokens) > minimum_sample_length:
+        max_start_index = len(tokens) - minimum_sample_length
+        start_index = random.randint(0, max_start_index)
+    else:
+        start_index = 0
+
+    # Only the part we keep needs decoding
+    return decode_tokens(tokens[start_index:])
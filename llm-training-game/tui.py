@@ -1,21 +1,89 @@
 #!/usr/bin/env python3
 """
 Terminal UI for LLM Prediction Viewer using Textual.
-This app loads pre-generated prediction data from prediction_data.json.
+This app loads pre-generated prediction data from prediction_data.json, or the
+datasets and directories of datasets given on the command line (JSON, or the binary
+format from binary_dataset.py). [ and ] switch between datasets:
+
+    python tui.py [dataset or directory ...] [--web [port]]
+
+Datasets are read a sample at a time through an offset index (see dataset_index.py), so
+even a very large one opens straight away once it's been indexed, and only the last few
+samples viewed are kept in memory.
 """
 
-import json
+import collections
 import os
 import sys
+import threading
+import binary_dataset
+from textual import work
 from textual.app import App, ComposeResult
 from textual.containers import Container, Horizontal, Vertical
 from textual.widgets import Button, Static, Header, Footer, Label
-from textual.reactive import reactive
+from textual.reactive import var
+from textual.worker import get_current_worker
 from textual import events
 from rich.text import Text
 from rich.panel import Panel
 from rich.table import Table
 from rich.console import Group
+from rich.measure import Measurement
+from rich.segment import Segment
+
+# Number of recently viewed samples kept parsed, and of steps kept rendered
+SAMPLE_CACHE_SIZE = 8
+RENDER_CACHE_SIZE = 64
+
+DATASET_SUFFIXES = ('.json', binary_dataset.SUFFIX)
+
+def find_datasets(paths):
+    """Dataset files among paths, with directories replaced by the datasets in them"""
+    datasets = []
+    for path in paths:
+        if os.path.isdir(path):
+            datasets += sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(DATASET_SUFFIXES)
+            )
+        else:
+            datasets.append(path)
+    return datasets
+
+class CachedRender:
+    """A renderable that lays out another once per width, and replays the lines after that.
+
+    Textual measures and renders a widget's content on every layout pass, which means
+    wrapping a long prefix all over again for every key press.
+    """
+    
+    def __init__(self, renderable):
+        self.renderable = renderable
+        self.lines = {}
+        self.measurements = {}
+    
+    def __rich_console__(self, console, options):
+        key = (options.max_width, options.height)
+        if key not in self.lines:
+            natural = self.lines.get((options.max_width, None))
+            if natural is not None and len(natural) == options.height:
+                # Rendering to its own height comes out the same, and is what Textual asks for after measuring
+                self.lines[key] = natural
+            else:
+                self.lines[key] = console.render_lines(self.renderable, options, pad=False)
+        for line in self.lines[key]:
+            yield from line
+            yield Segment.line()
+    
+    def __rich_measure__(self, console, options):
+        key = (options.min_width, options.max_width)
+        if key not in self.measurements:
+            self.measurements[key] = Measurement.get(console, options, self.renderable)
+        return self.measurements[key]
+    
+    def prepare(self, console, options):
+        """Lay out the lines for these options ahead of time (e.g. on a background thread)"""
+        for _ in self.__rich_console__(console, options):
+            pass
 
 class PredictionViewer(App):
     """A Textual app to view pre-generated language model predictions."""
@@ -116,23 +184,32 @@ class PredictionViewer(App):
     TITLE = "LLM Prediction Viewer"
     SUB_TITLE = "Compare language model predictions"
     
-    show_predictions = reactive(False)
-    show_actual = reactive(False)
-    current_sample_index = reactive(0)
-    current_step_index = reactive(0)
+    # Plain vars rather than reactives: update_display redraws what changed, so assigning
+    # one shouldn't also repaint the whole app
+    show_predictions = var(False)
+    show_actual = var(False)
+    current_sample_index = var(0)
+    current_step_index = var(0)
     
-    def __init__(self):
+    def __init__(self, *paths):
         super().__init__()
-        self.data = self.load_data()
+        self.paths = list(paths) or ['prediction_data.json']
+        self.dataset_index = 0
+        self.datasets = {}    # path -> dataset, or None if it couldn't be loaded
+        self.positions = {}   # path -> (sample index, step index) when last switched away from
+        self.path = self.paths[0]
+        self.data = None
+        self.render_cache = collections.OrderedDict()
+        self.render_lock = threading.Lock()
+        self.shown = {}
     
-    def load_data(self):
-        """Load prediction data from JSON file."""
+    def load_data(self, path):
+        """Load prediction data from a JSON or binary dataset file."""
         try:
-            with open('prediction_data.json', 'r') as f:
-                return json.load(f)
+            return binary_dataset.open_dataset(path, cache_size=SAMPLE_CACHE_SIZE)
         except FileNotFoundError:
             return None
-        except json.JSONDecodeError:
+        except ValueError:  # Invalid JSON, or a binary dataset this version can't read
             return None
     
     def compose(self) -> ComposeResult:
@@ -167,55 +244,139 @@ class PredictionViewer(App):
     
     def on_mount(self) -> None:
         """Called when the app is mounted."""
-        if not self.data:
-            self.query_one("#title").update("Error: No prediction data found. Run 'python generate.py' first.")
+        # Widgets update_display changes, looked up once
+        self.widgets = {
+            name: self.query_one(f"#{name}")
+            for name in ("title", "sample_nav", "step_nav", "prefix", "predictions", "actual",
+                         "prev_sample", "next_sample", "prev_step", "next_step")
+        }
+        self.show_dataset()
+    
+    def rendered_step(self, data, path, sample_index, step_index):
+        """The prefix, predictions and actual token panels for a step, built once and kept for recent steps."""
+        key = (path, sample_index, step_index)
+        with self.render_lock:
+            if key in self.render_cache:
+                self.render_cache.move_to_end(key)
+                return self.render_cache[key]
+        
+        step = data[sample_index]["steps"][step_index]
+        rendered = {
+            "prefix": CachedRender(Panel(step["prefix"], title="Current Prefix")),
+            "predictions": CachedRender(self.format_predictions(step.get("predictions", {}))),
+            "actual": CachedRender(Panel(Text(f"{step['next_actual_token']}", style="bold green"), title="Actual Next Token")),
+        }
+        with self.render_lock:
+            self.render_cache[key] = rendered
+            if len(self.render_cache) > RENDER_CACHE_SIZE:
+                self.render_cache.popitem(last=False)
+        return rendered
+    
+    @work(thread=True, exclusive=True, group="prefetch", exit_on_error=False)
+    def prefetch(self, data, path, sample_index, step_index, width):
+        """Decode and render the steps a key press away, so moving to them doesn't wait on parsing"""
+        worker = get_current_worker()
+        options = self.console_options.update_width(width).update(highlight=False)
+        nearby = [(sample_index, step_index + 1), (sample_index, step_index - 1),
+                  (sample_index + 1, 0), (sample_index - 1, 0)]
+        for nearby_sample, nearby_step in nearby:
+            if worker.is_cancelled:
+                return
+            if not 0 <= nearby_sample < len(data):
+                continue
+            if not 0 <= nearby_step < len(data[nearby_sample]["steps"]):
+                continue
+            rendered = self.rendered_step(data, path, nearby_sample, nearby_step)
+            if width > 0:
+                rendered["prefix"].prepare(self.console, options)
+    
+    def switch_dataset(self, index) -> None:
+        """Show the dataset at paths[index], where it was left"""
+        if len(self.paths) < 2 or not 0 <= index < len(self.paths):
             return
+        self.positions[self.path] = (self.current_sample_index, self.current_step_index)
+        self.dataset_index = index
+        self.path = self.paths[index]
+        self.current_sample_index, self.current_step_index = self.positions.get(self.path, (0, 0))
+        self.show_predictions = False
+        self.show_actual = False
+        self.show_dataset()
+    
+    def show_dataset(self) -> None:
+        """Show the dataset at self.path, opening it on a background thread the first time"""
+        if self.path in self.datasets:
+            self.data = self.datasets[self.path]
+            self.update_display()
+        else:
+            # Opening a big JSON dataset for the first time means scanning it for its index
+            self.data = None
+            self.widgets["title"].update(f"Opening {self.path}...")
+            self.shown.pop("title", None)
+            self.open_dataset(self.path)
+    
+    @work(thread=True, group="open")
+    def open_dataset(self, path):
+        data = self.load_data(path)
+        self.call_from_thread(self.dataset_opened, path, data)
+    
+    def dataset_opened(self, path, data):
+        self.datasets[path] = data
+        if path == self.path:
+            self.data = data
+            self.update_display()
+    
+    def show(self, name, key, render, layout=True):
+        """Update a widget with render(), unless it's already showing what `key` identifies.
         
-        self.update_display()
+        Pass layout=False for widgets whose size can't change, to skip re-laying out the screen.
+        """
+        if self.shown.get(name) != key:
+            self.widgets[name].update(render(), layout=layout)
+            self.shown[name] = key
     
     def update_display(self) -> None:
-        """Update the display with current data."""
+        """Update the display with current data, re-rendering only the widgets whose content changed."""
+        if len(self.paths) > 1:
+            self.sub_title = f"{self.path} ({self.dataset_index + 1} of {len(self.paths)}, [ and ] to switch)"
         if not self.data:
+            self.show("title", ("error", self.path),
+                      lambda: f"Error: No prediction data found in {self.path}. Run 'python generate.py' first.")
+            self.show("prefix", ("error", self.path), lambda: "")
+            self.widgets["predictions"].set_class(False, "visible")
+            self.widgets["actual"].set_class(False, "visible")
             return
         
         # Get current sample and step
-        current_sample = self.data[self.current_sample_index]
-        current_step = current_sample["steps"][self.current_step_index]
-        
-        # Update title
-        self.query_one("#title").update(f"Article: {current_sample['article_title']}")
+        data = self.data
+        path = self.path
+        sample_index = self.current_sample_index
+        step_index = self.current_step_index
+        current_sample = data[sample_index]
+        sample_key = (path, sample_index)
+        step_key = (path, sample_index, step_index)
         
-        # Update navigation info
-        sample_nav = self.query_one("#sample_nav")
-        sample_nav.update(f"Sample {self.current_sample_index + 1} of {len(self.data)}")
+        self.show("title", sample_key, lambda: f"Article: {current_sample['article_title']}")
+        self.show("sample_nav", sample_key, lambda: f"Sample {sample_index + 1} of {len(data)}", layout=False)
+        self.show("step_nav", step_key, lambda: f"Step {step_index + 1} of {len(current_sample['steps'])}", layout=False)
+        self.show("prefix", step_key, lambda: self.rendered_step(data, *step_key)["prefix"])
         
-        step_nav = self.query_one("#step_nav")
-        step_nav.update(f"Step {self.current_step_index + 1} of {len(current_sample['steps'])}")
-        
-        # Update prefix
-        prefix_text = current_step["prefix"]
-        self.query_one("#prefix").update(Panel(prefix_text, title="Current Prefix"))
-        
-        # Update predictions
-        predictions_content = self.format_predictions(current_step["predictions"])
-        self.query_one("#predictions").update(predictions_content)
-        
-        # Update actual next token
-        actual_text = Text(f"{current_step['next_actual_token']}", style="bold green")
-        self.query_one("#actual").update(Panel(actual_text, title="Actual Next Token"))
+        # Hidden panels are left alone until they're shown
+        if self.show_predictions:
+            self.show("predictions", step_key, lambda: self.rendered_step(data, *step_key)["predictions"])
+        if self.show_actual:
+            self.show("actual", step_key, lambda: self.rendered_step(data, *step_key)["actual"])
         
         # Apply visibility based on reactive variables
-        predictions = self.query_one("#predictions")
-        predictions.set_class(self.show_predictions, "visible")
-        
-        actual = self.query_one("#actual")
-        actual.set_class(self.show_actual, "visible")
+        self.widgets["predictions"].set_class(self.show_predictions, "visible")
+        self.widgets["actual"].set_class(self.show_actual, "visible")
         
         # Update button states
-        self.query_one("#prev_sample").disabled = self.current_sample_index == 0
-        self.query_one("#next_sample").disabled = self.current_sample_index >= len(self.data) - 1
-        self.query_one("#prev_step").disabled = self.current_step_index == 0
-        self.query_one("#next_step").disabled = self.current_step_index >= len(current_sample["steps"]) - 1
+        self.widgets["prev_sample"].disabled = sample_index == 0
+        self.widgets["next_sample"].disabled = sample_index >= len(self.data) - 1
+        self.widgets["prev_step"].disabled = step_index == 0
+        self.widgets["next_step"].disabled = step_index >= len(current_sample["steps"]) - 1
+        
+        self.prefetch(data, path, sample_index, step_index, self.widgets["prefix"].content_size.width)
     
     def format_predictions(self, predictions):
         """Format predictions for display."""
@@ -240,6 +401,8 @@ class PredictionViewer(App):
     def on_button_pressed(self, event: Button.Pressed) -> None:
         """Called when a button is pressed."""
         button_id = event.button.id
+        if not self.data:
+            return
         
         if button_id == "toggle_predictions":
             self.show_predictions = not self.show_predictions
@@ -280,6 +443,12 @@ class PredictionViewer(App):
         """Handle key presses."""
         if event.key == "q":
             self.exit()
+        elif event.key == "left_square_bracket":
+            self.switch_dataset(self.dataset_index - 1)
+        elif event.key == "right_square_bracket":
+            self.switch_dataset(self.dataset_index + 1)
+        elif not self.data:
+            return
         elif event.key == "p":
             self.show_predictions = not self.show_predictions
             self.update_display()
@@ -325,13 +494,18 @@ class PredictionViewer(App):
                 self.update_display()
 
 if __name__ == "__main__":
-    app = PredictionViewer()
+    args = sys.argv[1:]
+    web_args = None
+    if "--web" in args:
+        web_args = args[args.index("--web") + 1:]
+        args = args[:args.index("--web")]
+    app = PredictionViewer(*find_datasets(args))
     
     # Check if we should run as a web app
-    if len(sys.argv) > 1 and sys.argv[1] == "--web":
+    if web_args is not None:
         # Run as a web app
-        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+        port = int(web_args[0]) if web_args else 8080
         app.run(port=port, web_browser=True, log="textual.log")
     else:
         # Run as a terminal app
-        app.run() 
\ No newline at end of file
+        app.run()
@@ -58,6 +58,7 @@ const DATASET_INFO = [
 // Define action types for reducer
 const ACTION_TYPES = {
   SET_DATASETS: 'SET_DATASETS',
+  SET_SAMPLE: 'SET_SAMPLE',
   SET_LOADING: 'SET_LOADING',
   SET_ERROR: 'SET_ERROR',
   CHANGE_DATASET: 'CHANGE_DATASET',
@@ -89,6 +90,17 @@ function appReducer(state, action) {
         datasets: action.payload
       };
 
+    case ACTION_TYPES.SET_SAMPLE: {
+      // Fill in one sample of a dataset loaded on demand (see serve.py's /api/datasets)
+      const { path, index, sample } = action.payload;
+      const dataset = state.datasets[path].slice();
+      dataset[index] = sample;
+      return {
+        ...state,
+        datasets: { ...state.datasets, [path]: dataset }
+      };
+    }
+
     case ACTION_TYPES.SET_LOADING:
       return {
         ...state,
@@ -264,6 +276,7 @@ function appReducer(state, action) {
       if (state.currentDatasetIndex > 0) {
         const newIndex = state.currentDatasetIndex - 1;
         const newDataset = state.datasets[DATASET_INFO[newIndex].path];
+        if (!newDataset || !newDataset[newDataset.length - 1]) return state;
         return {
           ...state,
           currentDatasetIndex: newIndex,
@@ -303,6 +316,17 @@ function getCurrentDatasetFromState(state) {
   return dataset;
 }
 
+// Display names for the models in step.predictions (keyed by generate.py backend name)
+const models = {
+  gpt2: { modelName: 'GPT-2', subtitle: '124M params, 2019' },
+  llama3: { modelName: 'Llama 3.1', subtitle: '405B params, 2024' },
+  llama2: { modelName: 'Llama 2', subtitle: '70B params, 2023, quantized' }
+};
+
+function modelInfo(key) {
+  return models[key] || { modelName: key, subtitle: '' };
+}
+
 // ModelPredictions component to eliminate duplication
 function ModelPredictions({ modelName, subtitle, predictions, showActualToken, actualToken }) {
   // Check if a prediction matches the actual token
@@ -391,8 +415,32 @@ function App() {
     showActualToken
   } = state;
 
-  // Load all datasets on component mount
-  React.useEffect(() => {
+  // Samples requested from the dataset API and not arrived yet, as "path/index"
+  const pendingSamples = React.useRef(new Set());
+
+  // Fetch one sample from serve.py's dataset API, unless it's loaded or on its way
+  const loadSample = (path, index) => {
+    const dataset = datasets[path];
+    const key = `${path}/${index}`;
+    if (!dataset || index < 0 || index >= dataset.length || dataset[index] !== undefined ||
+        pendingSamples.current.has(key)) {
+      return;
+    }
+    pendingSamples.current.add(key);
+    fetch(`api/datasets/${encodeURIComponent(path)}/samples/${index}`)
+      .then(response => {
+        if (!response.ok) {
+          throw new Error(`Failed to load sample ${index} of ${path}`);
+        }
+        return response.json();
+      })
+      .then(sample => dispatch({ type: ACTION_TYPES.SET_SAMPLE, payload: { path, index, sample } }))
+      .catch(err => console.error(err))
+      .finally(() => pendingSamples.current.delete(key));
+  };
+
+  // Fetch every dataset whole, for servers without the dataset API
+  const loadAllDatasets = () => {
     const fetchPromises = DATASET_INFO.map(dataset =>
       fetch(dataset.path)
         .then(response => {
@@ -420,8 +468,44 @@ function App() {
           payload: "Failed to load datasets: " + err.message
         });
       });
+  };
+
+  // Load the dataset list on component mount. With serve.py this is just sample counts,
+  // and samples are fetched as they're needed; with any other server, fetch every dataset whole.
+  React.useEffect(() => {
+    fetch('api/datasets')
+      .then(response => {
+        if (!response.ok) {
+          throw new Error('No dataset API');
+        }
+        return response.json();
+      })
+      .then(list => {
+        const counts = Object.fromEntries(list.map(dataset => [dataset.path, dataset.samples]));
+        const sparseData = Object.fromEntries(DATASET_INFO.map(dataset =>
+          [dataset.path, dataset.path in counts ? new Array(counts[dataset.path]) : null]
+        ));
+        dispatch({ type: ACTION_TYPES.SET_DATASETS, payload: sparseData });
+        dispatch({ type: ACTION_TYPES.SET_LOADING, payload: false });
+      })
+      .catch(loadAllDatasets);
   }, []);
 
+  // Load the current sample, and the ones either side of it so stepping across a sample is instant
+  React.useEffect(() => {
+    const path = DATASET_INFO[currentDatasetIndex].path;
+    loadSample(path, currentSampleIndex);
+    loadSample(path, currentSampleIndex + 1);
+    loadSample(path, currentSampleIndex - 1);
+    if (currentDatasetIndex < DATASET_INFO.length - 1) {
+      loadSample(DATASET_INFO[currentDatasetIndex + 1].path, 0);
+    }
+    if (currentDatasetIndex > 0) {
+      const prevPath = DATASET_INFO[currentDatasetIndex - 1].path;
+      loadSample(prevPath, datasets[prevPath] ? datasets[prevPath].length - 1 : -1);
+    }
+  }, [datasets, currentDatasetIndex, currentSampleIndex]);
+
   // Get current dataset
   const getCurrentDataset = () => {
     return getCurrentDatasetFromState(state);
@@ -578,6 +662,21 @@ function App() {
 
   const currentSample = data[currentSampleIndex];
 
+  // Render while the sample is on its way from the dataset API
+  if (currentSample === undefined) {
+    return (
+      <div style={{
+        display: 'flex',
+        flexDirection: 'column',
+        alignItems: 'center',
+        justifyContent: 'center',
+        height: '100vh'
+      }}>
+        <p>Loading sample...</p>
+      </div>
+    );
+  }
+
   const currentStep = currentSample.steps[currentStepIndex];
 
   // Get minimal progress info
@@ -746,21 +845,15 @@ function App() {
                 gap: '15px',
                 marginTop: '10px'
               }}>
-                <ModelPredictions
-                  modelName="GPT-2"
-                  subtitle="124M params, 2019"
-                  predictions={currentStep.predictions.gpt2}
-                  showActualToken={showActualToken}
-                  actualToken={currentStep.next_actual_token}
-                />
-
-                <ModelPredictions
-                  modelName="Llama 3.1"
-                  subtitle="405B params, 2024"
-                  predictions={currentStep.predictions.llama3}
-                  showActualToken={showActualToken}
-                  actualToken={currentStep.next_actual_token}
-                />
+                {Object.keys(currentStep.predictions).map(key => (
+                  <ModelPredictions
+                    key={key}
+                    {...modelInfo(key)}
+                    predictions={currentStep.predictions[key]}
+                    showActualToken={showActualToken}
+                    actualToken={currentStep.next_actual_token}
+                  />
+                ))}
               </div>
               ) : (
               <div style={{
@@ -770,14 +863,9 @@ function App() {
                 marginTop: '10px',
                 opacity: currentSampleIndex == 0 && currentStepIndex == 0 ? 0.4 : 1,
               }}>
-                <ModelPlaceholder
-                  modelName="GPT-2"
-                  subtitle="124M params, 2019"
-                />
-                <ModelPlaceholder
-                  modelName="Llama 3.1"
-                  subtitle="405B params, 2024"
-                />
+                {Object.keys(currentStep.predictions).map(key => (
+                  <ModelPlaceholder key={key} {...modelInfo(key)} />
+                ))}
               </div>
               )
             }
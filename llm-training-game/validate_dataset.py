@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Check prediction datasets for structural problems and report per-model statistics.
+
+    python validate_dataset.py wikipedia.json math-full.json
+    python validate_dataset.py big.llmp --workers 8 --calibration --json report.json
+
+For every step this checks that:
+
+    - the prefix is the join of sample_words up to some word, and next_actual_token is
+      the word after it ("END" after the last one)
+    - each model's predictions are a list of {"token", "probability"} or {"error"} entries,
+      with probabilities in [0, 1], summing to at most 1 and sorted from most to least likely
+
+and for each model it reports top-1 and top-k accuracy against next_actual_token, the
+number of error entries, and calibration of the top-1 probability (expected calibration
+error, and with --calibration the accuracy in each confidence bin).
+
+Datasets are JSON arrays or binary datasets (.llmp), opened through their sample index
+(see dataset_index.py). Worker processes each open the dataset themselves and check a
+range of samples at a time, so only ranges and statistics pass between processes and
+memory use doesn't depend on the size of the dataset.
+"""
+
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import binary_dataset
+
+CHUNK_SIZE = 64          # samples per task
+CALIBRATION_BINS = 10
+EXAMPLES_PER_ISSUE = 5
+PROBABILITY_TOLERANCE = 1e-4  # float32 rounding (binary datasets) can push a sum a little over 1
+
+class ModelStats:
+    """Prediction counts for one model"""
+
+    def __init__(self):
+        self.steps = 0        # steps with predictions from this model
+        self.errors = 0       # steps where it returned an error entry
+        self.scored = 0       # steps with a next_actual_token to score against
+        self.top1 = 0
+        self.topk = 0
+        self.bins = [[0, 0.0, 0] for _ in range(CALIBRATION_BINS)]  # count, total confidence, correct
+
+    def add_prediction(self, entries, actual):
+        self.steps += 1
+        if any('error' in entry for entry in entries):
+            self.errors += 1
+            return
+        if actual is None or not entries:
+            return
+        self.scored += 1
+        confidence = entries[0]['probability']
+        correct = entries[0]['token'] == actual
+        self.top1 += correct
+        self.topk += any(entry['token'] == actual for entry in entries)
+        calibration_bin = self.bins[min(int(confidence * CALIBRATION_BINS), CALIBRATION_BINS - 1)]
+        calibration_bin[0] += 1
+        calibration_bin[1] += confidence
+        calibration_bin[2] += correct
+
+    def merge(self, other):
+        self.steps += other.steps
+        self.errors += other.errors
+        self.scored += other.scored
+        self.top1 += other.top1
+        self.topk += other.topk
+        for mine, theirs in zip(self.bins, other.bins):
+            for i in range(3):
+                mine[i] += theirs[i]
+
+    def expected_calibration_error(self):
+        """Mean gap between top-1 confidence and accuracy, weighted by how many steps are in each bin"""
+        if not self.scored:
+            return None
+        return sum(abs(total_confidence - correct) for _, total_confidence, correct in self.bins) / self.scored
+
+    def report(self):
+        return {
+            "steps": self.steps,
+            "errors": self.errors,
+            "scored": self.scored,
+            "top1_accuracy": self.top1 / self.scored if self.scored else None,
+            "topk_accuracy": self.topk / self.scored if self.scored else None,
+            "expected_calibration_error": self.expected_calibration_error(),
+            "calibration": [
+                {"confidence": [i / CALIBRATION_BINS, (i + 1) / CALIBRATION_BINS], "steps": count,
+                 "mean_confidence": total_confidence / count, "accuracy": correct / count}
+                for i, (count, total_confidence, correct) in enumerate(self.bins) if count
+            ],
+        }
+
+class DatasetStats:
+    """Issue counts and per-model statistics for some or all of a dataset's samples"""
+
+    def __init__(self):
+        self.samples = 0
+        self.steps = 0
+        self.issues = collections.Counter()
+        self.examples = collections.defaultdict(list)  # issue -> [(sample, step, detail)]
+        self.models = collections.defaultdict(ModelStats)
+
+    def issue(self, name, sample_index, step_index=None, detail=''):
+        self.issues[name] += 1
+        if len(self.examples[name]) < EXAMPLES_PER_ISSUE:
+            self.examples[name].append((sample_index, step_index, detail))
+
+    def merge(self, other):
+        self.samples += other.samples
+        self.steps += other.steps
+        self.issues.update(other.issues)
+        for name, examples in other.examples.items():
+            mine = self.examples[name]
+            mine.extend(examples[:EXAMPLES_PER_ISSUE - len(mine)])
+        for model, stats in other.models.items():
+            self.models[model].merge(stats)
+
+    def report(self):
+        return {
+            "samples": self.samples,
+            "steps": self.steps,
+            "issues": dict(self.issues),
+            "examples": {
+                name: [{"sample": sample, "step": step, "detail": detail} for sample, step, detail in examples]
+                for name, examples in self.examples.items()
+            },
+            "models": {model: stats.report() for model, stats in sorted(self.models.items())},
+        }
+
+def is_probability(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= 1
+
+def check_predictions(stats, sample_index, step_index, model, entries, actual):
+    """Check one model's prediction list, and count it towards the model's statistics if it's well formed"""
+    if not isinstance(entries, list):
+        stats.issue('predictions_not_a_list', sample_index, step_index, model)
+        return
+    for entry in entries:
+        if not isinstance(entry, dict):
+            stats.issue('malformed_prediction', sample_index, step_index, f"{model}: {entry!r:.80}")
+            return
+        if 'error' in entry:
+            continue
+        if not isinstance(entry.get('token'), str) or 'probability' not in entry:
+            stats.issue('malformed_prediction', sample_index, step_index, f"{model}: {entry!r:.80}")
+            return
+        if not is_probability(entry['probability']):
+            stats.issue('probability_out_of_range', sample_index, step_index,
+                        f"{model}: {entry['token']!r} {entry['probability']!r}")
+            return
+
+    probabilities = [entry['probability'] for entry in entries if 'error' not in entry]
+    if sum(probabilities) > 1 + PROBABILITY_TOLERANCE:
+        stats.issue('probabilities_sum_over_1', sample_index, step_index, f"{model}: {sum(probabilities):.6f}")
+    if any(a < b for a, b in zip(probabilities, probabilities[1:])):
+        stats.issue('predictions_not_sorted', sample_index, step_index,
+                    f"{model}: {[round(p, 4) for p in probabilities]}")
+    stats.models[model].add_prediction(entries, actual)
+
+def check_sample(stats, sample_index, sample):
+    if not isinstance(sample, dict):
+        stats.issue('sample_not_an_object', sample_index)
+        return
+    stats.samples += 1
+    words = sample.get('sample_words')
+    steps = sample.get('steps')
+    if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+        stats.issue('bad_sample_words', sample_index)
+        words = None
+    if not isinstance(steps, list):
+        stats.issue('bad_steps', sample_index)
+        return
+
+    if words is not None:
+        # A prefix that's a join of sample_words ends at one of these character offsets
+        text = ''.join(words)
+        word_ends = [0]
+        for word in words:
+            word_ends.append(word_ends[-1] + len(word))
+
+    for step_index, step in enumerate(steps):
+        stats.steps += 1
+        if not isinstance(step, dict) or not isinstance(step.get('prefix'), str) \
+                or not isinstance(step.get('next_actual_token'), str):
+            stats.issue('malformed_step', sample_index, step_index)
+            continue
+        prefix = step['prefix']
+        actual = step['next_actual_token']
+
+        if words is not None:
+            word_count = bisect.bisect_left(word_ends, len(prefix))
+            if word_count >= len(word_ends) or word_ends[word_count] != len(prefix) \
+                    or not text.startswith(prefix):
+                stats.issue('prefix_not_sample_words', sample_index, step_index, f"{prefix[-60:]!r}")
+            elif actual != (words[word_count] if word_count < len(words) else 'END'):
+                stats.issue('next_token_not_sample_word', sample_index, step_index, f"{actual!r}")
+
+        predictions = step.get('predictions')
+        if predictions is None:
+            continue
+        if not isinstance(predictions, dict):
+            stats.issue('predictions_not_an_object', sample_index, step_index)
+            continue
+        for model, entries in predictions.items():
+            check_predictions(stats, sample_index, step_index, model, entries, None if actual == 'END' else actual)
+
+# Each worker process opens the dataset once, in init_worker
+dataset = None
+
+def init_worker(path):
+    global dataset
+    dataset = binary_dataset.open_dataset(path, cache_size=0)
+
+def check_range(start, end):
+    """Statistics for samples start to end - 1 of the worker's dataset"""
+    stats = DatasetStats()
+    for sample_index in range(start, end):
+        try:
+            sample = dataset[sample_index]
+        except ValueError as e:
+            stats.issue('invalid_json', sample_index, detail=str(e))
+            continue
+        check_sample(stats, sample_index, sample)
+    return stats
+
+def validate(path, workers=None, chunk_size=CHUNK_SIZE):
+    """DatasetStats for the dataset in path, checked by a pool of `workers` processes (in this one if 1)"""
+    # Opening it here first builds the index once, instead of in every worker
+    init_worker(path)
+    try:
+        count = len(dataset)
+        if workers == 1 or count <= chunk_size:
+            return check_range(0, count)
+    finally:
+        dataset.close()
+
+    ranges = ((start, min(start + chunk_size, count)) for start in range(0, count, chunk_size))
+    stats = DatasetStats()
+    workers = workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                initargs=(path,)) as pool:
+        # Keep a few tasks per worker queued rather than submitting every range up front
+        pending = set()
+        while True:
+            for start, end in ranges:
+                pending.add(pool.submit(check_range, start, end))
+                if len(pending) >= 4 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stats.merge(future.result())
+    return stats
+
+def percent(value):
+    return '   -  ' if value is None else f"{value * 100:5.1f}%"
+
+def print_report(path, stats, seconds, calibration=False):
+    print(f"{path}: {stats.samples} samples, {stats.steps} steps, checked in {seconds:.2f} s")
+    if stats.issues:
+        for name, count in stats.issues.most_common():
+            print(f"  {name}: {count}")
+            for sample, step, detail in stats.examples[name]:
+                where = f"sample {sample}" + (f" step {step}" if step is not None else '')
+                print(f"      {where}" + (f": {detail}" if detail else ''))
+    else:
+        print("  no issues")
+
+    if stats.models:
+        print(f"  {'model':<12} {'steps':>7} {'errors':>7} {'top-1':>7} {'top-k':>7} {'ECE':>7}")
+        for model, model_stats in sorted(stats.models.items()):
+            print(f"  {model:<12} {model_stats.steps:7d} {model_stats.errors:7d} "
+                  f"{percent(model_stats.top1 / model_stats.scored if model_stats.scored else None):>7} "
+                  f"{percent(model_stats.topk / model_stats.scored if model_stats.scored else None):>7} "
+                  f"{percent(model_stats.expected_calibration_error()):>7}")
+            if calibration:
+                for row in model_stats.report()['calibration']:
+                    low, high = row['confidence']
+                    print(f"      confidence {low:.1f}-{high:.1f}: {row['steps']:6d} steps, "
+                          f"mean confidence {percent(row['mean_confidence'])}, accuracy {percent(row['accuracy'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Check prediction datasets and report per-model statistics')
+    parser.add_argument('datasets', type=str, nargs='+', help='JSON or binary (.llmp) datasets')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: one per CPU)')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Samples per worker task')
+    parser.add_argument('--calibration', action='store_true', help='Show accuracy by top-1 confidence')
+    parser.add_argument('--json', type=str, default=None, help='Also write the full report to this file')
+    args = parser.parse_args()
+
+    reports = {}
+    for path in args.datasets:
+        start = time.perf_counter()
+        try:
+            stats = validate(path, args.workers, args.chunk_size)
+        except (OSError, ValueError) as e:
+            print(f"{path}: can't be read: {e}")
+            reports[path] = {"error": str(e)}
+            continue
+        print_report(path, stats, time.perf_counter() - start, args.calibration)
+        reports[path] = stats.report()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    # Non-zero exit status if anything failed, for use in scripts
+    if any('error' in report or report['issues'] for report in reports.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
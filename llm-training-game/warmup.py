@@ -0,0 +1,106 @@
+"""
+Model warmup and readiness reporting for the Streamlit app.
+
+Loading GPT-2 and running its first forward passes takes seconds, which used to land on
+whoever pressed a button first. ModelWarmup instead loads every local backend on a
+background thread and runs it at a few prefix lengths (see Backend.warmup), recording
+how long loading took and how fast a prediction is afterwards. Until it is done, the app
+shows a warming-up page instead of the game.
+
+serve_health(port) additionally answers GET /health with the same status as JSON:
+200 once every model is warmed up, 503 before that (or if one failed), for load
+balancers and deploy scripts. The same server has per-stage latencies for Prometheus
+at GET /metrics.
+"""
+
+import json
+import threading
+import time
+import metrics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class ModelWarmup:
+    def __init__(self, backends, lengths):
+        self.backends = [backend for backend in backends if not backend.remote]
+        self.lengths = lengths
+        self.status = {backend.name: "waiting" for backend in self.backends}
+        self.metrics = {}
+        self.started = time.time()
+        self.finished = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for backend in self.backends:
+            self.status[backend.name] = "warming up"
+            try:
+                self.metrics[backend.name] = backend.warmup(self.lengths)
+            except Exception as e:
+                print(f"Error warming up {backend.name}: {e}")
+                self.status[backend.name] = f"failed: {e}"
+            else:
+                self.status[backend.name] = "ready"
+                print(f"{backend.name} warmed up: {self.describe(backend.name)}")
+        self.finished = time.time()
+
+    @property
+    def ready(self):
+        """Whether warmup is over; a model that failed to warm up shows errors in the game instead"""
+        return self.finished is not None
+
+    @property
+    def healthy(self):
+        return self.ready and all(status == "ready" for status in self.status.values())
+
+    def describe(self, name):
+        metrics = self.metrics.get(name)
+        if not metrics:
+            return self.status[name]
+        return (
+            f"loaded in {metrics['load_seconds']:.1f}s, warmed up in {metrics['warmup_seconds']:.1f}s, "
+            f"first prediction {metrics['first_token_seconds'] * 1000:.0f} ms"
+        )
+
+    def health(self):
+        return {
+            "ready": self.ready,
+            "healthy": self.healthy,
+            "seconds": (self.finished or time.time()) - self.started,
+            "models": {
+                name: dict(self.metrics.get(name, {}), status=status) for name, status in self.status.items()
+            },
+        }
+
+    def serve_health(self, port):
+        """Serve GET /health, and GET /metrics (see metrics.prometheus_text), on a background thread"""
+        warmup = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/health':
+                    body = json.dumps(warmup.health()).encode('utf-8')
+                    self.send_response(200 if warmup.healthy else 503)
+                    self.send_header('Content-Type', 'application/json')
+                elif path == '/metrics':
+                    body = metrics.prometheus_text().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                else:
+                    self.send_error(404)
+                    return
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), HealthHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary(self):
+        if not self.status:
+            return "Models: no local models to warm up"
+        return "Models: " + "; ".join(f"{name} {self.describe(name)}" for name in self.status)
@@ -0,0 +1,223 @@
+"""
+Concurrent fetching and parsing of random Wikipedia articles, plus a local corpus of
+everything fetched so later runs can sample articles offline.
+
+ArticlePipeline runs a pool of fetcher threads against Special:Random and hands the
+HTML to a process pool for text extraction (with lxml when it is installed, which is
+much faster than html.parser). Parsed articles come out of a bounded queue, so
+fetching keeps going in the background while the caller runs model inference.
+
+Set WIKIPEDIA_RANDOM_URL to fetch from somewhere else, e.g. a local stand-in server.
+"""
+
+import multiprocessing
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import requests
+from bs4 import BeautifulSoup
+import metrics
+
+WIKIPEDIA_RANDOM_URL = os.getenv('WIKIPEDIA_RANDOM_URL', "https://en.wikipedia.org/wiki/Special:Random")
+DEFAULT_CORPUS_PATH = 'wiki_corpus.sqlite3'
+# Fetches or parses in a row that can fail before ArticlePipeline gives up (e.g. with the network down)
+MAX_FAILURES = 5
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+def parse_article_html(html):
+    """Extract the title and main text from a Wikipedia article page"""
+    soup = BeautifulSoup(html, HTML_PARSER)
+
+    # Get article title
+    title = soup.find(id="firstHeading").text
+
+    # Get main content (excluding references, navigation, etc.)
+    content = soup.find(id="mw-content-text")
+
+    # Remove unwanted elements
+    for unwanted in content.find_all(['table', 'sup', 'div.thumb', 'span.mw-editsection']):
+        unwanted.decompose()
+
+    # Extract text
+    text = content.get_text().strip()
+
+    return {
+        'title': title,
+        'text': text
+    }
+
+def timed_parse_article_html(html):
+    """parse_article_html plus how long it took, for timing parses done in other processes"""
+    start = time.perf_counter()
+    article = parse_article_html(html)
+    return article, time.perf_counter() - start
+
+class CorpusStore:
+    """SQLite file of fetched articles, to sample from without network access"""
+
+    def __init__(self, path=DEFAULT_CORPUS_PATH):
+        self.path = path
+        # Callers that share a store between threads (e.g. app.py's article pool) serialize access themselves
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS articles (
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL UNIQUE,
+                text TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        ''')
+        self.db.commit()
+
+    def add(self, article):
+        self.db.execute(
+            'INSERT OR REPLACE INTO articles (title, text, fetched_at) VALUES (?, ?, ?)',
+            (article['title'], article['text'], time.time())
+        )
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def random_article(self):
+        """Pick a stored article uniformly at random (using the random module, so seeding works)"""
+        count = len(self)
+        if count == 0:
+            raise ValueError(f"Corpus {self.path} is empty; run once without --offline to fill it")
+        title, text = self.db.execute(
+            'SELECT title, text FROM articles ORDER BY id LIMIT 1 OFFSET ?', (random.randrange(count),)
+        ).fetchone()
+        return {'title': title, 'text': text}
+
+    def close(self):
+        self.db.close()
+
+class ArticleFetchError(Exception):
+    """Raised by ArticlePipeline.articles() when too many fetches or parses fail in a row"""
+
+class ArticlePipeline:
+    """Fetch and parse `limit` random articles in the background.
+
+    Iterate over articles() to consume them in the order they finish fetching. Articles
+    that fail to fetch or parse are replaced by fetching another one, until max_failures
+    fail in a row without an article getting through; then articles() raises ArticleFetchError.
+    """
+
+    def __init__(self, limit, num_fetchers=4, num_parsers=None, corpus=None, url=WIKIPEDIA_RANDOM_URL,
+                 max_failures=MAX_FAILURES):
+        self.limit = limit
+        self.url = url
+        self.corpus = corpus
+        self.remaining = limit
+        self.max_failures = max_failures
+        self.failures = 0   # failed fetches and parses since the last article was delivered
+        self.error = None   # ArticleFetchError once there have been too many
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.parsed = queue.Queue(maxsize=max(2, 2 * num_fetchers))
+        # The fetcher threads are running by the time the pool starts its workers, and forking
+        # a process with threads running can deadlock it, so the workers aren't forked from this one
+        self.parse_pool = ProcessPoolExecutor(max_workers=num_parsers, mp_context=multiprocessing.get_context(
+            'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        ))
+        self.fetchers = [threading.Thread(target=self.fetch_loop, daemon=True) for _ in range(num_fetchers)]
+        for fetcher in self.fetchers:
+            fetcher.start()
+
+    def fetch_loop(self):
+        session = requests.Session()
+        failures = 0
+        while not self.stopped.is_set():
+            with self.condition:
+                while self.remaining == 0 and not self.stopped.is_set() and self.error is None:
+                    self.condition.wait(timeout=0.5)
+                if self.stopped.is_set() or self.error is not None:
+                    return
+                self.remaining -= 1
+
+            try:
+                with metrics.timer('wikipedia_fetch'):
+                    response = session.get(self.url, timeout=30)
+                response.raise_for_status()
+                failures = 0
+            except requests.RequestException as e:
+                print(f"Error fetching article: {e}")
+                metrics.count('fetch_errors')
+                self.failed('fetch', e)
+                failures += 1
+                self.stopped.wait(min(30, 2 ** failures))
+                continue
+
+            try:
+                future = self.parse_pool.submit(timed_parse_article_html, response.text)
+            except RuntimeError:
+                # The pool was shut down while we were fetching
+                return
+            while not self.stopped.is_set():
+                try:
+                    self.parsed.put(future, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+
+    def failed(self, what, error):
+        """Ask the fetchers for one more article to make up for one that failed, or give up"""
+        with self.condition:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                if self.error is None:
+                    self.error = ArticleFetchError(
+                        f"Giving up after {self.failures} failed article fetches/parses in a row "
+                        f"(last {what} error: {error})"
+                    )
+            else:
+                self.remaining += 1
+            self.condition.notify_all()
+
+    def next_parsed(self):
+        """The next parse future from the fetchers, raising the pipeline's error if it has given up"""
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.parsed.get(timeout=0.5)
+            except queue.Empty:
+                pass
+
+    def articles(self):
+        delivered = 0
+        while delivered < self.limit:
+            future = self.next_parsed()
+            try:
+                article, parse_seconds = future.result()
+            except Exception as e:
+                print(f"Error parsing article: {e}")
+                metrics.count('parse_errors')
+                self.failed('parse', e)
+                continue
+            metrics.observe('html_parse', parse_seconds)
+            with self.condition:
+                self.failures = 0
+
+            if self.corpus is not None:
+                self.corpus.add(article)
+            delivered += 1
+            yield article
+
+    def close(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        for fetcher in self.fetchers:
+            # A fetcher stuck in a slow request is a daemon thread and can be left behind
+            fetcher.join(timeout=1)
+        self.parse_pool.shutdown(cancel_futures=True)
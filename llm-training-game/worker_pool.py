@@ -0,0 +1,74 @@
+"""
+Bounded worker pool with priority queues, shared by every session of the Streamlit app.
+
+Work is split into lanes (e.g. "local" for GPT-2 forward passes and "remote" for API
+calls), each with a fixed number of worker threads, so the number of concurrent calls
+of each kind is capped separately. Within a lane, tasks run lowest priority number
+first, and in submission order for equal priorities.
+
+Tasks can be tagged (e.g. with the article a session is playing), and cancel(tag)
+drops every tagged task that hasn't started yet.
+"""
+
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+
+class PriorityWorkerPool:
+    def __init__(self, lanes):
+        """lanes maps lane name -> number of worker threads"""
+        self.lock = threading.Lock()
+        self.queues = {lane: [] for lane in lanes}
+        self.ready = {lane: threading.Condition(self.lock) for lane in lanes}
+        self.tagged = {}  # tag -> set of futures not yet started
+        self.order = itertools.count()
+        self.workers = []
+        for lane, num_workers in lanes.items():
+            for _ in range(num_workers):
+                worker = threading.Thread(target=self.work, args=(lane,), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, lane, priority, fn, tag=None):
+        """Queue fn() on a lane and return a Future for its result"""
+        future = Future()
+        with self.lock:
+            heapq.heappush(self.queues[lane], (priority, next(self.order), future, fn, tag))
+            if tag is not None:
+                self.tagged.setdefault(tag, set()).add(future)
+            self.ready[lane].notify()
+        return future
+
+    def cancel(self, tag):
+        """Cancel every task with this tag that hasn't started. Returns how many were cancelled."""
+        with self.lock:
+            futures = self.tagged.pop(tag, set())
+        return sum(future.cancel() for future in futures)
+
+    def work(self, lane):
+        queue = self.queues[lane]
+        while True:
+            with self.lock:
+                while not queue:
+                    self.ready[lane].wait()
+                _, _, future, fn, tag = heapq.heappop(queue)
+                if tag is not None and tag in self.tagged:
+                    self.tagged[tag].discard(future)
+                    if not self.tagged[tag]:
+                        del self.tagged[tag]
+
+            # Skips tasks cancelled while they were queued
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def summary(self):
+        with self.lock:
+            queued = ", ".join(f"{len(queue)} {lane}" for lane, queue in self.queues.items())
+        return f"Worker pool: {len(self.workers)} workers, queued: {queued}"